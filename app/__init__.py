@@ -1,13 +1,24 @@
 """
 Flask - Proxy Service Dashboard App
+
+The app and its extensions are created on import, create_app() makes it ready
+to serve (see wsgi.py and run.py)
 """
 
+import os
+import tempfile
+
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from flask_wtf.csrf import CSRFProtect
 
 from app.config import get_config
+from app.contrib.api import configure_circuit_breaker
+from app.contrib.api import configure_retries
+from app.contrib.api import configure_session
+from app.contrib.api import configure_single_flight
+from app.contrib.api import configure_timeouts
 
 config = get_config()
 
@@ -16,10 +27,120 @@ psdash.config['APP_DOMAINS'] = {domain for domain in config['app']['domains']}
 psdash.config['SECRET_KEY'] = config['app']['secret_key']
 psdash.config['SQLALCHEMY_DATABASE_URI'] = config['database']['uri']
 psdash.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Check the connections before using them and replace the old ones
+psdash.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_pre_ping': config['database'].get('pool_pre_ping', True),
+    'pool_recycle': config['database'].get('pool_recycle', 1800),
+}
+if not config['database']['uri'].startswith('sqlite'):
+    # Connections per worker: pool_size kept open + max_overflow on peaks, a request
+    # waits at most pool_timeout seconds for one
+    psdash.config['SQLALCHEMY_ENGINE_OPTIONS'].update(
+        pool_size=config['database'].get('pool_size', 10),
+        max_overflow=config['database'].get('max_overflow', 20),
+        pool_timeout=config['database'].get('pool_timeout', 10))
+psdash.config['USER_CACHE_TTL'] = config.get('cache', {}).get('user_ttl', 300)
+psdash.config['USER_CACHE_SIZE'] = config.get('cache', {}).get('user_size', 256)
+
+# Password hashing: max concurrent hashes per worker and seconds to wait for one
+psdash.config['PASSWORD_CONCURRENCY'] = config.get('auth', {}).get('hash_concurrency', 2)
+psdash.config['PASSWORD_QUEUE_TIMEOUT'] = config.get('auth', {}).get('hash_queue_timeout', 5)
 psdash.config['PAGE_SIZE'] = config['app']['page_size']
+psdash.config['ASYNC_VIEWS'] = config['app'].get('async_views', False)
+psdash.config['IMPORT_BATCH_SIZE'] = config['app'].get('import_batch_size', 100)
+psdash.config['EXPORT_PAGE_SIZE'] = config['app'].get('export_page_size', 500)
+psdash.config['BULK_CONCURRENCY'] = config['app'].get('bulk_concurrency', 20)
+# Live updates of the lists (Server-Sent Events)
+psdash.config['LIVE_UPDATES'] = config['app'].get('live_updates', True)
+psdash.config['LIVE_INTERVAL'] = config['app'].get('live_interval', 15)
+psdash.config['LIVE_KEEPALIVE'] = config['app'].get('live_keepalive', 15)
+# Compile the templates and cache the reference data before serving
+psdash.config['WARM_UP'] = config['app'].get('warm_up', True)
+# Serve the built static assets (python run.py --build-assets) if there are any
+psdash.config['BUILT_ASSETS'] = config['app'].get('built_assets', True)
+# Gzip the HTML responses (if the web server in front does not)
+psdash.config['GZIP_HTML'] = config['app'].get('gzip_html', True)
+psdash.config['GZIP_MIN_SIZE'] = config['app'].get('gzip_min_size', 1024)
+psdash.config['GZIP_LEVEL'] = config['app'].get('gzip_level', 6)
 
 psdash.config['api_url'] = config['api']['url']
 psdash.config['api_key'] = config['api']['api_key']
+psdash.config['API_CONCURRENCY'] = config['api'].get('concurrency', 10)
+psdash.config['KEYSET_ENDPOINTS'] = set(config['api'].get('keyset_endpoints', []))
+psdash.config['KEYSET_PARAM'] = config['api'].get('keyset_param', 'after_id')
+
+# Reference data cache (providers, plans, types and locations)
+psdash.config['REFERENCE_CACHE_TTL'] = config.get('cache', {}).get('reference_ttl', 300)
+psdash.config['REFERENCE_CACHE_SIZE'] = config.get('cache', {}).get('reference_size', 16)
+psdash.config['STATS_TTL'] = config.get('cache', {}).get('stats_ttl', 3600)
+psdash.config['PAGE_CACHE_TTL'] = config.get('cache', {}).get('page_ttl', 30)
+psdash.config['PAGE_CACHE_SIZE'] = config.get('cache', {}).get('page_size', 64)
+# API responses cache shared by the workers of the host
+psdash.config['SHARED_CACHE'] = config.get('cache', {}).get('shared', True)
+# By default in a private directory (0700) of the user in the temp dir
+psdash.config['SHARED_CACHE_PATH'] = config.get('cache', {}).get('shared_path') or os.path.join(
+    tempfile.gettempdir(), 'psdash-{}'.format(os.getuid()), 'api-cache.sqlite')
+psdash.config['SHARED_CACHE_TTL'] = config.get('cache', {}).get('shared_ttl', 30)
+psdash.config['SHARED_CACHE_SIZE'] = config.get('cache', {}).get('shared_size', 1000)
+# Seconds an expired response is still served while it is requested again
+psdash.config['SHARED_CACHE_MAX_STALE'] = config.get('cache', {}).get('shared_max_stale', 300)
+# Background refresh of the hot pages in the shared cache
+psdash.config['REFRESH'] = config.get('refresh', {}).get('enabled', True)
+psdash.config['REFRESH_INTERVAL'] = config.get('refresh', {}).get('interval', 20)
+psdash.config['REFRESH_MAX_INTERVAL'] = config.get('refresh', {}).get('max_interval', 300)
+psdash.config['REFRESH_SLOW_THRESHOLD'] = config.get('refresh', {}).get('slow_threshold', 2)
+psdash.config['REFRESH_ENDPOINTS'] = config.get('refresh', {}).get(
+    'endpoints', ['proxy', 'target', 'provider_plan'])
+psdash.config['REFRESH_PAGES'] = config.get('refresh', {}).get('pages', 3)
+psdash.config['REFRESH_STATS'] = config.get('refresh', {}).get('stats', False)
+
+# List search and filters
+psdash.config['SEARCH_INDEX_TTL'] = config.get('search', {}).get('index_ttl', 600)
+psdash.config['SEARCH_PUSHDOWN_FIELDS'] = set(config.get('search', {}).get(
+    'pushdown_fields', ['provider_id', 'provider_plan_id', 'proxy_type_id', 'proxy_location_id']))
+
+# Proxy health checks
+psdash.config['HEALTHCHECK_URL'] = config.get('healthcheck', {}).get(
+    'check_url', 'http://example.com/')
+psdash.config['HEALTHCHECK_TIMEOUT'] = config.get('healthcheck', {}).get('timeout', 10)
+psdash.config['HEALTHCHECK_CONCURRENCY'] = config.get('healthcheck', {}).get('concurrency', 50)
+psdash.config['HEALTHCHECK_PROVIDER_CONCURRENCY'] = config.get('healthcheck', {}).get(
+    'provider_concurrency', 10)
+psdash.config['HEALTHCHECK_DEACTIVATE_AFTER'] = config.get('healthcheck', {}).get(
+    'deactivate_after', 0)
+
+# Instrumentation: Server-Timing headers and the /metrics endpoint
+psdash.config['METRICS'] = config.get('metrics', {}).get('enabled', True)
+# Who can read /metrics, besides the logged in users: a bearer token, the addresses
+psdash.config['METRICS_TOKEN'] = config.get('metrics', {}).get('token', '')
+psdash.config['METRICS_ALLOW'] = config.get('metrics', {}).get('allow', [])
+
+# Keep-alive connection pool shared by every API client of the worker
+configure_session(
+    pool_connections=config['api'].get('pool_connections', 10),
+    pool_maxsize=config['api'].get('pool_maxsize', 10),
+    pool_block=config['api'].get('pool_block', False))
+# Concurrent identical GETs of the worker share one upstream request
+configure_single_flight(
+    enabled=config['api'].get('single_flight', True),
+    timeout=config['api'].get('single_flight_timeout') or None)
+# Timeouts of the API requests: the default ones and by endpoint
+configure_timeouts(
+    connect=config['api'].get('connect_timeout', 3.05),
+    read=config['api'].get('read_timeout', 30),
+    endpoints=config['api'].get('timeouts', {}))
+# Retries of the failed idempotent requests, bounded by a budget
+configure_retries(
+    max_attempts=config['api'].get('retry_attempts', 3),
+    backoff=config['api'].get('retry_backoff', 0.1),
+    max_backoff=config['api'].get('retry_max_backoff', 2),
+    budget_ratio=config['api'].get('retry_budget', 0.1),
+    budget_min_per_second=config['api'].get('retry_min_per_second', 1))
+# Fail fast (degraded page) while the API keeps failing
+configure_circuit_breaker(
+    enabled=config['api'].get('circuit_breaker', True),
+    failure_threshold=config['api'].get('breaker_failures', 5),
+    reset_timeout=config['api'].get('breaker_reset', 30))
 
 # Setup Flask-SQLAlchemy
 db = SQLAlchemy(psdash)
@@ -30,3 +151,30 @@ csrf_protect = CSRFProtect(psdash)
 # Login Manager
 login_manager = LoginManager(psdash)
 login_manager.login_view = 'login.login'
+
+
+def create_app():
+    '''Return the app ready to serve: blueprints registered, the API responses in the
+    shared cache (see app.utils.cache) and refreshed in the background (see
+    app.utils.refresher), the built static assets served (see
+    app.utils.assets) and, if enabled, the templates compiled and the reference
+    data cached (see app.utils.warmup)
+    It can be called more than once, the app is only set up the first time
+    With gunicorn preload_app it runs in the master, before forking the workers'''
+    if 'dashboard' not in psdash.blueprints:
+        from app.views import register_blueprints
+        register_blueprints(psdash)
+        from app.utils.cache import init_shared_cache
+        init_shared_cache(psdash)
+        from app.utils.refresher import init_refresher
+        init_refresher(psdash)
+        if psdash.config['GZIP_HTML']:
+            from app.utils.conditional import init_compression
+            init_compression(psdash)
+        if psdash.config['BUILT_ASSETS']:
+            from app.utils.assets import init_assets
+            init_assets(psdash)
+        if psdash.config['WARM_UP']:
+            from app.utils.warmup import warm_up
+            warm_up(psdash)
+    return psdash
@@ -9,6 +9,8 @@ Even for scrapers/spiders
 That means, it should always be imported this way
 
 from config import get_config
+
+The PSDASH_CONFIG environment variable can point to another file (tests, benchmarks)
 """
 
 import os
@@ -26,7 +28,7 @@ class ConfigError(Exception):
 def get_config():
     '''Read the config file and return a dict'''
     config = None
-    config_path = os.path.join(HERE, CONFIG_FILENAME)
+    config_path = os.environ.get('PSDASH_CONFIG', os.path.join(HERE, CONFIG_FILENAME))
     if not os.path.exists(config_path):
         raise ConfigError('File does not exist: {}'.format(config_path))
     with open(config_path) as c_f:
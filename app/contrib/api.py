@@ -2,40 +2,449 @@
 RESTful JSON-API Client
 """
 
+import os
+import json
+import time
+import random
+import hashlib
 import logging
+import threading
 import requests
+from requests.adapters import HTTPAdapter
 from w3lib.url import urljoin
 from w3lib.url import add_or_replace_parameter
 
+from app.contrib.breaker import CircuitBreaker
+from app.contrib.breaker import RetryBudget
+from app.contrib.pool import spawn
+
 
 logger = logging.getLogger(__name__)
 
 
+SESSION_OPTIONS = {
+    'pool_connections': 10,
+    'pool_maxsize': 10,
+    'pool_block': False,
+}
+
+_session = None
+_session_pid = None
+
+# Concurrent identical GETs share one upstream request (see SingleFlight)
+_single_flight = None
+
+# Cache of the GET responses (see configure_cache)
+_cache = None
+
+# (<connect>, <read>) timeouts in seconds: the default one and by endpoint
+# (see configure_timeouts)
+_default_timeout = (3.05, 30)
+_timeouts = {}
+
+# Retries of the failed idempotent requests (see configure_retries)
+IDEMPOTENT_METHODS = frozenset(('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'))
+RETRY_STATUSES = frozenset((502, 503, 504))
+_retry_policy = None
+
+# Fail fast while the API is failing (see configure_circuit_breaker)
+_breaker = None
+
+# Functions called after every request: listener(<method>, <endpoint>, <status>, <seconds>)
+_request_listeners = []
+# Functions called for every GET read from the cache: listener(<endpoint>, <age>)
+_cache_hit_listeners = []
+
+
+def add_request_listener(listener):
+    '''Register a function called after every API request (sync or async) with the
+    HTTP method, the endpoint, the response status (or the exception class name if
+    the request failed) and the seconds it took'''
+    if listener not in _request_listeners:
+        _request_listeners.append(listener)
+
+
+def notify_request(method, endpoint, status, elapsed):
+    '''Call the request listeners'''
+    for listener in _request_listeners:
+        try:
+            listener(method, endpoint, status, elapsed)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('API request listener failed')
+
+
+def add_cache_hit_listener(listener):
+    '''Register a function called when a GET is read from the cache with the
+    endpoint and the age (seconds) of the cached response'''
+    if listener not in _cache_hit_listeners:
+        _cache_hit_listeners.append(listener)
+
+
+def notify_cache_hit(endpoint, age):
+    '''Call the cache hit listeners'''
+    for listener in _cache_hit_listeners:
+        try:
+            listener(endpoint, age)
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('API cache hit listener failed')
+
+
+def configure_session(**options):
+    '''Set the connection pool options used by the shared session
+    Valid options: pool_connections, pool_maxsize, pool_block
+    The current session (if any) is dropped so the next request will use the new options'''
+    global _session
+    unknown = set(options) - set(SESSION_OPTIONS)
+    if unknown:
+        raise ValueError('Unknown session options: {}'.format(', '.join(sorted(unknown))))
+    SESSION_OPTIONS.update(options)
+    if _session is not None:
+        _session.close()
+    _session = None
+
+
+def get_session():
+    '''Return the keep-alive session shared by every API instance in this process
+    It is created lazily and again after a fork, so every worker gets its own pool'''
+    global _session, _session_pid
+    pid = os.getpid()
+    if _session is None or _session_pid != pid:
+        session = requests.Session()
+        adapter = HTTPAdapter(**SESSION_OPTIONS)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        _session = session
+        _session_pid = pid
+    return _session
+
+
+class SingleFlightTimeout(requests.exceptions.Timeout):
+    '''Waited too long for the result of an identical request in flight'''
+
+
+class _Flight:
+    '''A call in flight: its waiters get its result or its exception'''
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    '''Run a function once for the concurrent calls with the same key: the calls made
+    while it is running wait for it (up to `timeout` seconds, or the timeout of the
+    call) and get its result or its exception. Nothing is kept once it finishes, so
+    no stale result is returned'''
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, timeout=None):
+        '''Return func() or the result of the identical call in flight
+        @param timeout: max seconds waiting for it if the SingleFlight has no timeout'''
+        timeout = self.timeout if self.timeout is not None else timeout
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if not leader:
+            if not flight.done.wait(timeout):
+                raise SingleFlightTimeout('Identical request still in flight after {}s'.format(
+                    timeout))
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = func()
+        except BaseException as exc:
+            # A killed greenlet (GreenletExit) must not be re-raised in the waiters
+            flight.error = exc if isinstance(exc, Exception) else \
+                requests.exceptions.ConnectionError('Identical request in flight was interrupted')
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result
+
+
+def configure_single_flight(enabled=True, timeout=None):
+    '''Enable (or disable) the coalescing of concurrent identical GET requests
+    @param timeout: max seconds waiting for the request in flight, by default the
+    longest it can take with its retries (see API.max_duration)'''
+    global _single_flight
+    _single_flight = SingleFlight(timeout=timeout) if enabled else None
+
+
+def configure_cache(cache):
+    '''Set the cache of the GET responses, None to disable it
+    It can be any object with the get_entry, set, extend, generation methods and
+    the timer attribute of app.contrib.shared_cache.SharedCache. The responses are
+    tagged with their endpoint, invalidate the tag after writing to an endpoint'''
+    global _cache
+    _cache = cache
+
+
+def get_cache():
+    '''Return the cache of the GET responses (None if disabled)'''
+    return _cache
+
+
+def get_request_keys(api_url, params):
+    '''Return the keys of a GET: (<single-flight key>, <cache key>)'''
+    key = repr((api_url, tuple(sorted((name, str(value)) for name, value in params.items()))))
+    return key, hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+
+def configure_timeouts(connect=3.05, read=30, endpoints=None):
+    '''Set the seconds to connect to the API and to wait for a response
+    @param endpoints: {<endpoint>: (<connect>, <read>)} for the endpoints with other
+    timeouts (a number is the read timeout)'''
+    global _default_timeout
+    _default_timeout = (connect, read)
+    _timeouts.clear()
+    for endpoint, timeout in (endpoints or {}).items():
+        _timeouts[endpoint] = (connect, timeout) if isinstance(timeout, (int, float)) \
+            else tuple(timeout)
+
+
+def get_timeout(endpoint):
+    '''Return the (<connect>, <read>) timeouts of an endpoint'''
+    return _timeouts.get(endpoint, _default_timeout)
+
+
+class RetryPolicy:
+    '''Retry the idempotent requests that failed with a transient error (connection
+    error, timeout, 502/503/504 response) after a random delay up to `backoff`
+    seconds doubled on every attempt (at most `max_backoff`). A request is sent at
+    most `max_attempts` times, and only while the retry budget lasts'''
+
+    def __init__(self, max_attempts=3, backoff=0.1, max_backoff=2, budget=None):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.budget = budget or RetryBudget()
+
+    def should_retry(self, method, attempt):
+        '''Return whether a failed attempt of a request can be retried'''
+        return (method in IDEMPOTENT_METHODS and attempt < self.max_attempts
+                and self.budget.withdraw())
+
+    def delay(self, attempt):
+        '''Seconds to wait before retrying a failed attempt'''
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** (attempt - 1)))
+
+
+def configure_retries(max_attempts=3, backoff=0.1, max_backoff=2, budget_ratio=0.1,
+                      budget_min_per_second=1):
+    '''Set the retries of the failed idempotent requests (max_attempts=1 disables them)
+    @param budget_ratio: retries allowed as a ratio of the requests of the process
+    @param budget_min_per_second: retries always allowed (see RetryBudget)'''
+    global _retry_policy
+    _retry_policy = RetryPolicy(
+        max_attempts=max_attempts, backoff=backoff, max_backoff=max_backoff,
+        budget=RetryBudget(ratio=budget_ratio, min_per_second=budget_min_per_second)) \
+        if max_attempts > 1 else None
+
+
+def get_retry_policy():
+    '''Return the RetryPolicy of the requests (None if the retries are disabled)'''
+    return _retry_policy
+
+
+class CircuitOpenError(requests.exceptions.ConnectionError):
+    '''The API is failing, the request was not sent (see configure_circuit_breaker)'''
+
+    def __init__(self, *args, retry_after=0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.retry_after = retry_after
+
+
+def configure_circuit_breaker(enabled=True, failure_threshold=5, reset_timeout=30):
+    '''Enable (or disable) the circuit breaker of the API: after `failure_threshold`
+    consecutive failed requests (connection error, timeout, 5xx response) the requests
+    fail with CircuitOpenError, without being sent, during `reset_timeout` seconds'''
+    global _breaker
+    _breaker = CircuitBreaker('api', failure_threshold=failure_threshold,
+                              reset_timeout=reset_timeout) if enabled else None
+
+
+def get_circuit_breaker():
+    '''Return the circuit breaker of the API (None if disabled)'''
+    return _breaker
+
+
+def check_circuit(method, endpoint):
+    '''Raise CircuitOpenError if a request can not be sent now
+    Return the circuit breaker to record its result (None if disabled)'''
+    breaker = _breaker
+    if breaker is not None and not breaker.allow():
+        notify_request(method, endpoint, CircuitOpenError.__name__, 0.0)
+        retry_after = breaker.retry_after()
+        raise CircuitOpenError('The API is failing, not retried for {:.0f}s'.format(retry_after),
+                               retry_after=retry_after)
+    return breaker
+
+
+def record_result(breaker, status):
+    '''Record the result of a request in the circuit breaker: the response status, an
+    exception class name or None (the request failed)'''
+    if breaker is None:
+        return
+    if not isinstance(status, int) or status >= 500:
+        breaker.record_failure()
+    else:
+        breaker.record_success()
+
+
 class API:
-    '''Class for RESTful API based on JSON'''
+    '''Class for RESTful API based on JSON
+    @param timeout: seconds (or a (<connect>, <read>) tuple) for all the requests,
+    the configured ones by default (see configure_timeouts)'''
 
-    def __init__(self, api_url, api_key, timeout=30):
+    def __init__(self, api_url, api_key, timeout=None, session=None):
         self.api_url = api_url
         self.api_key = api_key
         self.timeout = timeout
+        self._session = session
+
+    @property
+    def session(self):
+        '''The HTTP session used for the requests (the shared one by default)'''
+        if self._session is not None:
+            return self._session
+        return get_session()
+
+    def get_timeout(self, endpoint):
+        '''Return the timeout of the requests to an endpoint'''
+        return get_timeout(endpoint) if self.timeout is None else self.timeout
 
-    def get(self, endpoint, *, elem_id=None, **query):
-        '''GET Request'''
+    def max_duration(self, endpoint):
+        '''Return the seconds a request to an endpoint takes at most with its retries
+        (the read timeout is per read, a response trickling in can take longer)'''
+        timeout = self.get_timeout(endpoint)
+        attempt = sum(timeout) if isinstance(timeout, tuple) else timeout
+        policy = _retry_policy
+        if policy is None:
+            return attempt
+        return attempt * policy.max_attempts + policy.max_backoff * (policy.max_attempts - 1)
+
+    def send(self, method, endpoint, api_url, **kwargs):
+        '''Send a request to the API and return the response
+        The idempotent requests that fail with a transient error are retried (see
+        configure_retries), no request is sent while the circuit breaker is open
+        (see configure_circuit_breaker)'''
+        policy = _retry_policy
+        if policy is not None:
+            policy.budget.deposit()
+        attempt = 1
+        while True:
+            try:
+                resp = self.send_once(method, endpoint, api_url, **kwargs)
+            except CircuitOpenError:
+                raise
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                if policy is None or not policy.should_retry(method, attempt):
+                    raise
+            else:
+                if resp.status_code not in RETRY_STATUSES or policy is None \
+                        or not policy.should_retry(method, attempt):
+                    return resp
+            logger.info('Retrying %s request to %s (attempt %d)', method, endpoint, attempt)
+            time.sleep(policy.delay(attempt))
+            attempt += 1
+
+    def send_once(self, method, endpoint, api_url, **kwargs):
+        '''Send a request to the API (once) and return the response
+        The listeners (see add_request_listener) are notified'''
+        breaker = check_circuit(method, endpoint)
+        start = time.perf_counter()
+        status = None
+        try:
+            resp = self.session.request(method, api_url, timeout=self.get_timeout(endpoint),
+                                        **kwargs)
+            status = resp.status_code
+        except Exception as exc:
+            status = exc.__class__.__name__
+            raise
+        finally:
+            record_result(breaker, status)
+            notify_request(method, endpoint, status, time.perf_counter() - start)
+        return resp
+
+    def request(self, method, endpoint, api_url, refresh=False, stale=False, **kwargs):
+        '''Send a request to the API and return the JSON response
+        A GET is read from the shared cache (see configure_cache) when it is there.
+        With `stale` an expired one is returned too, while it is revalidated in the
+        background: only for reads that are just displayed (lists, reference data).
+        With `refresh` the GET is sent (and cached) even if it is cached: for the
+        reads that feed a write or an edit form.
+        A GET identical to one in flight (see configure_single_flight) waits for it
+        instead. Every caller parses the body into its own objects'''
+        if method != 'GET':
+            return self.send(method, endpoint, api_url, **kwargs).json()
+        key, cache_key = get_request_keys(api_url, kwargs.get('params') or {})
+        cache = _cache
+        if cache is None:
+            return json.loads(self.fetch(key, None, endpoint, api_url, **kwargs).content)
+        entry = None if refresh else cache.get_entry(cache_key)
+        if entry is not None:
+            content, stored, expires = entry
+            now = cache.timer()
+            if expires > now or stale:
+                notify_cache_hit(endpoint, now - stored)
+                # Only the first worker to see it stale revalidates it
+                if expires <= now and cache.extend(cache_key, self.max_duration(endpoint)):
+                    spawn(self.revalidate, key, cache_key, endpoint, api_url, **kwargs)
+                return json.loads(content)
+        return json.loads(self.fetch(key, cache_key, endpoint, api_url, **kwargs).content)
+
+    def fetch(self, key, cache_key, endpoint, api_url, **kwargs):
+        '''Send a GET (or wait for the identical one in flight) and cache the response
+        Return the response'''
+        cache = _cache if cache_key is not None else None
+        # A write to the endpoint while this GET is in flight makes it stale
+        generation = cache.generation(endpoint) if cache is not None else None
+
+        def send():
+            resp = self.send('GET', endpoint, api_url, **kwargs)
+            if cache is not None and resp.status_code == 200:
+                cache.set(cache_key, resp.content, tag=endpoint, generation=generation)
+            return resp
+
+        if _single_flight is None:
+            return send()
+        return _single_flight.do(key, send, timeout=self.max_duration(endpoint))
+
+    def revalidate(self, key, cache_key, endpoint, api_url, **kwargs):
+        '''Refresh a stale cached GET (in the background)'''
+        try:
+            self.fetch(key, cache_key, endpoint, api_url, **kwargs)
+        except Exception as exc:  # pylint: disable=broad-except
+            logger.warning('Revalidation of %s failed: %r', endpoint, exc)
+
+    def get(self, endpoint, *, elem_id=None, refresh=False, stale=False, **query):
+        '''GET Request
+        @param refresh: do not read it from the cache
+        @param stale: it can be read from the cache even if it expired (see request)'''
         api_url = urljoin(self.api_url, endpoint)
         if elem_id is not None:
             api_url = urljoin(api_url + '/', str(elem_id))
         logger.info('GET request to: %s', api_url)
         api_url = add_or_replace_parameter(api_url, 'api_key', self.api_key)
-        resp = requests.get(api_url, params=query, timeout=self.timeout)
-        return resp.json()
+        return self.request('GET', endpoint, api_url, refresh=refresh, stale=stale,
+                            params=query)
 
     def post(self, endpoint, **data):
         '''POST Request'''
         api_url = urljoin(self.api_url, endpoint)
         logger.info('POST request to: %s Data: %r', api_url, data)
         api_url = add_or_replace_parameter(api_url, 'api_key', self.api_key)
-        resp = requests.post(api_url, json=data, timeout=self.timeout)
-        return resp.json()
+        return self.request('POST', endpoint, api_url, json=data)
 
     def put(self, endpoint, elem_id, **data):
         '''PUT Request'''
@@ -43,8 +452,7 @@ class API:
         api_url = urljoin(api_url + '/', str(elem_id))
         logger.info('PUT request to: %s Data: %r', api_url, data)
         api_url = add_or_replace_parameter(api_url, 'api_key', self.api_key)
-        resp = requests.put(api_url, json=data, timeout=self.timeout)
-        return resp.json()
+        return self.request('PUT', endpoint, api_url, json=data)
 
     def delete(self, endpoint, elem_id):
         '''DELETE Request'''
@@ -52,5 +460,17 @@ class API:
         api_url = urljoin(api_url + '/', str(elem_id))
         logger.info('DELETE request to: %s', api_url)
         api_url = add_or_replace_parameter(api_url, 'api_key', self.api_key)
-        resp = requests.delete(api_url)
-        return resp.json()
+        return self.request('DELETE', endpoint, api_url)
+
+    def iter_pages(self, endpoint, page_size=100, **query):
+        '''Iterate over all the elements of an endpoint, one page (list) at a time'''
+        offset = 0
+        while True:
+            resp = self.get(endpoint, offset=offset, limit=page_size, **query)
+            data = resp['data']
+            if not data:
+                return
+            yield data
+            offset += len(data)
+            if len(data) < page_size or offset >= resp.get('total', offset + 1):
+                return
@@ -0,0 +1,205 @@
+"""
+Asynchronous RESTful JSON-API Client
+
+Same interface as app.contrib.api.API, built on httpx, with the same timeouts,
+retries, circuit breaker and GET responses cache. The GETs are not coalesced and
+an expired response is never returned: an async view runs in its own event loop,
+nothing can revalidate it once the view returned
+"""
+
+import json
+import time
+import asyncio
+import logging
+import contextlib
+import contextvars
+
+import httpx
+from w3lib.url import urljoin
+from w3lib.url import add_or_replace_parameter
+
+from app.contrib.api import RETRY_STATUSES
+from app.contrib.api import SESSION_OPTIONS
+from app.contrib.api import check_circuit
+from app.contrib.api import get_cache
+from app.contrib.api import get_request_keys
+from app.contrib.api import get_retry_policy
+from app.contrib.api import get_timeout
+from app.contrib.api import notify_cache_hit
+from app.contrib.api import notify_request
+from app.contrib.api import record_result
+
+
+logger = logging.getLogger(__name__)
+
+# The keep-alive client of the current client_scope
+_client = contextvars.ContextVar('async_api_client', default=None)
+
+
+@contextlib.asynccontextmanager
+async def client_scope():
+    '''Share a keep-alive client between the AsyncAPI instances running in the block
+    (and the tasks it starts) and close it at the end. Its connections are bound to
+    the event loop, use one scope per loop (Flask runs every async view in a new one)
+    The pool limits are the ones configured for the sync session'''
+    limits = httpx.Limits(max_connections=SESSION_OPTIONS['pool_maxsize'],
+                          max_keepalive_connections=SESSION_OPTIONS['pool_maxsize'])
+    async with httpx.AsyncClient(limits=limits) as client:
+        token = _client.set(client)
+        try:
+            yield client
+        finally:
+            _client.reset(token)
+
+
+def get_client():
+    '''Return the keep-alive client of the current client_scope'''
+    client = _client.get()
+    if client is None:
+        raise RuntimeError('AsyncAPI used outside of a client_scope()')
+    return client
+
+
+async def gather_bounded(*aws, concurrency=10):
+    '''Await all the awaitables with at most `concurrency` of them running at once
+    Return their results in the same order'''
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(awaitable):
+        async with semaphore:
+            return await awaitable
+
+    return await asyncio.gather(*(run(awaitable) for awaitable in aws))
+
+
+class AsyncAPI:
+    '''Async class for RESTful API based on JSON'''
+
+    def __init__(self, api_url, api_key, timeout=None, client=None):
+        self.api_url = api_url
+        self.api_key = api_key
+        self.timeout = timeout
+        self._client = client
+
+    @property
+    def client(self):
+        '''The HTTP client used for the requests (the one of the client_scope by default)'''
+        if self._client is not None:
+            return self._client
+        return get_client()
+
+    def get_timeout(self, endpoint):
+        '''Return the timeout of the requests to an endpoint'''
+        if self.timeout is not None:
+            return self.timeout
+        connect, read = get_timeout(endpoint)
+        return httpx.Timeout(read, connect=connect)
+
+    async def request(self, method, endpoint, api_url, refresh=False, **kwargs):
+        '''Send a request to the API and return the JSON response
+        A GET is read from the cache of the sync API (see
+        app.contrib.api.configure_cache) if it did not expire, with `refresh` it is
+        sent (and cached) even if it is cached'''
+        cache = get_cache() if method == 'GET' else None
+        if cache is None:
+            return (await self.send(method, endpoint, api_url, **kwargs)).json()
+        _, cache_key = get_request_keys(api_url, kwargs.get('params') or {})
+        entry = None if refresh else cache.get_entry(cache_key)
+        if entry is not None:
+            content, stored, expires = entry
+            now = cache.timer()
+            if expires > now:
+                notify_cache_hit(endpoint, now - stored)
+                return json.loads(content)
+        # A write to the endpoint while this GET is in flight makes it stale
+        generation = cache.generation(endpoint)
+        resp = await self.send(method, endpoint, api_url, **kwargs)
+        if resp.status_code == 200:
+            cache.set(cache_key, resp.content, tag=endpoint, generation=generation)
+        return json.loads(resp.content)
+
+    async def send(self, method, endpoint, api_url, **kwargs):
+        '''Send a request to the API and return the response
+        The failed idempotent requests are retried like the sync ones (see
+        app.contrib.api.configure_retries)'''
+        policy = get_retry_policy()
+        if policy is not None:
+            policy.budget.deposit()
+        attempt = 1
+        while True:
+            try:
+                resp = await self.send_once(method, endpoint, api_url, **kwargs)
+            except httpx.TransportError:
+                if policy is None or not policy.should_retry(method, attempt):
+                    raise
+            else:
+                if resp.status_code not in RETRY_STATUSES or policy is None \
+                        or not policy.should_retry(method, attempt):
+                    return resp
+            logger.info('Retrying %s request to %s (attempt %d)', method, endpoint, attempt)
+            await asyncio.sleep(policy.delay(attempt))
+            attempt += 1
+
+    async def send_once(self, method, endpoint, api_url, **kwargs):
+        '''Send a request to the API (once) and return the response
+        The listeners (see app.contrib.api.add_request_listener) are notified'''
+        breaker = check_circuit(method, endpoint)
+        start = time.perf_counter()
+        status = None
+        try:
+            resp = await self.client.request(method, api_url, timeout=self.get_timeout(endpoint),
+                                             **kwargs)
+            status = resp.status_code
+        except Exception as exc:
+            status = exc.__class__.__name__
+            raise
+        finally:
+            record_result(breaker, status)
+            notify_request(method, endpoint, status, time.perf_counter() - start)
+        return resp
+
+    async def get(self, endpoint, *, elem_id=None, refresh=False, **query):
+        '''GET Request
+        @param refresh: do not read it from the cache'''
+        api_url = urljoin(self.api_url, endpoint)
+        if elem_id is not None:
+            api_url = urljoin(api_url + '/', str(elem_id))
+        logger.info('GET request to: %s', api_url)
+        api_url = add_or_replace_parameter(api_url, 'api_key', self.api_key)
+        return await self.request('GET', endpoint, api_url, refresh=refresh, params=query)
+
+    async def post(self, endpoint, **data):
+        '''POST Request'''
+        api_url = urljoin(self.api_url, endpoint)
+        logger.info('POST request to: %s Data: %r', api_url, data)
+        api_url = add_or_replace_parameter(api_url, 'api_key', self.api_key)
+        return await self.request('POST', endpoint, api_url, json=data)
+
+    async def put(self, endpoint, elem_id, **data):
+        '''PUT Request'''
+        api_url = urljoin(self.api_url, endpoint)
+        api_url = urljoin(api_url + '/', str(elem_id))
+        logger.info('PUT request to: %s Data: %r', api_url, data)
+        api_url = add_or_replace_parameter(api_url, 'api_key', self.api_key)
+        return await self.request('PUT', endpoint, api_url, json=data)
+
+    async def delete(self, endpoint, elem_id):
+        '''DELETE Request'''
+        api_url = urljoin(self.api_url, endpoint)
+        api_url = urljoin(api_url + '/', str(elem_id))
+        logger.info('DELETE request to: %s', api_url)
+        api_url = add_or_replace_parameter(api_url, 'api_key', self.api_key)
+        return await self.request('DELETE', endpoint, api_url)
+
+    async def iter_pages(self, endpoint, page_size=100, **query):
+        '''Iterate over all the elements of an endpoint, one page (list) at a time'''
+        offset = 0
+        while True:
+            resp = await self.get(endpoint, offset=offset, limit=page_size, **query)
+            data = resp['data']
+            if not data:
+                return
+            yield data
+            offset += len(data)
+            if len(data) < page_size or offset >= resp.get('total', offset + 1):
+                return
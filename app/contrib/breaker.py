@@ -0,0 +1,125 @@
+"""
+Failure handling helpers
+
+- CircuitBreaker: stop calling a service that keeps failing, try again later
+- RetryBudget: bound the retries to a ratio of the calls, so a failing service
+  does not get a multiple of the load when every caller retries
+"""
+
+import time
+import logging
+import threading
+
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker:
+    '''A circuit breaker: after `failure_threshold` consecutive failures it opens and
+    the calls are rejected (allow() is False) during `reset_timeout` seconds. Then it
+    is half-open: a single trial call is allowed, it closes if the call succeeds and
+    opens again if it fails
+    The listeners are called on every change: listener(<name>, <old state>, <new state>)'''
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30, timer=time.monotonic):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.timer = timer
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.listeners = []
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def _set_state(self, state):
+        old, self.state = self.state, state
+        if old == state:
+            return
+        if state == OPEN:
+            logger.warning('Circuit %s open after %d failures, retrying in %ss',
+                           self.name, self.failures, self.reset_timeout)
+        else:
+            logger.warning('Circuit %s %s', self.name, state.replace('_', '-'))
+        for listener in self.listeners:
+            try:
+                listener(self.name, old, state)
+            except Exception:  # pylint: disable=broad-except
+                logger.exception('Circuit breaker listener failed')
+
+    def allow(self):
+        '''Return whether a call can be done now (a trial call when half-open)'''
+        with self._lock:
+            if self.state == OPEN:
+                if self.timer() - self.opened_at < self.reset_timeout:
+                    return False
+                self._set_state(HALF_OPEN)
+            if self.state == HALF_OPEN:
+                if self._trial:
+                    return False
+                self._trial = True
+            return True
+
+    def retry_after(self):
+        '''Seconds until a call is allowed again (0 if it is allowed)'''
+        with self._lock:
+            if self.state != OPEN:
+                return 0
+            return max(0, self.reset_timeout - (self.timer() - self.opened_at))
+
+    def record_success(self):
+        '''A call succeeded'''
+        with self._lock:
+            self.failures = 0
+            self._trial = False
+            self._set_state(CLOSED)
+
+    def record_failure(self):
+        '''A call failed'''
+        with self._lock:
+            self.failures += 1
+            self._trial = False
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                self.opened_at = self.timer()
+                self._set_state(OPEN)
+
+
+class RetryBudget:
+    '''Retries allowed as a ratio of the calls: every call deposits `ratio` (up to
+    `burst`), a retry withdraws 1. Besides, `min_per_second` retries are always
+    allowed, so the calls of a quiet process can be retried too'''
+
+    def __init__(self, ratio=0.1, min_per_second=1, burst=10, timer=time.monotonic):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.burst = burst
+        self.timer = timer
+        self.balance = 0.0
+        self.reserve = float(min_per_second)
+        self.reserve_at = timer()
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        '''A call was done'''
+        with self._lock:
+            self.balance = min(self.balance + self.ratio, self.burst)
+
+    def withdraw(self):
+        '''Return whether a retry can be done (and count it)'''
+        with self._lock:
+            now = self.timer()
+            self.reserve = min(float(self.min_per_second),
+                               self.reserve + (now - self.reserve_at) * self.min_per_second)
+            self.reserve_at = now
+            if self.balance >= 1:
+                self.balance -= 1
+                return True
+            if self.reserve >= 1:
+                self.reserve -= 1
+                return True
+            return False
@@ -0,0 +1,74 @@
+"""
+In-process caches
+"""
+
+import time
+import threading
+from collections import OrderedDict
+
+
+class TTLCache:
+    '''A thread-safe LRU mapping where every entry expires after `ttl` seconds
+    When it holds more than `maxsize` entries the least recently used one is evicted'''
+
+    def __init__(self, maxsize=128, ttl=300, timer=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+
+    def get(self, key, default=None):
+        '''Return the value for `key` if it is cached and not expired'''
+        with self._lock:
+            try:
+                expires, value = self._data[key]
+            except KeyError:
+                return default
+            if expires <= self.timer():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        '''Cache `value` for `key` during `ttl` seconds (the cache TTL by default)'''
+        ttl = self.ttl if ttl is None else ttl
+        with self._lock:
+            self._data[key] = (self.timer() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        '''Remove `key` from the cache and return its value if it is not expired'''
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is None or item[0] <= self.timer():
+                return default
+        return item[1]
+
+    def invalidate(self, predicate=None):
+        '''Remove all the keys for which `predicate(key)` is True (all of them by default)'''
+        with self._lock:
+            if predicate is None:
+                self._data.clear()
+                return
+            for key in [key for key in self._data if predicate(key)]:
+                del self._data[key]
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def purge(self):
+        '''Remove the expired entries'''
+        with self._lock:
+            now = self.timer()
+            for key in [key for key, (expires, _) in self._data.items() if expires <= now]:
+                del self._data[key]
+
+    def __len__(self):
+        '''Number of entries not expired'''
+        with self._lock:
+            self.purge()
+            return len(self._data)
@@ -0,0 +1,69 @@
+"""
+Compact latency histogram
+
+The latencies (milliseconds) are counted in fixed buckets, so a histogram is a
+short list of integers whatever the number of samples, and it is stored as a
+comma separated string
+"""
+
+import bisect
+
+
+# Upper bounds (ms) of the buckets, the last bucket counts everything above
+DEFAULT_BUCKETS = (50, 100, 200, 350, 500, 750, 1000, 1500, 2000, 3000, 5000, 10000)
+
+
+class LatencyHistogram:
+    '''Latency counts in fixed buckets'''
+
+    def __init__(self, counts=None, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = list(counts) if counts else [0] * (len(buckets) + 1)
+        if len(self.counts) != len(buckets) + 1:
+            raise ValueError('Expected {} counts, got {}'.format(
+                len(buckets) + 1, len(self.counts)))
+
+    @classmethod
+    def loads(cls, value, buckets=DEFAULT_BUCKETS):
+        '''Return a histogram from its string representation (see dumps)'''
+        if not value:
+            return cls(buckets=buckets)
+        return cls([int(count) for count in value.split(',')], buckets=buckets)
+
+    def dumps(self):
+        '''Return the histogram as a comma separated string of counts'''
+        return ','.join(str(count) for count in self.counts)
+
+    def record(self, latency):
+        '''Count a latency (ms)'''
+        self.counts[bisect.bisect_left(self.buckets, latency)] += 1
+
+    def merge(self, other):
+        '''Add the counts of another histogram (with the same buckets)'''
+        for pos, count in enumerate(other.counts):
+            self.counts[pos] += count
+
+    @property
+    def total(self):
+        '''Number of latencies counted'''
+        return sum(self.counts)
+
+    def percentile(self, percent):
+        '''Return the upper bound (ms) of the bucket of the given percentile
+        None if there are no samples, inf if it is above the last bucket'''
+        total = self.total
+        if not total:
+            return None
+        threshold = total * percent / 100
+        seen = 0
+        for pos, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= threshold:
+                return self.buckets[pos] if pos < len(self.buckets) else float('inf')
+        return float('inf')
+
+    def rows(self):
+        '''Return the histogram as a list of (<label>, <count>) tuples'''
+        labels = ['<= {} ms'.format(bound) for bound in self.buckets]
+        labels.append('> {} ms'.format(self.buckets[-1]))
+        return list(zip(labels, self.counts))
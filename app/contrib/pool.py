@@ -0,0 +1,105 @@
+"""
+Bounded concurrency helpers
+
+When the process is monkey-patched by gevent (gunicorn gevent workers) the calls
+run in a gevent pool, otherwise (debug server, scripts) a thread pool is used
+
+The calls run in a copy of the caller's context (contextvars), so the Flask
+app context (current_app, g) is available in them
+"""
+
+import os
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor
+
+
+DEFAULT_CONCURRENCY = 10
+
+
+def gevent_patched():
+    '''Return True if the sockets have been monkey-patched by gevent'''
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched('socket')
+
+
+def map_bounded(func, items, concurrency=DEFAULT_CONCURRENCY, return_exceptions=False):
+    '''Call `func` for every item running at most `concurrency` calls at once
+    Return the list of results in the same order as `items`
+    If `return_exceptions` is True an exception raised by a call is returned in its place
+    instead of being propagated'''
+    items = list(items)
+    if not items:
+        return []
+    context = contextvars.copy_context()
+
+    def call(item):
+        try:
+            return context.copy().run(func, item)
+        except Exception as exc:  # pylint: disable=broad-except
+            if not return_exceptions:
+                raise
+            return exc
+
+    size = max(1, min(concurrency, len(items)))
+    if size == 1:
+        return [call(item) for item in items]
+    if gevent_patched():
+        from gevent.pool import Pool
+        return Pool(size).map(call, items)
+    with ThreadPoolExecutor(max_workers=size) as executor:
+        return list(executor.map(call, items))
+
+
+def fan_out(*calls, concurrency=DEFAULT_CONCURRENCY):
+    '''Run independent calls (callables without arguments) concurrently, at most
+    `concurrency` of them at once, and return their results in the same order
+    The first exception raised by a call is propagated'''
+    return map_bounded(lambda call: call(), calls, concurrency=concurrency)
+
+
+def run_blocking(func, *args):
+    '''Call `func(*args)` that blocks in C code (a database driver), so it does not
+    yield to the other greenlets: in the gevent threadpool when the process is
+    monkey-patched, directly otherwise. Return its result'''
+    if gevent_patched():
+        import gevent
+        return gevent.get_hub().threadpool.apply(func, args)
+    return func(*args)
+
+
+def spawn(func, *args, **kwargs):
+    '''Start `func(*args, **kwargs)` in the background (greenlet or thread)
+    Return a callable that waits for it and returns its result (or raises its exception)'''
+    run = contextvars.copy_context().run
+    if gevent_patched():
+        import gevent
+        return gevent.spawn(run, func, *args, **kwargs).get
+    executor = ThreadPoolExecutor(max_workers=1)
+    future = executor.submit(run, func, *args, **kwargs)
+    executor.shutdown(wait=False)
+    return future.result
+
+
+_process_pool = None
+_process_pool_pid = None
+
+
+def get_process_pool(max_workers, broken=None):
+    '''Return the process pool of this process, for the CPU-bound calls that hold
+    the GIL (waiting for them does not block the other threads/greenlets)
+    It is created lazily and again after a fork, so every worker gets its own
+    @param broken: a pool that raised BrokenProcessPool (a process of it died), a
+    new one is created if it is still the pool of this process'''
+    global _process_pool, _process_pool_pid
+    pid = os.getpid()
+    if broken is not None and _process_pool is broken:
+        broken.shutdown(wait=False)
+        _process_pool = None
+    if _process_pool is None or _process_pool_pid != pid:
+        _process_pool = ProcessPoolExecutor(max_workers=max_workers)
+        _process_pool_pid = pid
+    return _process_pool
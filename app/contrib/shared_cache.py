@@ -0,0 +1,203 @@
+"""
+Host-local cache shared by processes
+
+A SQLite database in WAL mode: the readers do not block the writer (nor each
+other), so every worker of the host reads and writes the same entries without an
+external cache service
+
+The database holds API responses: it is only readable by the user running the app
+(its directory is created private, the file must be owned by that user). The
+SQLite calls run in the gevent threadpool under gevent (see run_blocking): waiting
+for a lock of the database does not block the other greenlets
+"""
+
+import os
+import stat
+import time
+import sqlite3
+import logging
+import threading
+
+from app.contrib.pool import run_blocking
+
+
+logger = logging.getLogger(__name__)
+
+
+# Bumped when the tables change: the old ones are dropped (it is just a cache)
+SCHEMA_VERSION = 2
+SCHEMA = (
+    '''CREATE TABLE IF NOT EXISTS entries (
+        key TEXT PRIMARY KEY,
+        tag TEXT,
+        stored REAL NOT NULL,
+        expires REAL NOT NULL,
+        value BLOB NOT NULL)''',
+    'CREATE INDEX IF NOT EXISTS entries_tag ON entries (tag)',
+    'CREATE INDEX IF NOT EXISTS entries_expires ON entries (expires)',
+    '''CREATE TABLE IF NOT EXISTS generations (
+        tag TEXT PRIMARY KEY,
+        generation INTEGER NOT NULL)''',
+)
+
+
+class SharedCache:
+    '''A TTL cache of bytes shared by the processes of a host
+    Every entry can have a tag, invalidating a tag removes its entries and bumps its
+    generation so a value read before the invalidation is not stored after it (see set)
+    When it holds more than `maxsize` entries the ones closest to expire are evicted
+    The expired entries are kept `max_stale` more seconds for get_entry
+    The errors of the database are logged and handled as misses'''
+
+    def __init__(self, path, maxsize=1000, ttl=60, max_stale=0, busy_timeout=1.0,
+                 timer=time.time):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.busy_timeout = busy_timeout
+        self.timer = timer
+        self._conn = None
+        self._conn_pid = None
+        self._lock = threading.Lock()
+
+    def _secure_path(self):
+        '''Create the directory (private) and the file (only readable by this user) of
+        the database, raise PermissionError if another user could read or replace it'''
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        dir_stat = os.stat(directory)
+        if dir_stat.st_uid not in (os.getuid(), 0) or (
+                dir_stat.st_mode & stat.S_IWOTH and not dir_stat.st_mode & stat.S_ISVTX):
+            raise PermissionError('Unsafe shared cache directory: {}'.format(directory))
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_NOFOLLOW', 0), 0o600)
+        try:
+            file_stat = os.fstat(fd)
+            if file_stat.st_uid != os.getuid():
+                raise PermissionError('Shared cache owned by another user: {}'.format(self.path))
+            if file_stat.st_mode & 0o077:
+                os.fchmod(fd, 0o600)
+        finally:
+            os.close(fd)
+
+    def _connect(self):
+        '''Return the connection of this process (a new one after a fork)'''
+        pid = os.getpid()
+        if self._conn is None or self._conn_pid != pid:
+            self._secure_path()
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.execute('BEGIN IMMEDIATE')
+            if conn.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+                conn.execute('DROP TABLE IF EXISTS entries')
+                conn.execute('DROP TABLE IF EXISTS generations')
+                conn.execute('PRAGMA user_version={}'.format(SCHEMA_VERSION))
+            for statement in SCHEMA:
+                conn.execute(statement)
+            conn.execute('COMMIT')
+            self._conn = conn
+            self._conn_pid = pid
+        return self._conn
+
+    def _execute(self, func, default=None):
+        '''Run func(<connection>), return `default` if the database fails'''
+        with self._lock:
+            try:
+                return run_blocking(lambda: func(self._connect()))
+            except (sqlite3.Error, OSError) as exc:
+                logger.warning('Shared cache %s failed: %s', self.path, exc)
+                return default
+
+    def get(self, key):
+        '''Return the value for `key` if it is cached and not expired'''
+        row = self._execute(lambda conn: conn.execute(
+            'SELECT value FROM entries WHERE key = ? AND expires > ?',
+            (key, self.timer())).fetchone())
+        return None if row is None else bytes(row[0])
+
+    def get_entry(self, key):
+        '''Return a tuple (<value>, <time stored>, <expiration time>) for `key` if
+        it is cached, even if it expired less than `max_stale` seconds ago'''
+        row = self._execute(lambda conn: conn.execute(
+            'SELECT value, stored, expires FROM entries WHERE key = ? AND expires > ?',
+            (key, self.timer() - self.max_stale)).fetchone())
+        return None if row is None else (bytes(row[0]), row[1], row[2])
+
+    def set(self, key, value, tag=None, ttl=None, generation=None):
+        '''Cache `value` for `key` during `ttl` seconds (the cache TTL by default)
+        If `generation` is given the value is only stored if the tag was not
+        invalidated since that generation was read. Return whether it was stored'''
+        ttl = self.ttl if ttl is None else ttl
+
+        def store(conn):
+            now = self.timer()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                if generation is not None and self._generation(conn, tag) != generation:
+                    conn.execute('ROLLBACK')
+                    return False
+                conn.execute('INSERT OR REPLACE INTO entries (key, tag, stored, expires, value) '
+                             'VALUES (?, ?, ?, ?, ?)', (key, tag, now, now + ttl, value))
+                conn.execute('DELETE FROM entries WHERE expires <= ?', (now - self.max_stale,))
+                conn.execute('DELETE FROM entries WHERE key IN (SELECT key FROM entries '
+                             'ORDER BY expires DESC LIMIT -1 OFFSET ?)', (self.maxsize,))
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            return True
+
+        return self._execute(store, default=False)
+
+    def extend(self, key, seconds):
+        '''Keep an expired entry `seconds` more (while it is revalidated)
+        Return whether it was expired (False if another process extended it first)'''
+
+        def update(conn):
+            now = self.timer()
+            return conn.execute('UPDATE entries SET expires = ? WHERE key = ? AND expires <= ?',
+                                (now + seconds, key, now)).rowcount == 1
+
+        return self._execute(update, default=False)
+
+    @staticmethod
+    def _generation(conn, tag):
+        row = conn.execute('SELECT generation FROM generations WHERE tag = ?', (tag,)).fetchone()
+        return 0 if row is None else row[0]
+
+    def generation(self, tag):
+        '''Return the number of times `tag` was invalidated'''
+        return self._execute(lambda conn: self._generation(conn, tag), default=0)
+
+    def generations(self):
+        '''Return {<tag>: <generation>} of all the invalidated tags'''
+        return self._execute(lambda conn: dict(conn.execute(
+            'SELECT tag, generation FROM generations').fetchall()), default={})
+
+    def invalidate(self, tag):
+        '''Remove the entries of `tag` and bump its generation'''
+
+        def delete(conn):
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                conn.execute('DELETE FROM entries WHERE tag = ?', (tag,))
+                conn.execute('INSERT INTO generations (tag, generation) VALUES (?, 1) '
+                             'ON CONFLICT (tag) DO UPDATE SET generation = generation + 1',
+                             (tag,))
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+
+        self._execute(delete)
+
+    def clear(self):
+        '''Remove all the entries'''
+        self._execute(lambda conn: conn.execute('DELETE FROM entries'))
+
+    def __len__(self):
+        return self._execute(lambda conn: conn.execute(
+            'SELECT COUNT(*) FROM entries WHERE expires > ?', (self.timer(),)).fetchone()[0],
+                             default=0)
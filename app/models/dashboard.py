@@ -3,6 +3,8 @@ Dashboard Forms
 """
 
 from flask_wtf import FlaskForm
+from flask_wtf.file import FileField
+from flask_wtf.file import FileRequired
 
 from wtforms import BooleanField
 from wtforms import IntegerField
@@ -75,6 +77,21 @@ class ProviderPlanForm(FlaskForm):
         validators.DataRequired('A code is required')])
 
 
+# The proxy fields sent to the API: (<API field>, <ProxyForm field>)
+PROXY_API_FIELDS = (
+    ('url', 'url'),
+    ('active', 'active'),
+    ('proxy_type_id', 'proxy_type'),
+    ('proxy_location_id', 'proxy_location'),
+    ('provider_id', 'provider'),
+    ('provider_plan_id', 'provider_plan'),
+    ('tor_control_port', 'tor_control_port'),
+    ('tor_control_pswd', 'tor_control_pswd'),
+    ('tor_renew_identity', 'tor_renew_identity'),
+    ('dont_block', 'dont_block'),
+)
+
+
 class ProxyForm(FlaskForm):
     '''Proxy Form'''
     id = IntegerField('Proxy ID', validators=[validators.Optional()])
@@ -96,3 +113,54 @@ class ProxyForm(FlaskForm):
     dont_block = BooleanField('Do Not Block',
                               description='Never mark proxy as blocked - Do Not Sleep',
                               default=False, validators=[validators.Optional()])
+
+    def api_data(self):
+        '''Return the proxy data to send to the API'''
+        return {api_field: getattr(self, form_field).data
+                for api_field, form_field in PROXY_API_FIELDS}
+
+
+class ProxyImportRowForm(ProxyForm):
+    '''Proxy Form used to validate every row of a bulk import'''
+    active = BooleanField('Active', default=True, validators=[validators.Optional()])
+
+    class Meta:
+        '''The rows are not submitted by a browser'''
+        csrf = False
+
+
+class ProxyImportForm(FlaskForm):
+    '''Proxy Bulk Import Form'''
+    file = FileField('Proxy List', description='CSV file with header or one proxy URL per line',
+                     validators=[FileRequired('A file is required')])
+    active = BooleanField('Active', default=True, validators=[validators.Optional()])
+    proxy_type = SelectField('Default Proxy Type', coerce=int, validators=[validators.Optional()])
+    proxy_location = SelectField('Default Proxy Location', coerce=int,
+                                 validators=[validators.Optional()])
+    provider = SelectField('Default Provider', coerce=int, validators=[validators.Optional()])
+    provider_plan = SelectField('Default Provider Plan', coerce=int,
+                                validators=[validators.Optional()])
+
+
+class ProxyBulkForm(FlaskForm):
+    '''Proxy Bulk Action Form'''
+    action = SelectField('Action', validators=[validators.DataRequired()])
+    ids = SelectMultipleField('Proxies', coerce=int, validate_choice=False,
+                              validators=[validators.Optional()])
+    all_matching = BooleanField('All the matching proxies', default=False,
+                                validators=[validators.Optional()])
+    provider_plan = SelectField('Provider Plan', coerce=int, validators=[validators.Optional()])
+    proxy_location = SelectField('Proxy Location', coerce=int, validators=[validators.Optional()])
+
+    def validate(self, extra_validators=None):
+        '''The plan/location actions need the plan/location, and some proxies are needed'''
+        if not super().validate(extra_validators):
+            return False
+        if not (self.ids.data or self.all_matching.data):
+            self.ids.errors.append('Select some proxies')
+            return False
+        for action, field in (('plan', self.provider_plan), ('location', self.proxy_location)):
+            if self.action.data == action and not field.data:
+                field.errors.append('Select the new {}'.format(field.label.text.lower()))
+                return False
+        return True
@@ -0,0 +1,51 @@
+"""
+Proxy health SQLAlchemy models
+"""
+
+from app import db
+from app.contrib.histogram import LatencyHistogram
+
+
+class ProxyHealth(db.Model):
+    '''Health check results of a proxy (the proxies are stored in the API,
+    only their ID is kept here)'''
+    __tablename__ = 'proxy_health'
+
+    proxy_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    checks = db.Column(db.Integer, nullable=False, default=0)
+    successes = db.Column(db.Integer, nullable=False, default=0)
+    consecutive_failures = db.Column(db.Integer, nullable=False, default=0)
+    # Latencies of the successful checks, see LatencyHistogram.dumps
+    latency = db.Column(db.String(128), nullable=False, default='')
+    last_checked_at = db.Column(db.DateTime)
+    last_error = db.Column(db.String(255))
+
+    @property
+    def histogram(self):
+        '''The LatencyHistogram of the successful checks'''
+        return LatencyHistogram.loads(self.latency)
+
+    @property
+    def success_rate(self):
+        '''Percentage of successful checks'''
+        if not self.checks:
+            return None
+        return 100 * self.successes / self.checks
+
+    def record(self, ok, latency, error, checked_at):
+        '''Add the result of a check'''
+        self.checks = (self.checks or 0) + 1
+        if ok:
+            self.successes = (self.successes or 0) + 1
+            self.consecutive_failures = 0
+            histogram = self.histogram
+            histogram.record(latency)
+            self.latency = histogram.dumps()
+            self.last_error = None
+        else:
+            self.consecutive_failures = (self.consecutive_failures or 0) + 1
+            self.last_error = (error or '')[:255]
+        self.last_checked_at = checked_at
+
+    def __repr__(self):
+        return '<ProxyHealth {}>'.format(self.proxy_id)
@@ -8,10 +8,26 @@ from wtforms import StringField
 from wtforms import SubmitField
 from wtforms import validators
 
-from passlib.apps import custom_app_context as pwd_context
+from sqlalchemy import event
+from sqlalchemy.orm import object_session
 
 from app import db
+from app import psdash
 from app import login_manager
+from app.contrib.cache import TTLCache
+from app.utils.cache import add_invalidation_listener
+from app.utils.cache import invalidate_endpoint
+from app.utils.passwords import hash_password
+from app.utils.passwords import verify_password
+
+
+# The users loaded by load_user in this worker: {<user id (str)>: <detached User>}
+# A change committed by any worker (or process) drops them in every worker, with the
+# shared cache (see app.utils.cache), otherwise only in the worker doing it
+user_cache = TTLCache(maxsize=psdash.config['USER_CACHE_SIZE'],
+                      ttl=psdash.config['USER_CACHE_TTL'])
+# The shared cache tag invalidated when a user changes
+USERS_TAG = 'users'
 
 
 class User(db.Model):
@@ -26,11 +42,12 @@ class User(db.Model):
 
     def verify_password(self, pswd):
         '''Verify if the password `pwd` is valid'''
-        return pwd_context.verify(pswd, self.password)
+        return verify_password(pswd, self.password)
 
     def set_password(self, pswd):
         '''Set a new password for the current user'''
-        self.password = pwd_context.encrypt(pswd)
+        self.password = hash_password(pswd)
+        user_cache.pop(self.get_id())
 
     @classmethod
     def login(cls, form):
@@ -71,7 +88,48 @@ class LoginForm(FlaskForm):
     submit = SubmitField('Save')
 
 
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def on_user_changed(mapper, connection, user):
+    '''Drop a changed/deleted user from the cache, the other workers drop it once
+    the change is committed'''
+    user_cache.pop(user.get_id())
+    session = object_session(user)
+    if session is not None:
+        session.info['users_changed'] = True
+
+
+@event.listens_for(db.session, 'after_commit')
+def on_commit(session):
+    '''A user changed: drop the users cached by every worker'''
+    if session.info.pop('users_changed', False):
+        invalidate_endpoint(USERS_TAG)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def on_rollback(session):
+    '''The changes of the users were not saved'''
+    session.info.pop('users_changed', None)
+
+
+def on_cache_invalidated(tag):
+    '''Drop the cached users when another worker changed one'''
+    if tag == USERS_TAG:
+        user_cache.invalidate()
+
+
+add_invalidation_listener(on_cache_invalidated)
+
+
 @login_manager.user_loader
 def load_user(user_id):
-    '''The load_user method for flask_login'''
-    return User.query.get(user_id)
+    '''The load_user method for flask_login
+    The users are kept in the cache, detached from the DB session, so the
+    authenticated requests do not query the DB'''
+    user = user_cache.get(user_id)
+    if user is None:
+        user = db.session.get(User, user_id)
+        if user is not None:
+            db.session.expunge(user)
+            user_cache.set(user_id, user)
+    return user
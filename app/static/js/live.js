@@ -0,0 +1,67 @@
+/*
+ * Live updates of a list (see app/utils/live.py)
+ * The rows of the table with data-live-url are patched in place with the
+ * changes streamed by the server, the added elements are announced
+ */
+(function () {
+  var table = document.querySelector('table[data-live-url]');
+  if (!table || !window.EventSource) {
+    return;
+  }
+  var notice = document.getElementById('live-notice');
+  var name = table.getAttribute('data-live-name');
+  var added = 0;
+
+  function showNotice(text) {
+    notice.querySelector('span').textContent = text;
+    notice.style.display = '';
+  }
+
+  function patchCell(cell, field, value) {
+    if (field === 'active') {
+      cell.textContent = value ? 'Yes' : 'No';
+      cell.style.color = value ? 'green' : 'red';
+    } else {
+      cell.textContent = value === null ? '' : value;
+    }
+  }
+
+  function findRow(id) {
+    return table.querySelector('tr[data-id="' + id + '"]');
+  }
+
+  var source = new EventSource(table.getAttribute('data-live-url'));
+
+  source.addEventListener('delta', function (event) {
+    var delta = JSON.parse(event.data);
+    delta.changed.forEach(function (element) {
+      var row = findRow(element.id);
+      if (!row) {
+        return;
+      }
+      Object.keys(element).forEach(function (field) {
+        var cell = row.querySelector('[data-field="' + field + '"]');
+        if (cell) {
+          patchCell(cell, field, element[field]);
+        }
+      });
+      row.classList.add('table-info');
+    });
+    delta.removed.forEach(function (id) {
+      var row = findRow(id);
+      if (row) {
+        row.classList.add('text-muted');
+        row.style.textDecoration = 'line-through';
+      }
+    });
+    if (delta.added.length) {
+      added += delta.added.length;
+      showNotice(added + ' ' + name + ' added.');
+    }
+  });
+
+  source.addEventListener('reload', function () {
+    source.close();
+    showNotice('The list changed too much to be updated.');
+  });
+})();
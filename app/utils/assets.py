@@ -0,0 +1,147 @@
+"""
+Static assets pipeline
+
+`python run.py --build-assets` writes to `static/dist/`:
+- Every static file with a content hash in its name (`bootstrap.min.<hash>.css`),
+  our own CSS is minified (the vendor files are already the .min builds)
+- Precompressed .gz (and .br if brotli is installed) variants of the text files
+- A manifest.json {<original name>: <fingerprinted name>}
+
+When the manifest exists `url_for('static', filename=...)` resolves to the
+fingerprinted names, which are served with an immutable Cache-Control and the
+best precompressed variant the browser accepts
+"""
+
+import os
+import re
+import gzip
+import json
+import shutil
+import hashlib
+import mimetypes
+
+from flask import request
+from flask import send_from_directory
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+DIST_FOLDER = 'dist'
+MANIFEST_FILENAME = 'manifest.json'
+# Files worth compressing
+COMPRESS_EXTENSIONS = ('.css', '.js', '.map', '.svg', '.json', '.txt', '.html')
+# Source maps keep their names, the minified files point to them
+KEEP_NAME_EXTENSIONS = ('.map',)
+# Variants by preference: (<encoding>, <extension>)
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+CSS_COMMENT_RE = re.compile(r'/\*(?!!).*?\*/', re.S)
+CSS_SPACES_RE = re.compile(r'\s+')
+CSS_PUNCTUATION_RE = re.compile(r'\s*([{};,])\s*')
+
+
+def minify_css(css):
+    '''Conservative CSS minification: drop the comments (but the /*! licenses)
+    and the whitespace'''
+    css = CSS_COMMENT_RE.sub('', css)
+    css = CSS_SPACES_RE.sub(' ', css)
+    css = CSS_PUNCTUATION_RE.sub(r'\1', css)
+    return css.replace(';}', '}').strip()
+
+
+def fingerprint(name, content):
+    '''Return the name with the hash of the content before the extension'''
+    base, ext = os.path.splitext(name)
+    return '{}.{}{}'.format(base, hashlib.sha256(content).hexdigest()[:12], ext)
+
+
+def write_compressed(path, content):
+    '''Write the precompressed variants of a file, only if they are smaller'''
+    variants = [('.gz', gzip.compress(content, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        variants.append(('.br', brotli.compress(content)))
+    for ext, compressed in variants:
+        if len(compressed) < len(content):
+            with open(path + ext, 'wb') as c_f:
+                c_f.write(compressed)
+
+
+def build_assets(static_folder):
+    '''Build the fingerprinted and precompressed assets and the manifest
+    Return the manifest'''
+    dist = os.path.join(static_folder, DIST_FOLDER)
+    shutil.rmtree(dist, ignore_errors=True)
+    manifest = {}
+    for root, dirs, files in os.walk(static_folder):
+        if root == static_folder and DIST_FOLDER in dirs:
+            dirs.remove(DIST_FOLDER)
+        for filename in files:
+            name = os.path.relpath(os.path.join(root, filename), static_folder)
+            name = name.replace(os.sep, '/')
+            with open(os.path.join(root, filename), 'rb') as s_f:
+                content = s_f.read()
+            if name.endswith('.css') and not name.endswith('.min.css'):
+                content = minify_css(content.decode('utf-8')).encode('utf-8')
+            if name.endswith(KEEP_NAME_EXTENSIONS):
+                built_name = name
+            else:
+                built_name = fingerprint(name, content)
+                manifest[name] = '{}/{}'.format(DIST_FOLDER, built_name)
+            path = os.path.join(dist, built_name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as d_f:
+                d_f.write(content)
+            if name.endswith(COMPRESS_EXTENSIONS):
+                write_compressed(path, content)
+    with open(os.path.join(dist, MANIFEST_FILENAME), 'w') as m_f:
+        json.dump(manifest, m_f, indent=1, sort_keys=True)
+    return manifest
+
+
+def load_manifest(static_folder):
+    '''Return the manifest of the built assets, an empty dict if they are not built'''
+    path = os.path.join(static_folder, DIST_FOLDER, MANIFEST_FILENAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as m_f:
+        return json.load(m_f)
+
+
+def init_assets(app):
+    '''Serve the built assets (if any): url_for('static') returns the fingerprinted
+    names, served with an immutable Cache-Control and precompressed if accepted'''
+    manifest = load_manifest(app.static_folder)
+    if not manifest:
+        return
+    fingerprinted = set(manifest.values())
+    default_static = app.view_functions['static']
+
+    def static_url_defaults(endpoint, values):
+        if endpoint == 'static' and values.get('filename') in manifest:
+            values['filename'] = manifest[values['filename']]
+
+    def serve_static(filename):
+        if filename not in fingerprinted:
+            return default_static(filename=filename)
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        served, encoding = filename, None
+        for name, ext in ENCODINGS:
+            if request.accept_encodings[name] and os.path.exists(
+                    os.path.join(app.static_folder, filename + ext)):
+                served, encoding = filename + ext, name
+                break
+        response = send_from_directory(app.static_folder, served, mimetype=mimetype,
+                                       max_age=IMMUTABLE_MAX_AGE)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
+
+    app.url_defaults(static_url_defaults)
+    app.view_functions['static'] = serve_static
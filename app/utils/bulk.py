@@ -0,0 +1,137 @@
+"""
+Bulk actions on proxies
+
+An action (activate, deactivate, set/unset "Do Not Block", move to a plan or a
+location, delete) is applied to many proxies with concurrent PUT/DELETE requests
+(BULK_CONCURRENCY config). The failed requests are retried by the API client,
+within its retry budget (see app.contrib.api.configure_retries).
+A report line is generated for every proxy
+"""
+
+import logging
+
+from app.contrib.pool import map_bounded
+from app.models.dashboard import PROXY_API_FIELDS
+from app.utils.cache import get_reference_data
+from app.utils.cache import invalidate_endpoint
+from app.utils.signals import proxy_saved
+from app.utils.signals import proxy_deleted
+
+
+logger = logging.getLogger(__name__)
+
+# (<action>, <label>)
+BULK_ACTIONS = (
+    ('activate', 'Activate'),
+    ('deactivate', 'Deactivate'),
+    ('dont_block', 'Set "Do Not Block"'),
+    ('block', 'Unset "Do Not Block"'),
+    ('plan', 'Move to the plan'),
+    ('location', 'Move to the location'),
+    ('delete', 'Delete'),
+)
+# Fields set by the actions that do not need a value
+ACTION_CHANGES = {
+    'activate': {'active': True},
+    'deactivate': {'active': False},
+    'dont_block': {'dont_block': True},
+    'block': {'dont_block': False},
+}
+
+
+class BulkProxyAction:
+    '''Apply an action to many proxies
+    @param api: an API instance
+    @param action: one of BULK_ACTIONS
+    @param value: the plan or location ID of the plan/location actions'''
+
+    def __init__(self, api, action, value=None, batch_size=100, concurrency=20):
+        if action not in dict(BULK_ACTIONS):
+            raise ValueError('Unknown bulk action: {}'.format(action))
+        self.api = api
+        self.action = action
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.changes = self.get_changes(action, value)
+        self.done = 0
+        self.unchanged = 0
+        self.errors = 0
+
+    @staticmethod
+    def get_changes(action, value):
+        '''Return the proxy fields changed by an action (None for delete)'''
+        if action == 'delete':
+            return None
+        if action == 'plan':
+            plan = get_reference_data('provider_plan').get(value)
+            if plan is None:
+                raise ValueError('Unknown provider plan: {}'.format(value))
+            return {'provider_plan_id': plan['id'], 'provider_id': plan['provider_id']}
+        if action == 'location':
+            if value not in get_reference_data('proxy_location'):
+                raise ValueError('Unknown proxy location: {}'.format(value))
+            return {'proxy_location_id': value}
+        return ACTION_CHANGES[action]
+
+    def apply(self, proxy):
+        '''Apply the action to a proxy (a dict or an ID)
+        Return a tuple (<proxy ID>, <result>, <error or the saved proxy data>)'''
+        proxy_id = proxy['id'] if isinstance(proxy, dict) else proxy
+        try:
+            if self.changes is None:
+                resp = self.api.delete('proxy', proxy_id)
+                if resp.get('status') == 'error':
+                    return proxy_id, 'failed', resp.get('message', resp)
+                return proxy_id, 'deleted', None
+            if not isinstance(proxy, dict):
+                proxy = self.api.get('proxy', elem_id=proxy_id, refresh=True).get('data')
+                if not proxy:
+                    return proxy_id, 'failed', 'not found'
+            if all(proxy.get(field) == value for field, value in self.changes.items()):
+                return proxy_id, 'unchanged', None
+            # The fields the Proxy Form sends, with the changes of the action
+            proxy_data = {field: proxy.get(field) for field, _ in PROXY_API_FIELDS}
+            proxy_data.update(self.changes)
+            resp = self.api.put('proxy', proxy_id, **proxy_data)
+            if resp.get('status') == 'error':
+                return proxy_id, 'failed', resp.get('message', resp)
+            return proxy_id, 'updated', proxy_data
+        except Exception as exc:  # pylint: disable=broad-except
+            return proxy_id, 'failed', '{}: {}'.format(exc.__class__.__name__, exc)
+
+    def run_batch(self, batch):
+        '''Apply the action to a batch of proxies, generating a report line for each
+        The signals are sent from here: their receivers are not thread-safe'''
+        results = map_bounded(self.apply, batch, concurrency=self.concurrency)
+        for proxy_id, result, extra in results:
+            if result == 'failed':
+                self.errors += 1
+                yield 'proxy {}: failed: {}'.format(proxy_id, extra)
+                continue
+            if result == 'unchanged':
+                self.unchanged += 1
+            else:
+                self.done += 1
+            if result == 'updated':
+                proxy_saved.send(self, proxy=dict(extra, id=proxy_id))
+            elif result == 'deleted':
+                proxy_deleted.send(self, proxy_id=proxy_id)
+            yield 'proxy {}: {}'.format(proxy_id, result)
+
+    def progress(self):
+        '''A report line with the current counters'''
+        return '{} done, {} unchanged, {} errors'.format(self.done, self.unchanged, self.errors)
+
+    def run(self, proxies):
+        '''Apply the action to the proxies (dicts or IDs), generating the report lines'''
+        proxies = list(proxies)
+        yield '{}: {} proxies'.format(dict(BULK_ACTIONS)[self.action], len(proxies))
+        try:
+            for start in range(0, len(proxies), self.batch_size):
+                yield from self.run_batch(proxies[start:start + self.batch_size])
+                logger.info('Bulk %s: %s', self.action, self.progress())
+                yield self.progress()
+        finally:
+            invalidate_endpoint('proxy')
+        logger.info('Bulk %s finished: %s', self.action, self.progress())
+        yield 'Done: ' + self.progress()
@@ -0,0 +1,192 @@
+"""
+Caches for the data read from the Proxy Service API
+
+- Reference data: the full lists of providers, plans, types and locations
+- List pages: the next page of a list is requested in the background and kept
+  until it is used, with the last total of every list and the keyset cursors
+- Shared: the API GET responses, in a SQLite database shared by all the workers
+  of the host (SHARED_CACHE config). A write from any worker invalidates the
+  endpoint for all of them, and the caches above of every worker are dropped
+  for that endpoint before its next request (see init_shared_cache). The expired
+  list pages and reference lists are served while they are requested again in the
+  background (see app.utils.refresher), the age of the data of a page is shown in it
+"""
+
+import threading
+from collections import Counter
+
+from flask import g
+from flask import has_app_context
+
+from app import psdash
+from app.contrib.api import API
+from app.contrib.api import add_cache_hit_listener
+from app.contrib.api import configure_cache
+from app.contrib.cache import TTLCache
+from app.contrib.pool import spawn
+from app.contrib.shared_cache import SharedCache
+
+
+REFERENCE_ENDPOINTS = ('provider', 'provider_plan', 'proxy_type', 'proxy_location')
+
+reference_cache = TTLCache(maxsize=psdash.config['REFERENCE_CACHE_SIZE'],
+                           ttl=psdash.config['REFERENCE_CACHE_TTL'])
+
+# (<endpoint>, <query>, <page>, <limit>): (<results>, <total>)
+page_cache = TTLCache(maxsize=psdash.config['PAGE_CACHE_SIZE'],
+                      ttl=psdash.config['PAGE_CACHE_TTL'])
+# (<endpoint>, <query>): <total>
+total_cache = TTLCache(maxsize=psdash.config['PAGE_CACHE_SIZE'],
+                       ttl=psdash.config['PAGE_CACHE_TTL'])
+# (<endpoint>, <query>, <page>, <limit>): <last ID of the previous page>
+cursor_cache = TTLCache(maxsize=psdash.config['PAGE_CACHE_SIZE'] * 10,
+                        ttl=psdash.config['PAGE_CACHE_TTL'] * 10)
+
+shared_cache = None
+if psdash.config['SHARED_CACHE']:
+    shared_cache = SharedCache(psdash.config['SHARED_CACHE_PATH'],
+                               maxsize=psdash.config['SHARED_CACHE_SIZE'],
+                               ttl=psdash.config['SHARED_CACHE_TTL'],
+                               max_stale=psdash.config['SHARED_CACHE_MAX_STALE'])
+
+# The shared cache generations of the endpoints seen by this worker
+_generations = {}
+
+# Called with the endpoint (or tag) dropped by invalidate_local, for the caches of
+# other modules (see add_invalidation_listener)
+_invalidation_listeners = []
+
+# The invalidations of every endpoint in this worker (see invalidate_local)
+_local_generations = Counter()
+# The keys of the pages being prefetched
+_prefetching = set()
+_prefetching_lock = threading.Lock()
+
+
+def get_reference_data(endpoint):
+    '''Return all the elements of a reference endpoint as a dict {<id>: <element>, ...}
+    The list is requested to the API only when it is not cached'''
+    elements = reference_cache.get(endpoint)
+    if elements is None:
+        api = API(psdash.config['api_url'], psdash.config['api_key'])
+        resp = api.get(endpoint, stale=True)
+        elements = {element['id']: element for element in resp['data']}
+        reference_cache.set(endpoint, elements)
+    return elements
+
+
+def request_list_page(endpoint, page, limit, query):
+    '''Request a page of a list to the API
+    If the endpoint supports keyset pagination (KEYSET_ENDPOINTS config) and the last
+    ID of the previous page is known it is used instead of the offset
+    Return a tuple (<results>, <total>)'''
+    api = API(psdash.config['api_url'], psdash.config['api_key'])
+    query_key = tuple(sorted(query.items()))
+    params = dict(query, limit=limit)
+    keyset = endpoint in psdash.config['KEYSET_ENDPOINTS']
+    cursor = cursor_cache.get((endpoint, query_key, page, limit)) if keyset else None
+    if cursor is not None:
+        params[psdash.config['KEYSET_PARAM']] = cursor
+    else:
+        params['offset'] = (page - 1) * limit
+    resp = api.get(endpoint, stale=True, **params)
+    results, total = resp['data'], resp['total']
+    total_cache.set((endpoint, query_key), total)
+    if keyset and results:
+        cursor_cache.set((endpoint, query_key, page + 1, limit), results[-1]['id'])
+    return results, total
+
+
+def prefetch_list_page(endpoint, page, limit, query):
+    '''Request a page of a list in the background and keep it in the page cache
+    The page is not kept if the endpoint was invalidated meanwhile (a write), and a
+    page already being prefetched is not requested again'''
+    key = (endpoint, tuple(sorted(query.items())), page, limit)
+    with _prefetching_lock:
+        if key in _prefetching or key in page_cache:
+            return
+        _prefetching.add(key)
+    generation = _local_generations[endpoint]
+
+    def prefetch():
+        try:
+            result = request_list_page(endpoint, page, limit, query)
+            with _prefetching_lock:
+                if _local_generations[endpoint] == generation:
+                    page_cache.set(key, result)
+        finally:
+            with _prefetching_lock:
+                _prefetching.discard(key)
+
+    spawn(prefetch)
+
+
+def get_list_page(endpoint, page, limit, **query):
+    '''Return a page of a list as a tuple (<results>, <total>)
+    A prefetched page is used (only once) if there is one, with the last known total'''
+    query_key = tuple(sorted(query.items()))
+    cached = page_cache.pop((endpoint, query_key, page, limit))
+    if cached is not None:
+        results, total = cached
+        return results, total_cache.get((endpoint, query_key), total)
+    return request_list_page(endpoint, page, limit, query)
+
+
+def invalidate_local(endpoint):
+    '''Drop the data of an endpoint cached by this worker'''
+    with _prefetching_lock:
+        _local_generations[endpoint] += 1
+        page_cache.invalidate(lambda key: key[0] == endpoint)
+    reference_cache.pop(endpoint)
+    total_cache.invalidate(lambda key: key[0] == endpoint)
+    for listener in _invalidation_listeners:
+        listener(endpoint)
+
+
+def add_invalidation_listener(listener):
+    '''Call listener(<endpoint or tag>) when it is invalidated, by this worker or by
+    another one (a module keeping its own cache of data that is not from the API)'''
+    _invalidation_listeners.append(listener)
+
+
+def invalidate_endpoint(endpoint):
+    '''Drop the cached data of an endpoint, in every worker. Call it after writing
+    to that endpoint'''
+    invalidate_local(endpoint)
+    if shared_cache is not None:
+        shared_cache.invalidate(endpoint)
+
+
+def sync_shared_generations():
+    '''before_request: drop the data cached by this worker for the endpoints written
+    by another worker (or process) since the last request'''
+    for endpoint, generation in shared_cache.generations().items():
+        if _generations.get(endpoint, 0) != generation:
+            invalidate_local(endpoint)
+            _generations[endpoint] = generation
+
+
+def on_cache_hit(endpoint, age):
+    '''API cache hit listener: keep the age of the oldest data of the request'''
+    if has_app_context():
+        g.data_age = max(g.get('data_age', 0), age)
+
+
+def data_age_context():
+    '''Context processor: `data_age`, the seconds since the oldest data of the page
+    was read from the API, if it is older than the shared cache TTL (it is stale)'''
+    age = g.get('data_age', 0)
+    return {'data_age': int(age) if age > psdash.config['SHARED_CACHE_TTL'] else None}
+
+
+def init_shared_cache(app):
+    '''Cache the API GET responses in the shared cache and keep the caches of this
+    worker in sync with the writes of the others'''
+    if shared_cache is None:
+        return
+    configure_cache(shared_cache)
+    # Nothing is cached by this worker yet
+    _generations.update(shared_cache.generations())
+    app.before_request(sync_shared_generations)
+    add_cache_hit_listener(on_cache_hit)
+    app.context_processor(data_age_context)
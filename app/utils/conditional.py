@@ -0,0 +1,139 @@
+"""
+Conditional GET and compression of the dashboard pages
+
+- render_conditional: the ETag of a page is computed from the data it renders
+  (before rendering it), a request with a matching If-None-Match gets a
+  304 Not Modified without rendering the template
+- init_compression: the HTML responses are gzipped when the browser accepts it
+"""
+
+import gzip
+import json
+import time
+import hashlib
+import datetime
+
+from flask import request
+from flask import session
+from flask import make_response
+from flask import render_template
+from flask_login import current_user
+from flask_wtf import FlaskForm
+from flask_wtf.csrf import generate_csrf
+
+from app import psdash
+from app.contrib.histogram import LatencyHistogram
+
+
+GZIP_SUFFIX = '-gzip'
+
+_templates_version = None
+
+
+def get_templates_version():
+    '''Hash of the sources of all the templates, so a deploy changing a template
+    changes the ETags of the pages'''
+    global _templates_version
+    if _templates_version is None:
+        digest = hashlib.sha256()
+        env = psdash.jinja_env
+        for name in sorted(env.list_templates()):
+            digest.update(name.encode('utf-8'))
+            digest.update(env.loader.get_source(env, name)[0].encode('utf-8'))
+        _templates_version = digest.hexdigest()
+    return _templates_version
+
+
+def etag_default(obj):
+    '''JSON serialization of the non JSON values in the context of a page'''
+    if isinstance(obj, FlaskForm):
+        return {field.name: (field.data, getattr(field, 'choices', None))
+                for field in obj if field.name != 'csrf_token'}
+    if isinstance(obj, (set, frozenset)):
+        return sorted(obj, key=repr)
+    if isinstance(obj, (datetime.datetime, datetime.date)):
+        return obj.isoformat()
+    if isinstance(obj, LatencyHistogram):
+        return obj.dumps()
+    if hasattr(obj, '__table__'):
+        # SQLAlchemy model
+        return {column.name: getattr(obj, column.name) for column in obj.__table__.columns}
+    # Not stable: the ETag will not match, the page is rendered
+    return repr(obj)
+
+
+def get_csrf_secret_hash():
+    '''Hash of the CSRF secret of the session (created if it has none yet, like
+    rendering a form does)'''
+    generate_csrf()
+    field_name = psdash.config.get('WTF_CSRF_FIELD_NAME', 'csrf_token')
+    secret = session.get(field_name) or ''
+    return hashlib.sha256(secret.encode('utf-8')).hexdigest()
+
+
+def compute_etag(template_name, context):
+    '''Return the ETag of a page from its template, its data and the user'''
+    parts = {
+        'templates': get_templates_version(),
+        'template': template_name,
+        'user': current_user.get_id() if current_user else None,
+        'context': context,
+    }
+    if any(isinstance(value, FlaskForm) for value in context.values()):
+        # The CSRF token of a cached form must be valid for the current session
+        parts['csrf_secret'] = get_csrf_secret_hash()
+        time_limit = psdash.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+        if time_limit:
+            # and must not expire: renew it halfway
+            parts['csrf_period'] = int(time.time() // (time_limit / 2))
+    payload = json.dumps(parts, sort_keys=True, default=etag_default)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:32]
+
+
+def render_conditional(template_name, **context):
+    '''Like render_template, for GET requests the response has an ETag computed
+    from the context and a 304 is returned if the browser already has that page'''
+    if request.method not in ('GET', 'HEAD') or session.get('_flashes'):
+        # Flashed messages are shown once, the page must be rendered
+        return render_template(template_name, **context)
+    etag = compute_etag(template_name, context)
+    if request.if_none_match.contains(etag + GZIP_SUFFIX):
+        response = make_response('', 304)
+        response.set_etag(etag + GZIP_SUFFIX)
+    elif request.if_none_match.contains(etag):
+        response = make_response('', 304)
+        response.set_etag(etag)
+    else:
+        response = make_response(render_template(template_name, **context))
+        response.set_etag(etag)
+    # Always revalidate (the data comes from the API)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def compress_response(response):
+    '''after_request: gzip the HTML responses if the browser accepts it'''
+    if (response.status_code != 200
+            or response.mimetype != 'text/html'
+            or response.is_streamed
+            or response.direct_passthrough
+            or 'Content-Encoding' in response.headers
+            or not request.accept_encodings['gzip']):
+        return response
+    data = response.get_data()
+    if len(data) < psdash.config['GZIP_MIN_SIZE']:
+        return response
+    response.set_data(gzip.compress(data, compresslevel=psdash.config['GZIP_LEVEL']))
+    response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    etag, weak = response.get_etag()
+    if etag:
+        # Another representation of the page, another strong ETag
+        response.set_etag(etag + GZIP_SUFFIX, weak=weak)
+    return response
+
+
+def init_compression(app):
+    '''Gzip the HTML responses'''
+    app.after_request(compress_response)
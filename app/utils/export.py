@@ -0,0 +1,94 @@
+"""
+Streaming export of the inventory (CSV or JSON lines)
+
+The API is paged with offset/limit, the next page is requested while the current
+one is written, so the memory used does not depend on the size of the inventory
+"""
+
+import io
+import csv
+import json
+
+from app.contrib.pool import spawn
+from app.utils.cache import get_reference_data
+
+
+# endpoint: (columns, relations [(<id field>, <reference endpoint>, <name column>), ...])
+EXPORTS = {
+    'proxy': (
+        ('id', 'url', 'active', 'type', 'location', 'provider', 'plan',
+         'dont_block', 'tor_control_port', 'tor_renew_identity'),
+        (('proxy_type_id', 'proxy_type', 'type'),
+         ('proxy_location_id', 'proxy_location', 'location'),
+         ('provider_id', 'provider', 'provider'),
+         ('provider_plan_id', 'provider_plan', 'plan')),
+    ),
+    'target': (
+        ('id', 'identifier', 'domain', 'blocked_standby'),
+        (),
+    ),
+    'provider_plan': (
+        ('id', 'code', 'name', 'provider'),
+        (('provider_id', 'provider', 'provider'),),
+    ),
+}
+
+FORMATS = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+}
+
+
+def iter_prefetched_pages(api, endpoint, page_size, **query):
+    '''Like API.iter_pages but the next page is requested in the background
+    while the current one is being consumed'''
+    offset = 0
+    wait = spawn(api.get, endpoint, offset=offset, limit=page_size, **query)
+    while True:
+        resp = wait()
+        data = resp['data']
+        if not data:
+            return
+        offset += len(data)
+        more = len(data) == page_size and offset < resp.get('total', offset + 1)
+        if more:
+            wait = spawn(api.get, endpoint, offset=offset, limit=page_size, **query)
+        yield data
+        if not more:
+            return
+
+
+def iter_export_rows(api, endpoint, page_size):
+    '''Generate the pages of rows (dicts with the export columns) of an endpoint
+    The relation names are taken from a lookup table built once for the export'''
+    columns, relations = EXPORTS[endpoint]
+    lookups = {ref_endpoint: {elem_id: element['name'] for elem_id, element
+                              in get_reference_data(ref_endpoint).items()}
+               for _, ref_endpoint, _ in relations}
+    for page in iter_prefetched_pages(api, endpoint, page_size):
+        rows = []
+        for element in page:
+            for id_field, ref_endpoint, name_column in relations:
+                element[name_column] = lookups[ref_endpoint].get(element[id_field], '')
+            rows.append({column: element.get(column) for column in columns})
+        yield rows
+
+
+def generate_export(api, endpoint, export_format, page_size=500):
+    '''Generate the export file chunks (one per page) in the given format'''
+    columns, _ = EXPORTS[endpoint]
+    if export_format == 'csv':
+        buf = io.StringIO()
+        writer = csv.DictWriter(buf, fieldnames=columns)
+        writer.writeheader()
+        for rows in iter_export_rows(api, endpoint, page_size):
+            writer.writerows(rows)
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+        # Only the header if there is no data
+        if buf.getvalue():
+            yield buf.getvalue()
+    else:
+        for rows in iter_export_rows(api, endpoint, page_size):
+            yield ''.join(json.dumps(row) + '\n' for row in rows)
@@ -0,0 +1,282 @@
+"""
+Proxy health checks
+
+Every active proxy is used to request a check URL:
+- The checks run in a bounded pool (gevent or threads, see app.contrib.pool) with
+  a cap of concurrent checks per provider, so a provider is not flooded
+- The proxies are checked one API page at a time and the results saved after every
+  page (ProxyHealth: success counts and a compact latency histogram per proxy)
+- Optionally the proxies failing N checks in a row are deactivated (PUT active=False)
+
+Run it with `python run.py --healthcheck` (a cron job for example)
+"""
+
+import time
+import logging
+import datetime
+import threading
+from collections import namedtuple
+from collections import defaultdict
+from collections import deque
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from app import db
+from app import psdash
+from app.contrib.api import API
+from app.contrib.cache import TTLCache
+from app.contrib.histogram import LatencyHistogram
+from app.contrib.pool import map_bounded
+from app.models.health import ProxyHealth
+from app.utils.cache import invalidate_endpoint
+from app.utils.signals import proxy_saved
+from app.utils.signals import proxy_deleted
+
+
+logger = logging.getLogger(__name__)
+
+
+CheckResult = namedtuple('CheckResult', ('proxy_id', 'ok', 'latency', 'error'))
+
+# The summary of the stats page, it reads every row: computed once per STATS_TTL
+summary_cache = TTLCache(maxsize=1, ttl=psdash.config['STATS_TTL'])
+_summary_lock = threading.Lock()
+
+# The IDs of the deleted proxies whose health is not deleted yet (see purge_deleted)
+_deleted_ids = set()
+_deleted_lock = threading.Lock()
+# Max IDs in the IN clause of a delete
+DELETE_CHUNK_SIZE = 500
+
+
+def probe(session, proxy_url, check_url, timeout):
+    '''Request the check URL through a proxy
+    Return a tuple (<ok>, <latency in ms>, <error or None>)'''
+    start = time.monotonic()
+    try:
+        resp = session.get(check_url, proxies={'http': proxy_url, 'https': proxy_url},
+                           timeout=timeout, allow_redirects=False, stream=True)
+        resp.close()
+    except requests.RequestException as exc:
+        return False, (time.monotonic() - start) * 1000, exc.__class__.__name__
+    latency = (time.monotonic() - start) * 1000
+    if resp.status_code >= 400:
+        return False, latency, 'HTTP {}'.format(resp.status_code)
+    return True, latency, None
+
+
+def interleave_by_provider(proxies):
+    '''Return the proxies alternating their providers, so the pool is not filled
+    with proxies waiting for the same provider'''
+    queues = defaultdict(deque)
+    for proxy in proxies:
+        queues[proxy.get('provider_id')].append(proxy)
+    queues = list(queues.values())
+    interleaved = []
+    while queues:
+        for queue in queues:
+            interleaved.append(queue.popleft())
+        queues = [queue for queue in queues if queue]
+    return interleaved
+
+
+class HealthChecker:
+    '''Check the active proxies and save the results
+    @param api: the API client used to read (and deactivate) the proxies
+    @param check_url: the URL requested through every proxy
+    @param timeout: seconds to wait for a proxy
+    @param concurrency: max number of checks running at once
+    @param provider_concurrency: max number of checks running at once per provider
+    @param deactivate_after: consecutive failures to deactivate a proxy (0: never)
+    @param session: the requests Session used for the checks (a new one by default)'''
+
+    def __init__(self, api, check_url, timeout=10, concurrency=50, provider_concurrency=10,
+                 deactivate_after=0, session=None):
+        self.api = api
+        self.check_url = check_url
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.provider_concurrency = provider_concurrency
+        self.deactivate_after = deactivate_after
+        if session is None:
+            session = requests.Session()
+            # Every proxy is a different host, the checks are not kept alive
+            adapter = HTTPAdapter(pool_connections=concurrency, pool_maxsize=1)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        self.session = session
+        self._semaphores = {}
+        self._semaphores_lock = threading.Lock()
+
+    def provider_semaphore(self, provider_id):
+        '''Return the semaphore limiting the concurrent checks of a provider'''
+        with self._semaphores_lock:
+            if provider_id not in self._semaphores:
+                self._semaphores[provider_id] = threading.BoundedSemaphore(
+                    self.provider_concurrency)
+            return self._semaphores[provider_id]
+
+    def check(self, proxy):
+        '''Check a proxy, return a CheckResult'''
+        with self.provider_semaphore(proxy.get('provider_id')):
+            ok, latency, error = probe(self.session, proxy['url'], self.check_url,
+                                       self.timeout)
+        return CheckResult(proxy['id'], ok, latency, error)
+
+    def check_proxies(self, proxies):
+        '''Check a list of proxies, return the list of CheckResult'''
+        return map_bounded(self.check, interleave_by_provider(proxies),
+                           concurrency=self.concurrency)
+
+    def release_proxies(self):
+        '''Close the connection pools of the checked proxies: the adapters keep a pool
+        manager per proxy URL, which would hold one per proxy of the inventory'''
+        for adapter in self.session.adapters.values():
+            managers = getattr(adapter, 'proxy_manager', {})
+            for manager in managers.values():
+                manager.clear()
+            managers.clear()
+
+    def save(self, results):
+        '''Add the check results to the stored health of the proxies
+        Return the list of ProxyHealth to deactivate'''
+        purge_deleted()
+        checked_at = datetime.datetime.utcnow()
+        health = {row.proxy_id: row for row in ProxyHealth.query.filter(
+            ProxyHealth.proxy_id.in_([result.proxy_id for result in results]))}
+        dead = []
+        for result in results:
+            row = health.get(result.proxy_id)
+            if row is None:
+                row = ProxyHealth(proxy_id=result.proxy_id)
+                db.session.add(row)
+            row.record(result.ok, result.latency, result.error, checked_at)
+            if self.deactivate_after and row.consecutive_failures >= self.deactivate_after:
+                dead.append(row)
+        db.session.commit()
+        summary_cache.invalidate()
+        return dead
+
+    def deactivate(self, proxy):
+        '''Set a proxy as not active in the API'''
+        proxy_data = {key: value for key, value in proxy.items() if key != 'id'}
+        proxy_data['active'] = False
+        self.api.put('proxy', proxy['id'], **proxy_data)
+        proxy_saved.send(psdash, proxy=dict(proxy_data, id=proxy['id']))
+
+    def run(self, page_size=500):
+        '''Check all the active proxies, one API page at a time
+        Return a dict with the counts of checked, ok, failed and deactivated proxies'''
+        summary = {'checked': 0, 'ok': 0, 'failed': 0, 'deactivated': 0}
+        # The proxies deactivated are sent back whole: read them from the API
+        for page in self.api.iter_pages('proxy', page_size=page_size, refresh=True):
+            proxies = {proxy['id']: proxy for proxy in page if proxy.get('active')}
+            if not proxies:
+                continue
+            results = self.check_proxies(proxies.values())
+            self.release_proxies()
+            dead = self.save(results)
+            for row in dead:
+                self.deactivate(proxies[row.proxy_id])
+            ok = sum(1 for result in results if result.ok)
+            summary['checked'] += len(results)
+            summary['ok'] += ok
+            summary['failed'] += len(results) - ok
+            summary['deactivated'] += len(dead)
+            logger.info('Health check: %r', summary)
+        if summary['deactivated']:
+            invalidate_endpoint('proxy')
+        return summary
+
+
+def run_health_checks():
+    '''Run the health checks with the [healthcheck] config
+    It must be called within an app context'''
+    api = API(psdash.config['api_url'], psdash.config['api_key'])
+    checker = HealthChecker(api, psdash.config['HEALTHCHECK_URL'],
+                            timeout=psdash.config['HEALTHCHECK_TIMEOUT'],
+                            concurrency=psdash.config['HEALTHCHECK_CONCURRENCY'],
+                            provider_concurrency=psdash.config['HEALTHCHECK_PROVIDER_CONCURRENCY'],
+                            deactivate_after=psdash.config['HEALTHCHECK_DEACTIVATE_AFTER'])
+    return checker.run(page_size=psdash.config['EXPORT_PAGE_SIZE'])
+
+
+def get_proxies_health(proxy_ids):
+    '''Return the stored health of the given proxies as a dict {<proxy id>: ProxyHealth}'''
+    if not proxy_ids:
+        return {}
+    purge_deleted()
+    return {row.proxy_id: row for row in ProxyHealth.query.filter(
+        ProxyHealth.proxy_id.in_(proxy_ids))}
+
+
+def get_health_summary():
+    '''Return the health of all the checked proxies as a dict:
+    checked, healthy (last check ok), failing, the merged LatencyHistogram, its
+    p50/p95 and the time of the last check
+    It is cached like the stats (STATS_TTL): the checks saved by another process
+    (the cron job) show up when it expires'''
+    summary = summary_cache.get('summary')
+    if summary is None:
+        with _summary_lock:
+            summary = summary_cache.get('summary')
+            if summary is None:
+                summary = load_health_summary()
+                summary_cache.set('summary', summary)
+    return summary
+
+
+def load_health_summary():
+    '''Compute the health summary (see get_health_summary) from all the rows'''
+    purge_deleted()
+    histogram = LatencyHistogram()
+    checked = failing = 0
+    last_checked_at = None
+    rows = db.session.query(ProxyHealth.consecutive_failures, ProxyHealth.latency,
+                            ProxyHealth.last_checked_at)
+    for consecutive_failures, latency, checked_at in rows:
+        checked += 1
+        if consecutive_failures:
+            failing += 1
+        histogram.merge(LatencyHistogram.loads(latency))
+        if checked_at and (last_checked_at is None or checked_at > last_checked_at):
+            last_checked_at = checked_at
+    return {
+        'checked': checked,
+        'healthy': checked - failing,
+        'failing': failing,
+        'histogram': histogram,
+        'p50': histogram.percentile(50),
+        'p95': histogram.percentile(95),
+        'last_checked_at': last_checked_at,
+    }
+
+
+def purge_deleted():
+    '''Delete the health of the deleted proxies, a few statements and one commit
+    for all of them (a bulk delete sends a signal per proxy)'''
+    global _deleted_ids
+    with _deleted_lock:
+        proxy_ids, _deleted_ids = list(_deleted_ids), set()
+    if not proxy_ids:
+        return
+    try:
+        for start in range(0, len(proxy_ids), DELETE_CHUNK_SIZE):
+            ProxyHealth.query.filter(ProxyHealth.proxy_id.in_(
+                proxy_ids[start:start + DELETE_CHUNK_SIZE])).delete(synchronize_session=False)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        with _deleted_lock:
+            _deleted_ids.update(proxy_ids)
+        raise
+
+
+@proxy_deleted.connect
+def on_proxy_deleted(sender, proxy_id):
+    '''Drop the health of a deleted proxy: it is deleted with the next ones, before
+    the health is read again'''
+    with _deleted_lock:
+        _deleted_ids.add(proxy_id)
+    summary_cache.invalidate()
@@ -0,0 +1,195 @@
+"""
+Bulk proxy import
+
+The uploaded file is read as a stream, it can be:
+- A CSV file with a header, the columns are
+  url, active, type, location, provider, plan, dont_block,
+  tor_control_port, tor_control_pswd, tor_renew_identity
+  type/location/provider/plan are the codes of the related elements
+- A plain list of proxy URLs, one per line
+
+Every row is validated like the Proxy Form, the duplicates (against the existing
+proxies and inside the file) are skipped and the new proxies are created in batches
+"""
+
+import csv
+import codecs
+import hashlib
+import logging
+import tempfile
+
+from werkzeug.datastructures import MultiDict
+
+from app.contrib.pool import map_bounded
+from app.models.dashboard import ProxyImportRowForm
+from app.utils.cache import get_reference_data
+from app.utils.cache import invalidate_endpoint
+from app.utils.signals import proxy_saved
+
+
+logger = logging.getLogger(__name__)
+
+# CSV column: (form field, reference endpoint)
+RELATION_COLUMNS = {
+    'type': ('proxy_type', 'proxy_type'),
+    'location': ('proxy_location', 'proxy_location'),
+    'provider': ('provider', 'provider'),
+    'plan': ('provider_plan', 'provider_plan'),
+}
+FLAG_COLUMNS = ('active', 'dont_block', 'tor_renew_identity')
+TEXT_COLUMNS = ('tor_control_port', 'tor_control_pswd')
+TRUE_VALUES = {'1', 'y', 'yes', 't', 'true', 'on'}
+
+
+def url_hash(url):
+    '''Compact (8 bytes) hash of a proxy URL used for the duplicates index'''
+    return hashlib.blake2b(url.strip().encode('utf-8'), digest_size=8).digest()
+
+
+def spool_upload(file_storage):
+    '''Copy an uploaded file to a temporary file and return it
+    The upload is closed with the request, before a streamed response is sent'''
+    tmp_file = tempfile.TemporaryFile()
+    file_storage.save(tmp_file)
+    tmp_file.seek(0)
+    return tmp_file
+
+
+def iter_file_rows(tmp_file):
+    '''Iterate over the rows of a file (see iter_rows), closing it at the end'''
+    with tmp_file:
+        yield from iter_rows(tmp_file)
+
+
+def iter_rows(stream):
+    '''Iterate over the rows of a binary stream
+    Generate tuples (<line number>, <row dict>)'''
+    reader = csv.reader(codecs.iterdecode(stream, 'utf-8-sig', errors='replace'))
+    header = None
+    for line_num, row in enumerate(reader, 1):
+        values = [value.strip() for value in row]
+        if not any(values) or values[0].startswith('#'):
+            continue
+        if header is None:
+            lowered = [value.lower() for value in values]
+            if 'url' in lowered:
+                header = lowered
+                continue
+            # A plain list of URLs
+            header = ['url']
+        yield line_num, dict(zip(header, values))
+
+
+class ProxyImporter:
+    '''Import the proxies from the rows generated by iter_rows
+    @param api: an API instance
+    @param defaults: a dict with the values used when a row does not have them
+    {'active': <bool>, 'proxy_type': <id>, 'proxy_location': <id>, ...}'''
+
+    def __init__(self, api, defaults, batch_size=100, concurrency=10):
+        self.api = api
+        self.defaults = defaults
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.choices = {}
+        self.codes = {}
+        for column, (field, endpoint) in RELATION_COLUMNS.items():
+            elements = get_reference_data(endpoint).values()
+            self.choices[field] = [(element['id'], element['name']) for element in elements]
+            self.codes[column] = {element['code'].lower(): element['id'] for element in elements}
+        self.read = 0
+        self.created = 0
+        self.duplicates = 0
+        self.errors = 0
+
+    def load_url_hashes(self):
+        '''Return the set of hashes of the URLs of all the existing proxies'''
+        hashes = set()
+        for page in self.api.iter_pages('proxy', page_size=self.batch_size * 10,
+                                        refresh=True):
+            hashes.update(url_hash(proxy['url']) for proxy in page)
+        return hashes
+
+    def build_form(self, row):
+        '''Return a validated ProxyImportRowForm for the row
+        Raise ValueError if the row is not valid'''
+        formdata = MultiDict()
+        formdata['url'] = row.get('url', '')
+        for column, (field, _) in RELATION_COLUMNS.items():
+            code = row.get(column)
+            if code:
+                elem_id = self.codes[column].get(code.lower())
+                if elem_id is None:
+                    raise ValueError('unknown {} code: {}'.format(column, code))
+            else:
+                elem_id = self.defaults.get(field)
+            if elem_id:
+                formdata[field] = str(elem_id)
+        for column in FLAG_COLUMNS:
+            value = row.get(column)
+            if value:
+                flag = value.lower() in TRUE_VALUES
+            else:
+                flag = self.defaults.get(column, False)
+            if flag:
+                formdata[column] = 'y'
+        for column in TEXT_COLUMNS:
+            if row.get(column):
+                formdata[column] = row[column]
+        form = ProxyImportRowForm(formdata=formdata)
+        for field, choices in self.choices.items():
+            getattr(form, field).choices = choices
+        if not form.validate():
+            raise ValueError('; '.join('{}: {}'.format(field, ', '.join(errors))
+                                       for field, errors in form.errors.items()))
+        return form
+
+    def create_batch(self, batch):
+        '''Create the proxies of a batch [(<line number>, <proxy data>), ...]
+        Generate a report line for every error'''
+        results = map_bounded(lambda item: self.api.post('proxy', **item[1]), batch,
+                              concurrency=self.concurrency, return_exceptions=True)
+        for (line_num, data), result in zip(batch, results):
+            if isinstance(result, Exception) or not result.get('data'):
+                self.errors += 1
+                error = result if isinstance(result, Exception) else result.get('message', result)
+                yield 'line {}: could not create {}: {}'.format(line_num, data['url'], error)
+            else:
+                self.created += 1
+                proxy_saved.send(self, proxy=dict(data, id=result['data'].get('id')))
+
+    def progress(self):
+        '''A report line with the current counters'''
+        return '{} rows read, {} created, {} duplicates, {} errors'.format(
+            self.read, self.created, self.duplicates, self.errors)
+
+    def run(self, rows):
+        '''Import the rows, generating the report lines (errors and progress)'''
+        seen = self.load_url_hashes()
+        yield '{} existing proxies'.format(len(seen))
+        batch = []
+        for line_num, row in rows:
+            self.read += 1
+            try:
+                form = self.build_form(row)
+            except ValueError as exc:
+                self.errors += 1
+                yield 'line {}: {}'.format(line_num, exc)
+                continue
+            key = url_hash(form.url.data)
+            if key in seen:
+                self.duplicates += 1
+                yield 'line {}: duplicate {}'.format(line_num, form.url.data)
+                continue
+            seen.add(key)
+            batch.append((line_num, form.api_data()))
+            if len(batch) >= self.batch_size:
+                yield from self.create_batch(batch)
+                batch = []
+                logger.info('Proxy import: %s', self.progress())
+                yield self.progress()
+        if batch:
+            yield from self.create_batch(batch)
+        invalidate_endpoint('proxy')
+        logger.info('Proxy import finished: %s', self.progress())
+        yield 'Done: ' + self.progress()
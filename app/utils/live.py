@@ -0,0 +1,197 @@
+"""
+Live updates of the proxies and targets lists (Server-Sent Events)
+
+Every worker runs a single poller for all its connected browsers: every
+LIVE_INTERVAL seconds it reads the whole inventory of the endpoints with
+subscribers, compares it with the previous poll and sends the differences
+(added, changed and removed elements) to them. The API responses come from the
+shared cache (see app.utils.cache), so a poll is done upstream about once per
+host in the cache TTL. The poller stops when the last browser disconnects
+
+A browser too slow to read its events gets a `reload` event instead
+"""
+
+import json
+import queue
+import logging
+import threading
+import contextvars
+
+from app import psdash
+from app.contrib.api import API
+from app.utils.cache import get_reference_data
+
+
+logger = logging.getLogger(__name__)
+
+# Fields compared by the poller and sent to the browsers
+LIVE_FIELDS = {
+    'proxy': ('url', 'active', 'proxy_type_id', 'proxy_location_id', 'provider_id',
+              'provider_plan_id', 'dont_block'),
+    'target': ('identifier', 'domain', 'blocked_standby'),
+}
+# Names added to the proxies: (<ID field>, <reference endpoint>, <name field>)
+PROXY_NAMES = (
+    ('proxy_type_id', 'proxy_type', 'type'),
+    ('proxy_location_id', 'proxy_location', 'location'),
+    ('provider_id', 'provider', 'provider'),
+    ('provider_plan_id', 'provider_plan', 'plan'),
+)
+
+
+def load_snapshot(api, endpoint, page_size):
+    '''Return {<id>: <tuple of the LIVE_FIELDS>} of all the elements of an endpoint'''
+    fields = LIVE_FIELDS[endpoint]
+    return {element['id']: tuple(element.get(field) for field in fields)
+            for page in api.iter_pages(endpoint, page_size=page_size)
+            for element in page}
+
+
+def diff_snapshots(old, new):
+    '''Return the (<added IDs>, <changed IDs>, <removed IDs>) between two snapshots'''
+    added = [elem_id for elem_id in new if elem_id not in old]
+    changed = [elem_id for elem_id, row in new.items()
+               if elem_id in old and old[elem_id] != row]
+    removed = [elem_id for elem_id in old if elem_id not in new]
+    return added, changed, removed
+
+
+def element_data(endpoint, elem_id, row):
+    '''The data of an element sent to the browsers (with the names of the relations)'''
+    data = dict(zip(LIVE_FIELDS[endpoint], row), id=elem_id)
+    if endpoint == 'proxy':
+        for id_field, ref_endpoint, name_field in PROXY_NAMES:
+            element = get_reference_data(ref_endpoint).get(data[id_field])
+            data[name_field] = element['name'] if element else ''
+    return data
+
+
+class LivePoller:
+    '''Poll the inventory and send its changes to the subscribers
+    @param interval: seconds between polls
+    @param queue_size: events kept for a subscriber that does not read them'''
+
+    def __init__(self, api, interval=15, queue_size=100, page_size=500):
+        self.api = api
+        self.interval = interval
+        self.queue_size = queue_size
+        self.page_size = page_size
+        self.subscribers = {}
+        self.snapshots = {}
+        self.running = False
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+
+    def subscribe(self, endpoint):
+        '''Return a new queue receiving the events of an endpoint'''
+        events = queue.Queue(maxsize=self.queue_size)
+        with self._lock:
+            self.subscribers.setdefault(endpoint, set()).add(events)
+            if not self.running:
+                self.running = True
+                self._wakeup.clear()
+                # A daemon thread (a greenlet with gevent) in a new context: it outlives
+                # the request subscribing first, it must not keep its request context
+                threading.Thread(target=contextvars.Context().run, args=(self.loop,),
+                                 name='live-poller', daemon=True).start()
+        return events
+
+    def unsubscribe(self, endpoint, events):
+        '''Stop sending events to a queue'''
+        with self._lock:
+            subscribers = self.subscribers.get(endpoint, set())
+            subscribers.discard(events)
+            if not subscribers:
+                self.subscribers.pop(endpoint, None)
+                # The next subscriber starts from a new snapshot
+                self.snapshots.pop(endpoint, None)
+                if not self.subscribers:
+                    self._wakeup.set()
+
+    def publish(self, endpoint, event):
+        '''Send an event to the subscribers of an endpoint'''
+        with self._lock:
+            subscribers = list(self.subscribers.get(endpoint, ()))
+        for events in subscribers:
+            try:
+                events.put_nowait(event)
+            except queue.Full:
+                # Too far behind: drop its events, the browser reloads the page
+                while not events.empty():
+                    events.get_nowait()
+                events.put_nowait({'type': 'reload', 'endpoint': endpoint})
+
+    def poll(self):
+        '''Poll the endpoints with subscribers and publish their changes'''
+        with self._lock:
+            endpoints = list(self.subscribers)
+        for endpoint in endpoints:
+            new = load_snapshot(self.api, endpoint, self.page_size)
+            old = self.snapshots.get(endpoint)
+            self.snapshots[endpoint] = new
+            if old is None:
+                continue
+            added, changed, removed = diff_snapshots(old, new)
+            if added or changed or removed:
+                self.publish(endpoint, {
+                    'type': 'delta',
+                    'endpoint': endpoint,
+                    'added': [element_data(endpoint, elem_id, new[elem_id])
+                              for elem_id in added],
+                    'changed': [element_data(endpoint, elem_id, new[elem_id])
+                                for elem_id in changed],
+                    'removed': removed,
+                })
+
+    def loop(self):
+        '''Poll until there are no subscribers'''
+        while True:
+            with self._lock:
+                if not self.subscribers:
+                    self.running = False
+                    return
+            try:
+                self.poll()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception('Live poll failed')
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+
+
+_poller = None
+_poller_lock = threading.Lock()
+
+
+def get_poller():
+    '''Return the LivePoller of this worker'''
+    global _poller
+    with _poller_lock:
+        if _poller is None:
+            _poller = LivePoller(API(psdash.config['api_url'], psdash.config['api_key']),
+                                 interval=psdash.config['LIVE_INTERVAL'],
+                                 page_size=psdash.config['EXPORT_PAGE_SIZE'])
+        return _poller
+
+
+def format_event(event):
+    '''Return an event in the text/event-stream format'''
+    return 'event: {}\ndata: {}\n\n'.format(event['type'], json.dumps(event))
+
+
+def generate_events(endpoint, keepalive=15, retry=5):
+    '''Generate the text/event-stream of the changes of an endpoint, with a comment
+    every `keepalive` seconds without events so the proxies keep it open
+    @param retry: seconds before the browser reconnects'''
+    poller = get_poller()
+    events = poller.subscribe(endpoint)
+    try:
+        yield 'retry: {}\n\n'.format(int(retry * 1000))
+        while True:
+            try:
+                event = events.get(timeout=keepalive)
+            except queue.Empty:
+                yield ': keepalive\n\n'
+                continue
+            yield format_event(event)
+    finally:
+        poller.unsubscribe(endpoint, events)
@@ -0,0 +1,151 @@
+"""
+Instrumentation of the dashboard
+
+- Every API request is timed and counted by method, endpoint and status
+- Every view is timed, with the time spent rendering its template
+- Every response gets a Server-Timing header: API calls, template and total time
+- The password hashing (app.utils.passwords) wait and duration
+- The state of the API circuit breaker (see app.contrib.api.configure_circuit_breaker)
+- The metrics are exported in the Prometheus format (see app.views.metrics)
+
+With several gunicorn workers set the PROMETHEUS_MULTIPROC_DIR environment variable
+(gunicorn.py does it) so the metrics of all the workers are aggregated
+"""
+
+import time
+import threading
+
+from flask import g
+from flask import has_app_context
+from flask import request
+from flask import before_render_template
+from flask import template_rendered
+
+from prometheus_client import Counter
+from prometheus_client import Gauge
+from prometheus_client import Histogram
+
+from app.contrib.api import add_request_listener
+from app.contrib.api import get_circuit_breaker
+from app.contrib.breaker import CLOSED
+from app.contrib.breaker import HALF_OPEN
+from app.contrib.breaker import OPEN
+
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+API_REQUESTS = Counter('psdash_api_requests_total', 'Requests sent to the Proxy Service API',
+                       ['method', 'endpoint', 'status'])
+API_LATENCY = Histogram('psdash_api_request_duration_seconds',
+                        'Duration of the requests sent to the Proxy Service API',
+                        ['method', 'endpoint'], buckets=LATENCY_BUCKETS)
+VIEW_LATENCY = Histogram('psdash_view_duration_seconds', 'Duration of the dashboard views',
+                         ['view', 'method'], buckets=LATENCY_BUCKETS)
+PASSWORD_HASH_LATENCY = Histogram('psdash_password_hash_seconds',
+                                  'Time spent hashing/verifying passwords', ['operation'],
+                                  buckets=LATENCY_BUCKETS)
+PASSWORD_QUEUE_WAIT = Histogram('psdash_password_queue_wait_seconds',
+                                'Time waiting for a free password hashing slot', ['operation'],
+                                buckets=LATENCY_BUCKETS)
+PASSWORD_REJECTED = Counter('psdash_password_rejected_total',
+                            'Password hashing calls rejected after waiting too long',
+                            ['operation'])
+TEMPLATE_LATENCY = Histogram('psdash_template_render_seconds',
+                             'Time spent rendering the templates of the views',
+                             ['view'], buckets=LATENCY_BUCKETS)
+
+# The worst state of the workers is exported
+CIRCUIT_STATES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+API_CIRCUIT_STATE = Gauge('psdash_api_circuit_state',
+                          'State of the API circuit breaker: 0 closed, 1 half-open, 2 open',
+                          multiprocess_mode='max')
+API_CIRCUIT_CHANGES = Counter('psdash_api_circuit_changes_total',
+                              'Changes of state of the API circuit breaker', ['state'])
+
+
+class RequestTimings:
+    '''Times of a dashboard request. The API calls may run concurrently (see
+    app.contrib.pool), so their time is the sum of the time of every call'''
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.api_calls = 0
+        self.api_time = 0.0
+        self.template_time = 0.0
+        self._lock = threading.Lock()
+
+    def add_api_call(self, elapsed):
+        '''Count an API call'''
+        with self._lock:
+            self.api_calls += 1
+            self.api_time += elapsed
+
+    def server_timing(self):
+        '''Return the Server-Timing header value (durations in ms)'''
+        total = time.perf_counter() - self.start
+        return ', '.join((
+            'api;dur={:.1f};desc="API ({} calls)"'.format(self.api_time * 1000, self.api_calls),
+            'tpl;dur={:.1f};desc="Template"'.format(self.template_time * 1000),
+            'total;dur={:.1f};desc="Total"'.format(total * 1000),
+        ))
+
+
+def on_api_request(method, endpoint, status, elapsed):
+    '''API request listener: update the metrics and the timings of the current request'''
+    API_REQUESTS.labels(method, endpoint, str(status)).inc()
+    API_LATENCY.labels(method, endpoint).observe(elapsed)
+    if has_app_context():
+        timings = g.get('timings')
+        if timings is not None:
+            timings.add_api_call(elapsed)
+
+
+def on_circuit_change(name, old, new):
+    '''Circuit breaker listener: update its state metrics'''
+    API_CIRCUIT_STATE.set(CIRCUIT_STATES[new])
+    API_CIRCUIT_CHANGES.labels(new).inc()
+
+
+def start_timings():
+    '''before_request: start the timings of the request'''
+    g.timings = RequestTimings()
+
+
+def add_server_timing(response):
+    '''after_request: add the Server-Timing header and observe the view duration'''
+    timings = g.get('timings')
+    if timings is not None:
+        response.headers['Server-Timing'] = timings.server_timing()
+        VIEW_LATENCY.labels(request.endpoint or 'unknown', request.method).observe(
+            time.perf_counter() - timings.start)
+    return response
+
+
+def on_before_render_template(sender, template, context, **extra):
+    '''Keep the time a template starts rendering'''
+    g.template_start = time.perf_counter()
+
+
+def on_template_rendered(sender, template, context, **extra):
+    '''Add the time spent rendering a template'''
+    start = g.pop('template_start', None)
+    timings = g.get('timings')
+    if start is None or timings is None:
+        return
+    elapsed = time.perf_counter() - start
+    timings.template_time += elapsed
+    TEMPLATE_LATENCY.labels(request.endpoint or 'unknown').observe(elapsed)
+
+
+def init_metrics(app):
+    '''Instrument the app: API and circuit breaker listeners, request hooks and
+    template signals'''
+    add_request_listener(on_api_request)
+    breaker = get_circuit_breaker()
+    if breaker is not None:
+        breaker.listeners.append(on_circuit_change)
+        API_CIRCUIT_STATE.set(CIRCUIT_STATES[breaker.state])
+    app.before_request(start_timings)
+    app.after_request(add_server_timing)
+    before_render_template.connect(on_before_render_template, app)
+    template_rendered.connect(on_template_rendered, app)
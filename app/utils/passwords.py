@@ -0,0 +1,73 @@
+"""
+Password hashing off the request loop
+
+Hashing/verifying a password takes hundreds of ms of CPU holding the GIL, so it
+runs in a small process pool per worker (see app.contrib.pool.get_process_pool)
+and a gevent worker keeps serving the other requests meanwhile.
+At most PASSWORD_CONCURRENCY calls run at once per worker, a call waiting more
+than PASSWORD_QUEUE_TIMEOUT seconds for its turn raises PasswordHashingBusy
+"""
+
+import time
+import logging
+import threading
+from concurrent.futures.process import BrokenProcessPool
+
+from passlib.apps import custom_app_context as pwd_context
+
+from app import psdash
+from app.contrib.pool import get_process_pool
+from app.utils.metrics import PASSWORD_HASH_LATENCY
+from app.utils.metrics import PASSWORD_QUEUE_WAIT
+from app.utils.metrics import PASSWORD_REJECTED
+
+
+logger = logging.getLogger(__name__)
+
+
+class PasswordHashingBusy(Exception):
+    '''Used when too many password hashes are waiting'''
+
+
+_semaphore = threading.BoundedSemaphore(psdash.config['PASSWORD_CONCURRENCY'])
+
+
+def _hash(pswd):
+    return pwd_context.hash(pswd)
+
+
+def _verify(pswd, pswd_hash):
+    return pwd_context.verify(pswd, pswd_hash)
+
+
+def run_hashing(operation, func, *args):
+    '''Run a passlib call in the process pool, measuring the wait and the hashing
+    If a process of the pool died the pool is replaced and the call run again once'''
+    start = time.perf_counter()
+    if not _semaphore.acquire(timeout=psdash.config['PASSWORD_QUEUE_TIMEOUT']):
+        PASSWORD_REJECTED.labels(operation).inc()
+        raise PasswordHashingBusy('Too many password {} calls waiting'.format(operation))
+    try:
+        started = time.perf_counter()
+        PASSWORD_QUEUE_WAIT.labels(operation).observe(started - start)
+        pool = get_process_pool(psdash.config['PASSWORD_CONCURRENCY'])
+        try:
+            result = pool.submit(func, *args).result()
+        except BrokenProcessPool:
+            logger.warning('The password hashing pool is broken, replacing it')
+            pool = get_process_pool(psdash.config['PASSWORD_CONCURRENCY'], broken=pool)
+            result = pool.submit(func, *args).result()
+        PASSWORD_HASH_LATENCY.labels(operation).observe(time.perf_counter() - started)
+        return result
+    finally:
+        _semaphore.release()
+
+
+def hash_password(pswd):
+    '''Return the hash of a password'''
+    return run_hashing('hash', _hash, pswd)
+
+
+def verify_password(pswd, pswd_hash):
+    '''Verify a password against its hash'''
+    return run_hashing('verify', _verify, pswd, pswd_hash)
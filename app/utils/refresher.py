@@ -0,0 +1,162 @@
+"""
+Background refresh of the hot pages (stale-while-revalidate)
+
+Every REFRESH_INTERVAL seconds the first REFRESH_PAGES pages of the lists
+(proxies, targets, plans), the reference lists and, if enabled, the data of the
+stats are requested again and stored in the shared cache (see app.utils.cache),
+so the users get them from the cache instead of waiting for the API. An expired
+list page or reference list is still served (up to SHARED_CACHE_MAX_STALE
+seconds) while it is requested again in the background, the pages then show the
+age of their data. The reads behind a write or an edit form are never stale
+
+A single worker of the host refreshes: the one holding the lock of a file next
+to the shared cache. When the API is slow or fails the interval is doubled (up to
+REFRESH_MAX_INTERVAL seconds) so it is not loaded even more
+"""
+
+import os
+import time
+import fcntl
+import logging
+import threading
+
+from app import psdash
+from app.contrib.api import API
+from app.contrib.pool import map_bounded
+from app.utils.cache import REFERENCE_ENDPOINTS
+
+
+logger = logging.getLogger(__name__)
+
+# The endpoints read by the stats (see app.utils.stats)
+STATS_ENDPOINTS = ('proxy', 'target_provider')
+
+
+def timed(call):
+    '''Run a call, return its duration'''
+    start = time.perf_counter()
+    call()
+    return time.perf_counter() - start
+
+
+class Refresher:
+    '''Refresh the cached API responses of the hot pages
+    @param lock_path: the file locked by the refreshing process
+    @param endpoints: the lists whose first `pages` pages are refreshed (only the first
+    one for the keyset endpoints, their next pages are requested by cursor)
+    @param stats: refresh all the pages read by the stats too
+    @param slow_threshold: mean seconds of a request above which the API is slow'''
+
+    def __init__(self, api, lock_path, interval=20, max_interval=300, slow_threshold=2,
+                 endpoints=(), pages=3, page_size=25, keyset_endpoints=(), stats=False,
+                 stats_page_size=500, concurrency=4):
+        self.api = api
+        self.lock_path = lock_path
+        self.interval = interval
+        self.max_interval = max_interval
+        self.slow_threshold = slow_threshold
+        self.endpoints = endpoints
+        self.pages = pages
+        self.page_size = page_size
+        self.keyset_endpoints = keyset_endpoints
+        self.stats = stats
+        self.stats_page_size = stats_page_size
+        self.concurrency = concurrency
+        self.current_interval = interval
+        self._lock_file = None
+
+    def acquire(self):
+        '''Return whether this process is the one refreshing (it holds the lock,
+        released when the process exits)'''
+        if self._lock_file is not None:
+            return True
+        lock_file = open(self.lock_path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        logger.info('Process %s refreshes the hot pages', os.getpid())
+        return True
+
+    def get_calls(self):
+        '''The requests of a refresh (callables), the same ones the pages send'''
+        calls = [lambda endpoint=endpoint: self.api.get(endpoint, refresh=True)
+                 for endpoint in REFERENCE_ENDPOINTS]
+        for endpoint in self.endpoints:
+            pages = 1 if endpoint in self.keyset_endpoints else self.pages
+            calls.extend(
+                lambda endpoint=endpoint, offset=page * self.page_size: self.api.get(
+                    endpoint, limit=self.page_size, offset=offset, refresh=True)
+                for page in range(pages))
+        if self.stats:
+            calls.extend(
+                lambda endpoint=endpoint: list(self.api.iter_pages(
+                    endpoint, page_size=self.stats_page_size, refresh=True))
+                for endpoint in STATS_ENDPOINTS)
+        return calls
+
+    def refresh(self):
+        '''Refresh the responses once and adapt the interval to the API latency
+        Return the mean seconds of a request'''
+        calls = self.get_calls()
+        results = map_bounded(timed, calls, concurrency=self.concurrency,
+                              return_exceptions=True)
+        errors = [result for result in results if isinstance(result, Exception)]
+        durations = [result for result in results if not isinstance(result, Exception)]
+        mean = sum(durations) / len(durations) if durations else 0.0
+        if errors or mean > self.slow_threshold:
+            self.current_interval = min(self.current_interval * 2, self.max_interval)
+            logger.warning('Refresh: %d errors (%r), %.2fs per request, next one in %ss',
+                           len(errors), errors[0] if errors else None, mean,
+                           self.current_interval)
+        else:
+            self.current_interval = self.interval
+        return mean
+
+    def loop(self):
+        '''Refresh forever if this process holds the lock, otherwise check again
+        every interval (the process holding it may exit)'''
+        while True:
+            try:
+                if self.acquire():
+                    self.refresh()
+            except Exception:  # pylint: disable=broad-except
+                logger.exception('Refresh failed')
+            time.sleep(self.current_interval)
+
+
+_refresher_pid = None
+_refresher_lock = threading.Lock()
+
+
+def start_refresher():
+    '''before_request: start the refresher of this worker (once per process, the app
+    may be loaded before forking the workers)'''
+    global _refresher_pid
+    if _refresher_pid == os.getpid():
+        return
+    with _refresher_lock:
+        if _refresher_pid == os.getpid():
+            return
+        _refresher_pid = os.getpid()
+        refresher = Refresher(API(psdash.config['api_url'], psdash.config['api_key']),
+                              psdash.config['SHARED_CACHE_PATH'] + '.refresh.lock',
+                              interval=psdash.config['REFRESH_INTERVAL'],
+                              max_interval=psdash.config['REFRESH_MAX_INTERVAL'],
+                              slow_threshold=psdash.config['REFRESH_SLOW_THRESHOLD'],
+                              endpoints=psdash.config['REFRESH_ENDPOINTS'],
+                              pages=psdash.config['REFRESH_PAGES'],
+                              page_size=psdash.config['PAGE_SIZE'],
+                              keyset_endpoints=psdash.config['KEYSET_ENDPOINTS'],
+                              stats=psdash.config['REFRESH_STATS'],
+                              stats_page_size=psdash.config['EXPORT_PAGE_SIZE'])
+        # A daemon thread (a greenlet with gevent): it does not keep the process alive
+        threading.Thread(target=refresher.loop, name='refresher', daemon=True).start()
+
+
+def init_refresher(app):
+    '''Refresh the hot pages in the background (it needs the shared cache)'''
+    if app.config['SHARED_CACHE'] and app.config['REFRESH']:
+        app.before_request(start_refresher)
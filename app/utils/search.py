@@ -0,0 +1,265 @@
+"""
+In-process search index of the inventory (proxies and targets)
+
+Used to answer the list filters the API can not answer (text search, flags)
+- An inverted index: n-gram (up to GRAM_SIZE characters) of the tokens of the
+  URL host/port, domain... -> set of IDs. The credentials of the proxy URLs
+  (user:password@) are not indexed
+- Facets: field -> value -> set of IDs
+- For every element only a tuple with the listed fields is kept
+
+The index is loaded in one pass over the paginated API, updated with the
+inventory signals and loaded again when it expires (SEARCH_INDEX_TTL config).
+Meanwhile the other requests search the expired index, and the changes made during
+the pass are applied to the new one
+"""
+
+import re
+import time
+import threading
+from collections import defaultdict
+
+from app import psdash
+from app.contrib.api import API
+from app.contrib.pool import fan_out
+from app.utils.signals import proxy_saved
+from app.utils.signals import proxy_deleted
+from app.utils.signals import target_saved
+from app.utils.signals import target_deleted
+
+
+TOKEN_RE = re.compile(r'[a-z0-9]+')
+# The user:password@ of a URL
+USERINFO_RE = re.compile(r'^([a-z][a-z0-9+.-]*://)[^/?#@]*@')
+# The longest n-grams indexed, a longer query token is looked up by its n-grams
+GRAM_SIZE = 3
+
+PROXY_FIELDS = ('id', 'url', 'active', 'proxy_type_id', 'proxy_location_id',
+                'provider_id', 'provider_plan_id', 'dont_block')
+PROXY_FACETS = ('active', 'proxy_type_id', 'proxy_location_id', 'provider_id',
+                'provider_plan_id', 'dont_block')
+TARGET_FIELDS = ('id', 'identifier', 'domain', 'blocked_standby')
+TARGET_FACETS = ('provider_ids',)
+
+
+def tokenize(text):
+    '''Split a text (URL, domain...) in lower case alphanumeric tokens'''
+    return TOKEN_RE.findall(str(text or '').lower())
+
+
+def get_grams(token):
+    '''The n-grams of a token, of every size up to GRAM_SIZE'''
+    return {token[start:start + size] for size in range(1, GRAM_SIZE + 1)
+            for start in range(len(token) - size + 1)}
+
+
+class InventoryIndex:
+    '''Search index of the elements of an endpoint
+    @param fields: the fields kept for every element (the first one is the ID)
+    @param text_fields: the fields indexed for the text search
+    @param facet_fields: the fields indexed by value, a set/list value is indexed
+    by every one of its items'''
+
+    def __init__(self, fields, text_fields, facet_fields):
+        self.fields = fields
+        self.text_positions = [fields.index(field) for field in text_fields]
+        self.facet_fields = facet_fields
+        self.rows = {}
+        self.facet_values = {}
+        self.postings = defaultdict(set)
+        self.facets = {field: defaultdict(set) for field in facet_fields}
+        self.loaded_at = None
+        self._lock = threading.RLock()
+
+    def _texts(self, row):
+        texts = [str(row[pos] or '').lower() for pos in self.text_positions]
+        return [USERINFO_RE.sub(r'\1', text) if '@' in text else text for text in texts]
+
+    def _grams(self, row):
+        return {gram for text in self._texts(row) for token in tokenize(text)
+                for gram in get_grams(token)}
+
+    def add(self, element):
+        '''Index a new or updated element (a dict)'''
+        with self._lock:
+            self.remove(element['id'])
+            row = tuple(element.get(field) for field in self.fields)
+            self.rows[element['id']] = row
+            for gram in self._grams(row):
+                self.postings[gram].add(element['id'])
+            values = {}
+            for field in self.facet_fields:
+                value = element.get(field)
+                values[field] = value
+                for item in value if isinstance(value, (set, list, tuple)) else (value,):
+                    self.facets[field][item].add(element['id'])
+            self.facet_values[element['id']] = values
+
+    def remove(self, elem_id):
+        '''Remove an element from the index'''
+        with self._lock:
+            row = self.rows.pop(elem_id, None)
+            if row is None:
+                return
+            for gram in self._grams(row):
+                self.postings[gram].discard(elem_id)
+                if not self.postings[gram]:
+                    del self.postings[gram]
+            for field, value in self.facet_values.pop(elem_id).items():
+                for item in value if isinstance(value, (set, list, tuple)) else (value,):
+                    self.facets[field][item].discard(elem_id)
+
+    def _text_ids(self, text):
+        '''IDs of the elements that may contain the text: with all the n-grams of
+        every token of the text (a superset, search checks the text itself)'''
+        postings = [self.postings.get(gram, set())
+                    for query_token in tokenize(text)
+                    for gram in get_grams(query_token)
+                    if len(gram) == min(len(query_token), GRAM_SIZE)]
+        if not postings:
+            return set(self.rows)
+        # From the shortest one: every intersection is at most that long
+        postings.sort(key=len)
+        return postings[0].intersection(*postings[1:])
+
+    def search(self, text='', **filters):
+        '''Return the sorted IDs of the elements containing the text (in any of the
+        text fields) and matching all the facet filters'''
+        with self._lock:
+            ids = None
+            for field, value in filters.items():
+                matched = self.facets[field].get(value, set())
+                ids = set(matched) if ids is None else ids & matched
+            if text:
+                text_ids = self._text_ids(text)
+                ids = text_ids if ids is None else ids & text_ids
+                lowered = text.lower()
+                ids = {elem_id for elem_id in ids
+                       if any(lowered in value for value in self._texts(self.rows[elem_id]))}
+            if ids is None:
+                ids = set(self.rows)
+            return sorted(ids)
+
+    def get_rows(self, ids):
+        '''Return the elements (dicts) of the given IDs'''
+        with self._lock:
+            return [dict(zip(self.fields, self.rows[elem_id]))
+                    for elem_id in ids if elem_id in self.rows]
+
+
+def load_proxy_index(api, page_size):
+    '''Return a new index of all the proxies'''
+    index = InventoryIndex(PROXY_FIELDS, ('url',), PROXY_FACETS)
+    for page in api.iter_pages('proxy', page_size=page_size):
+        for proxy in page:
+            index.add(proxy)
+    index.loaded_at = time.time()
+    return index
+
+
+def load_target_index(api, page_size):
+    '''Return a new index of all the targets, with their providers'''
+    targets, providers = fan_out(
+        lambda: [target for page in api.iter_pages('target', page_size=page_size)
+                 for target in page],
+        lambda: [rel for page in api.iter_pages('target_provider', page_size=page_size)
+                 for rel in page])
+    provider_ids = defaultdict(set)
+    for rel in providers:
+        provider_ids[rel['target_id']].add(rel['provider_id'])
+    index = InventoryIndex(TARGET_FIELDS, ('identifier', 'domain'), TARGET_FACETS)
+    for target in targets:
+        index.add(dict(target, provider_ids=provider_ids[target['id']]))
+    index.loaded_at = time.time()
+    return index
+
+
+_indexes = {}
+# Protects _indexes and _pending, never held during a load
+_indexes_lock = threading.Lock()
+# Held by the request (re)loading the index of an endpoint
+_load_locks = {'proxy': threading.Lock(), 'target': threading.Lock()}
+# The updates received during the load of an index (replayed on the loaded index)
+_pending = {}
+
+INDEX_LOADERS = {
+    'proxy': load_proxy_index,
+    'target': load_target_index,
+}
+
+
+def is_expired(index):
+    '''Return whether an index (or None) must be loaded again'''
+    return index is None or index.loaded_at + psdash.config['SEARCH_INDEX_TTL'] < time.time()
+
+
+def load_index(endpoint):
+    '''Load the index of an endpoint and make it the index of this worker
+    The updates received meanwhile are applied to it before'''
+    api = API(psdash.config['api_url'], psdash.config['api_key'])
+    with _indexes_lock:
+        _pending[endpoint] = []
+    try:
+        index = INDEX_LOADERS[endpoint](api, psdash.config['EXPORT_PAGE_SIZE'])
+        with _indexes_lock:
+            for update in _pending[endpoint]:
+                update(index)
+            _indexes[endpoint] = index
+    finally:
+        with _indexes_lock:
+            del _pending[endpoint]
+    return index
+
+
+def get_index(endpoint):
+    '''Return the index of an endpoint (proxy or target) of this worker,
+    (re)loading it if it expired
+    While a request reloads it the others get the expired one'''
+    index = _indexes.get(endpoint)
+    if not is_expired(index):
+        return index
+    load_lock = _load_locks[endpoint]
+    if not load_lock.acquire(blocking=index is None):
+        return index
+    try:
+        index = _indexes.get(endpoint)
+        if is_expired(index):
+            index = load_index(endpoint)
+    finally:
+        load_lock.release()
+    return index
+
+
+def apply_update(endpoint, update):
+    '''Apply an update (a function of the index) to the loaded index of an endpoint,
+    and to the one being loaded if any'''
+    with _indexes_lock:
+        if endpoint in _pending:
+            _pending[endpoint].append(update)
+        index = _indexes.get(endpoint)
+    if index is not None:
+        update(index)
+
+
+@proxy_saved.connect
+def on_proxy_saved(sender, proxy):
+    '''Index a created/updated proxy'''
+    apply_update('proxy', lambda index: index.add(proxy))
+
+
+@proxy_deleted.connect
+def on_proxy_deleted(sender, proxy_id):
+    '''Remove a deleted proxy from the index'''
+    apply_update('proxy', lambda index: index.remove(proxy_id))
+
+
+@target_saved.connect
+def on_target_saved(sender, target, provider_ids):
+    '''Index a created/updated target'''
+    apply_update('target', lambda index: index.add(dict(target, provider_ids=provider_ids)))
+
+
+@target_deleted.connect
+def on_target_deleted(sender, target_id):
+    '''Remove a deleted target from the index'''
+    apply_update('target', lambda index: index.remove(target_id))
@@ -0,0 +1,21 @@
+"""
+Inventory signals
+
+Sent by the dashboard after writing to the API, so the in-memory views of the
+inventory (stats, search index) can be updated without reloading them
+
+- proxy_saved: proxy=<proxy dict with id>
+- proxy_deleted: proxy_id=<id>
+- target_saved: target=<target dict with id>, provider_ids=<set of IDs>
+- target_deleted: target_id=<id>
+"""
+
+from blinker import Namespace
+
+
+inventory_signals = Namespace()
+
+proxy_saved = inventory_signals.signal('proxy-saved')
+proxy_deleted = inventory_signals.signal('proxy-deleted')
+target_saved = inventory_signals.signal('target-saved')
+target_deleted = inventory_signals.signal('target-deleted')
@@ -0,0 +1,192 @@
+"""
+Inventory statistics
+
+The counters are computed in one streaming pass over the paginated API and
+kept in memory. The changes made from the dashboard are applied incrementally,
+the full pass is only done again when the counters expire (STATS_TTL config).
+Meanwhile the other requests get the expired counters, and the changes made during
+the pass are applied to the new ones
+"""
+
+import time
+import threading
+from collections import Counter
+
+from app import psdash
+from app.contrib.api import API
+from app.contrib.pool import fan_out
+from app.utils.signals import proxy_saved
+from app.utils.signals import proxy_deleted
+from app.utils.signals import target_saved
+from app.utils.signals import target_deleted
+
+
+# Proxy fields counted by value: the relations and the flags
+PROXY_FIELDS = ('provider_id', 'provider_plan_id', 'proxy_type_id', 'proxy_location_id')
+PROXY_FLAGS = ('active', 'dont_block')
+
+
+class InventoryStats:
+    '''Counters of the proxy and target inventory
+    For every proxy only a tuple with the counted values is kept, so an update or a
+    delete can be discounted without asking the API for the previous data'''
+
+    def __init__(self):
+        self.proxies = {}
+        self.proxy_counters = {field: Counter() for field in PROXY_FIELDS + PROXY_FLAGS}
+        self.target_providers = Counter()
+        self.targets_loaded_at = None
+        self.loaded_at = None
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def proxy_key(proxy):
+        '''The compact tuple of counted values of a proxy'''
+        return tuple(proxy.get(field) for field in PROXY_FIELDS) + tuple(
+            bool(proxy.get(flag)) for flag in PROXY_FLAGS)
+
+    def _count(self, key, delta):
+        for field, value in zip(PROXY_FIELDS + PROXY_FLAGS, key):
+            counter = self.proxy_counters[field]
+            counter[value] += delta
+            if counter[value] <= 0:
+                del counter[value]
+
+    def add_proxy(self, proxy):
+        '''Count a new or updated proxy (a dict as returned by the API)'''
+        with self._lock:
+            self.remove_proxy(proxy['id'])
+            key = self.proxy_key(proxy)
+            self.proxies[proxy['id']] = key
+            self._count(key, 1)
+
+    def remove_proxy(self, proxy_id):
+        '''Discount a deleted proxy'''
+        with self._lock:
+            key = self.proxies.pop(proxy_id, None)
+            if key is not None:
+                self._count(key, -1)
+
+    def load_proxies(self, api, page_size):
+        '''Count all the proxies, one page at a time'''
+        for page in api.iter_pages('proxy', page_size=page_size):
+            for proxy in page:
+                self.add_proxy(proxy)
+        self.loaded_at = time.time()
+
+    def load_targets(self, api, page_size):
+        '''Count the targets related to every provider'''
+        pairs = set()
+        for page in api.iter_pages('target_provider', page_size=page_size):
+            pairs.update((rel['target_id'], rel['provider_id']) for rel in page)
+        target_providers = Counter(provider_id for _, provider_id in pairs)
+        with self._lock:
+            self.target_providers = target_providers
+            self.targets_loaded_at = time.time()
+
+    @property
+    def total(self):
+        '''Number of proxies'''
+        return len(self.proxies)
+
+    def counts(self, field):
+        '''Return the counts of a proxy field as a list of (<value>, <count>) tuples
+        sorted from the most common'''
+        with self._lock:
+            return self.proxy_counters[field].most_common()
+
+
+_stats = None
+# Protects _stats and _pending, never held during a load
+_stats_lock = threading.Lock()
+# Held by the request (re)loading the stats
+_load_lock = threading.Lock()
+# The updates received during a load (replayed on the loaded stats), None otherwise
+_pending = None
+
+
+def get_expired(stats):
+    '''Return whether the proxy and the target counters of the stats expired'''
+    ttl = psdash.config['STATS_TTL']
+    proxies_expired = stats is None or stats.loaded_at + ttl < time.time()
+    targets_expired = (stats is None or stats.targets_loaded_at is None
+                       or stats.targets_loaded_at + ttl < time.time())
+    return proxies_expired, targets_expired
+
+
+def load_stats(stats, proxies_expired):
+    '''Load the expired counters (all of them if `proxies_expired`, otherwise the
+    targets of `stats`) and make them the stats of this worker
+    The updates received meanwhile are applied to them before'''
+    global _stats, _pending
+    api = API(psdash.config['api_url'], psdash.config['api_key'])
+    page_size = psdash.config['EXPORT_PAGE_SIZE']
+    new_stats = InventoryStats() if proxies_expired else stats
+    calls = [lambda: new_stats.load_targets(api, page_size)]
+    if proxies_expired:
+        calls.append(lambda: new_stats.load_proxies(api, page_size))
+    with _stats_lock:
+        _pending = []
+    try:
+        fan_out(*calls)
+        with _stats_lock:
+            for update in _pending:
+                update(new_stats)
+            _stats = new_stats
+    finally:
+        with _stats_lock:
+            _pending = None
+    return new_stats
+
+
+def get_stats():
+    '''Return the InventoryStats of this worker, (re)loading them if they expired
+    While a request reloads them the others get the expired ones'''
+    stats = _stats
+    if not any(get_expired(stats)):
+        return stats
+    if not _load_lock.acquire(blocking=stats is None):
+        return stats
+    try:
+        stats = _stats
+        proxies_expired, targets_expired = get_expired(stats)
+        if proxies_expired or targets_expired:
+            stats = load_stats(stats, proxies_expired)
+    finally:
+        _load_lock.release()
+    return stats
+
+
+def apply_update(update):
+    '''Apply an update (a function of the stats) to the loaded stats, and to the
+    ones being loaded if any'''
+    with _stats_lock:
+        if _pending is not None:
+            _pending.append(update)
+        stats = _stats
+    if stats is not None:
+        update(stats)
+
+
+@proxy_saved.connect
+def on_proxy_saved(sender, proxy):
+    '''Apply a created/updated proxy to the loaded stats'''
+    apply_update(lambda stats: stats.add_proxy(proxy))
+
+
+@proxy_deleted.connect
+def on_proxy_deleted(sender, proxy_id):
+    '''Apply a deleted proxy to the loaded stats'''
+    apply_update(lambda stats: stats.remove_proxy(proxy_id))
+
+
+def recount_targets(stats):
+    '''Recount the target relations of the stats on the next request'''
+    stats.targets_loaded_at = None
+
+
+@target_saved.connect
+@target_deleted.connect
+def on_target_changed(sender, **kwargs):
+    '''The target relations changed, recount them on the next request'''
+    apply_update(recount_targets)
@@ -0,0 +1,47 @@
+"""
+Warm-up of the app before serving
+
+Done once in the gunicorn master when the app is preloaded, so the workers get
+the compiled templates and the cached reference data copy-on-write and their
+first request is as fast as the rest
+"""
+
+import logging
+
+from app.contrib.pool import fan_out
+from app.utils.cache import REFERENCE_ENDPOINTS
+from app.utils.cache import get_reference_data
+
+
+logger = logging.getLogger(__name__)
+
+
+def compile_templates(app):
+    '''Load (compile) all the templates in the Jinja environment cache
+    Return the number of templates'''
+    names = app.jinja_env.list_templates(extensions=('html',))
+    for name in names:
+        app.jinja_env.get_template(name)
+    return len(names)
+
+
+def load_reference_data(app):
+    '''Cache the reference lists (providers, plans, types, locations)
+    The API may be down while deploying, the lists are then loaded by the first requests'''
+    with app.app_context():
+        try:
+            fan_out(*(lambda endpoint=endpoint: get_reference_data(endpoint)
+                      for endpoint in REFERENCE_ENDPOINTS),
+                    concurrency=app.config['API_CONCURRENCY'])
+        except Exception:  # pylint: disable=broad-except
+            logger.warning('Could not load the reference data', exc_info=True)
+            return False
+    return True
+
+
+def warm_up(app):
+    '''Compile the templates and cache the reference data'''
+    templates = compile_templates(app)
+    loaded = load_reference_data(app)
+    logger.info('Warm-up: %d templates compiled, reference data %s',
+                templates, 'cached' if loaded else 'not cached')
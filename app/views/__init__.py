@@ -10,3 +10,11 @@ def register_blueprints(app):
     '''Register the blueprints'''
     app.register_blueprint(login_blueprint)
     app.register_blueprint(dashboard_blueprint)
+    if app.config['METRICS']:
+        from app.utils.metrics import init_metrics
+        from app.views.metrics import metrics_blueprint
+        init_metrics(app)
+        app.register_blueprint(metrics_blueprint)
+    if app.config['ASYNC_VIEWS']:
+        from app.views.dashboard_async import register_async_views
+        register_async_views(app)
@@ -7,19 +7,57 @@ Dashboard views
 - Locations
 - Providers
 - Stats
+- API unavailable (degraded page)
 
 """
 
+import time
+import math
+
+import httpx
+import requests
+
 from flask import Blueprint
 from flask import render_template
 from flask import request
 from flask import url_for
 from flask import redirect
+from flask import abort
+from flask import flash
+from flask import Response
+from flask import stream_with_context
 
 from flask_login import login_required
 
 from app import psdash
 from app.contrib.api import API
+from app.contrib.api import CircuitOpenError
+from app.contrib.api import get_circuit_breaker
+from app.contrib.pool import map_bounded
+from app.contrib.pool import fan_out
+from app.utils.cache import REFERENCE_ENDPOINTS
+from app.utils.cache import get_reference_data
+from app.utils.cache import invalidate_endpoint
+from app.utils.cache import get_list_page
+from app.utils.cache import prefetch_list_page
+from app.utils.importer import ProxyImporter
+from app.utils.importer import iter_file_rows
+from app.utils.importer import spool_upload
+from app.utils.live import LIVE_FIELDS
+from app.utils.live import generate_events
+from app.utils.bulk import BULK_ACTIONS
+from app.utils.bulk import BulkProxyAction
+from app.utils.export import FORMATS
+from app.utils.export import generate_export
+from app.utils.stats import get_stats
+from app.utils.search import get_index
+from app.utils.healthcheck import get_proxies_health
+from app.utils.healthcheck import get_health_summary
+from app.utils.conditional import render_conditional
+from app.utils.signals import proxy_saved
+from app.utils.signals import proxy_deleted
+from app.utils.signals import target_saved
+from app.utils.signals import target_deleted
 
 from app.models.dashboard import TargetForm
 from app.models.dashboard import ProxyForm
@@ -27,10 +65,27 @@ from app.models.dashboard import ProxyTypeForm
 from app.models.dashboard import ProxyLocationForm
 from app.models.dashboard import ProviderForm
 from app.models.dashboard import ProviderPlanForm
+from app.models.dashboard import ProxyImportForm
+from app.models.dashboard import ProxyBulkForm
 
 
 dashboard_blueprint = Blueprint('dashboard', __name__, template_folder='dashboard')
 
+# List filters: {<query string parameter>: <field>, ...}
+PROXY_FILTERS = {
+    'provider_id': 'provider_id',
+    'provider_plan_id': 'provider_plan_id',
+    'proxy_type_id': 'proxy_type_id',
+    'proxy_location_id': 'proxy_location_id',
+    'active': 'active',
+    'dont_block': 'dont_block',
+}
+TARGET_FILTERS = {
+    'provider_id': 'provider_ids',
+}
+# Filters with a "1"/"0" value, the rest are IDs
+FLAG_FILTERS = ('active', 'dont_block')
+
 
 def get_current_page_offset_limit():
     '''Given the current page and page size config it will return the offset/limit to use
@@ -45,36 +100,118 @@ def get_prev_next_page(total, current_page):
     '''Given the total of items and the current page value
     it will return the previous page and the next page'''
     page_size = psdash.config['PAGE_SIZE']
-    next_page = None if (current_page * page_size) > total else current_page + 1
+    next_page = None if (current_page * page_size) >= total else current_page + 1
     prev_page = current_page -1 if current_page > 1 else None
     return prev_page, next_page
 
 
+def get_list_filters(filters_map):
+    '''Read the search text (`q` parameter) and the filters of a list from the query string
+    Return a tuple (<text>, <filters>, <list args>)
+    - filters: a dict {<field>: <value>, ...}
+    - list args: the query string parameters to keep in the pagination links'''
+    text = request.args.get('q', '').strip()
+    filters = {}
+    list_args = {'q': text} if text else {}
+    for param, field in filters_map.items():
+        if param in FLAG_FILTERS:
+            value = request.args.get(param, '')
+            if value not in ('0', '1'):
+                continue
+            filters[field] = value == '1'
+        else:
+            value = request.args.get(param, type=int)
+            if value is None:
+                continue
+            filters[field] = value
+        list_args[param] = request.args[param]
+    return text, filters, list_args
+
+
+def get_filter_options():
+    '''The options of the proxies list filters {<parameter>: [(<id>, <name>), ...], ...}'''
+    return {
+        'provider_id': get_api_options('provider'),
+        'provider_plan_id': get_api_options('provider_plan'),
+        'proxy_type_id': get_api_options('proxy_type'),
+        'proxy_location_id': get_api_options('proxy_location'),
+    }
+
+
 def get_api_options(endpoint, id_field='id', val_field='name'):
-    '''Call the API en return a list of tuples [(<id>, <value>), ...]'''
-    api = API(psdash.config['api_url'], psdash.config['api_key'])
-    resp = api.get(endpoint)
-    return [(res[id_field], res[val_field]) for res in resp['data']]
+    '''Call the API en return a list of tuples [(<id>, <value>), ...]
+    The reference endpoints are served from the cache'''
+    if endpoint in REFERENCE_ENDPOINTS:
+        data = get_reference_data(endpoint).values()
+    else:
+        api = API(psdash.config['api_url'], psdash.config['api_key'])
+        data = api.get(endpoint)['data']
+    return [(res[id_field], res[val_field]) for res in data]
+
+
+class RelationSyncError(Exception):
+    '''Used when some of the changes to a relation could not be applied'''
+
+    def __init__(self, parent_id, failures):
+        self.parent_id = parent_id
+        self.failures = failures
+        super().__init__('Could not apply {} relation change(s) for {}: {}'.format(
+            len(failures), parent_id, '; '.join(
+                '{} {} {} ({})'.format(endpoint, action, value, error)
+                for endpoint, action, value, error in failures)))
 
 
 def update_api_relations(endpoint, parent_field, child_field, parent_id, *child_ids):
     '''Update the relations so the parent_id will be related to the all the child_ids
-    All the existing data will be wiped and replaced with this new one'''
+    Only the differences are sent: the relations to other children are deleted and the
+    missing ones are created, running the requests concurrently
+    If any of the requests fails (an exception or an error status) a RelationSyncError
+    is raised once all of them finished, with the action and the child ID of each failure
+    The existing relations are read from the API (not the cache), the endpoint is
+    invalidated after the changes'''
     api = API(psdash.config['api_url'], psdash.config['api_key'])
     params = {parent_field: parent_id}
-    resp = api.get(endpoint, **params)
+    resp = api.get(endpoint, refresh=True, **params)
+    wanted = set(child_ids)
+    existing = set()
+    # (<action>, <child ID>, <relation ID to delete>)
+    changes = []
     for data in resp['data']:
-        api.delete(endpoint, data['id'])
-    for child_id in child_ids:
+        if data[child_field] in wanted and data[child_field] not in existing:
+            existing.add(data[child_field])
+        else:
+            changes.append(('delete', data[child_field], data['id']))
+    changes.extend(('create', child_id, None) for child_id in wanted - existing)
+
+    def apply_change(change):
+        action, child_id, rel_id = change
+        if action == 'delete':
+            return api.delete(endpoint, rel_id)
         new_rel = params.copy()
         new_rel[child_field] = child_id
-        api.post(endpoint, **new_rel)
+        return api.post(endpoint, **new_rel)
+
+    try:
+        results = map_bounded(apply_change, changes, return_exceptions=True,
+                              concurrency=psdash.config['API_CONCURRENCY'])
+    finally:
+        if changes:
+            invalidate_endpoint(endpoint)
+    failures = []
+    for (action, child_id, _), result in zip(changes, results):
+        if isinstance(result, Exception):
+            failures.append((endpoint, action, child_id, result))
+        elif result.get('status') == 'error':
+            failures.append((endpoint, action, child_id, result.get('message', result)))
+    if failures:
+        raise RelationSyncError(parent_id, failures)
+
 
 def generate_related_ids(endpoint, parent_field, child_field, parent_id):
     '''Given an endpoint (relation) and a parent ID it will generate all the child IDs'''
     api = API(psdash.config['api_url'], psdash.config['api_key'])
     params = {parent_field: parent_id}
-    resp = api.get(endpoint, **params)
+    resp = api.get(endpoint, refresh=True, **params)
     for data in resp['data']:
         yield data[child_field]
 
@@ -93,6 +230,7 @@ def add_update_data(endpoint, form, *fields_map):
     else:
         # Create the new element
         api.post(endpoint, **data)
+    invalidate_endpoint(endpoint)
 
 
 def add_update_target_data(form):
@@ -111,48 +249,54 @@ def add_update_target_data(form):
         # Create the new target
         resp = api.post('target', **target_data)
         target_id = resp['data']['id']
+    invalidate_endpoint('target')
+    target_saved.send(psdash, target=dict(target_data, id=target_id),
+                      provider_ids=set(form.providers.data))
     # Update Target/Provider relations
-    update_api_relations(
-        'target_provider', 'target_id', 'provider_id', target_id, *form.providers.data)
-    update_api_relations(
-        'target_provider_plan', 'target_id', 'provider_plan_id', target_id, *form.plans.data)
+    failures = []
+    for relation, child_field, child_ids in (
+            ('target_provider', 'provider_id', form.providers.data),
+            ('target_provider_plan', 'provider_plan_id', form.plans.data)):
+        try:
+            update_api_relations(relation, 'target_id', child_field, target_id, *child_ids)
+        except RelationSyncError as exc:
+            failures.extend(exc.failures)
+    if failures:
+        raise RelationSyncError(target_id, failures)
 
 
 def add_update_proxy_data(form):
     '''Given a ProxyForm it will call the API and add the data'''
     api = API(psdash.config['api_url'], psdash.config['api_key'])
     proxy_id = form.id.data
-    proxy_data = {
-        'url': form.url.data,
-        'active': form.active.data,
-        'proxy_type_id': form.proxy_type.data,
-        'proxy_location_id': form.proxy_location.data,
-        'provider_id': form.provider.data,
-        'provider_plan_id': form.provider_plan.data,
-        'tor_control_port': form.tor_control_port.data,
-        'tor_control_pswd': form.tor_control_pswd.data,
-        'tor_renew_identity': form.tor_renew_identity.data,
-        'dont_block': form.dont_block.data,
-    }
+    proxy_data = form.api_data()
     if proxy_id:
         # It is an update
         api.put('proxy', proxy_id, **proxy_data)
     else:
         # Create the new proxy
-        api.post('proxy', **proxy_data)
+        resp = api.post('proxy', **proxy_data)
+        proxy_id = resp['data']['id']
+    invalidate_endpoint('proxy')
+    proxy_saved.send(psdash, proxy=dict(proxy_data, id=proxy_id))
 
 
 def delete_element(endpoint, elem_id):
     '''Delete an element from the API'''
     api = API(psdash.config['api_url'], psdash.config['api_key'])
     api.delete(endpoint, elem_id)
+    invalidate_endpoint(endpoint)
+    if endpoint == 'proxy':
+        proxy_deleted.send(psdash, proxy_id=elem_id)
+    elif endpoint == 'target':
+        target_deleted.send(psdash, target_id=elem_id)
 
 
 def populate_form(endpoint, form, elem_id, *fields_map):
     '''Basic funtion to populate form instance with data from the API
     Similar to add_update_data but on the contrary. See that function for more details'''
     api = API(psdash.config['api_url'], psdash.config['api_key'])
-    element = api.get(endpoint, elem_id=elem_id)['data']
+    element = api.get(endpoint, elem_id=elem_id, refresh=True)['data']
     if element:
         form.id.data = elem_id
         for api_field, form_field in fields_map:
@@ -160,24 +304,29 @@ def populate_form(endpoint, form, elem_id, *fields_map):
 
 
 def populate_target_form(form, target_id):
-    '''Given a target ID it will populate the form with the data returned from the API'''
+    '''Given a target ID it will populate the form with the data returned from the API
+    The target and its relations are requested concurrently'''
     api = API(psdash.config['api_url'], psdash.config['api_key'])
-    target = api.get('target', elem_id=target_id)['data']
+    target, provider_ids, plan_ids = fan_out(
+        lambda: api.get('target', elem_id=target_id, refresh=True)['data'],
+        lambda: set(generate_related_ids(
+            'target_provider', 'target_id', 'provider_id', target_id)),
+        lambda: set(generate_related_ids(
+            'target_provider_plan', 'target_id', 'provider_plan_id', target_id)),
+        concurrency=psdash.config['API_CONCURRENCY'])
     if target:
         form.id.data = target_id
         form.domain.data = target['domain']
         form.identifier.data = target['identifier']
         form.sleep.data = target['blocked_standby']
-        form.providers.data = set(generate_related_ids(
-            'target_provider', 'target_id', 'provider_id', target_id))
-        form.plans.data = set(generate_related_ids(
-            'target_provider_plan', 'target_id', 'provider_plan_id', target_id))
+        form.providers.data = provider_ids
+        form.plans.data = plan_ids
 
 
 def populate_proxy_form(form, proxy_id):
     '''Given a proxy ID it will populate the form with the data returned from the API'''
     api = API(psdash.config['api_url'], psdash.config['api_key'])
-    proxy = api.get('proxy', elem_id=proxy_id)['data']
+    proxy = api.get('proxy', elem_id=proxy_id, refresh=True)['data']
     if proxy:
         form.id.data = proxy_id
         form.url.data = proxy['url']
@@ -192,92 +341,252 @@ def populate_proxy_form(form, proxy_id):
         form.dont_block.data = proxy['dont_block']
 
 
-def return_paginated_list(api_endpoint):
-    '''Paginate the results of the API'''
+def return_paginated_list(api_endpoint, **query):
+    '''Paginate the results of the API
+    The next page is requested in the background so it is ready when it is asked'''
+    page, _, limit = get_current_page_offset_limit()
+    results, total = get_list_page(api_endpoint, page, limit, **query)
+    prev_page, next_page = get_prev_next_page(total, page)
+    if next_page:
+        prefetch_list_page(api_endpoint, next_page, limit, query)
+    return results, total, prev_page, next_page
+
+
+def search_paginated_list(api_endpoint, text, **filters):
+    '''Paginate the results of a search in the in-process index of the endpoint'''
     page, offset, limit = get_current_page_offset_limit()
-    api = API(psdash.config['api_url'], psdash.config['api_key'])
-    api_resp = api.get(api_endpoint, offset=offset, limit=limit)
-    total = api_resp['total']
-    results = api_resp['data']
+    index = get_index(api_endpoint)
+    ids = index.search(text, **filters)
+    total = len(ids)
+    results = index.get_rows(ids[offset:offset + limit])
     prev_page, next_page = get_prev_next_page(total, page)
     return results, total, prev_page, next_page
 
 
-def add_name_to_results(results, id_field, api_endpoint, src_field, name_field):
-    '''Add the name for an ID relation field to the results
+def return_filtered_list(api_endpoint, text, **filters):
+    '''Paginate the results of a list with a search text and filters
+    Equality filters supported by the API (SEARCH_PUSHDOWN_FIELDS config) are sent to
+    the API, the rest is answered from the in-process index'''
+    if not text and set(filters) <= psdash.config['SEARCH_PUSHDOWN_FIELDS']:
+        return return_paginated_list(api_endpoint, **filters)
+    return search_paginated_list(api_endpoint, text, **filters)
+
+
+def get_matching_elements(api_endpoint, text, **filters):
+    '''Return all the elements of a list with a search text and filters (see
+    return_filtered_list): the elements (dicts) when the filters are sent to the API,
+    only their IDs when they are answered from the in-process index
+    The elements are read from the API, not the cache: they are written back'''
+    if not text and set(filters) <= psdash.config['SEARCH_PUSHDOWN_FIELDS']:
+        api = API(psdash.config['api_url'], psdash.config['api_key'])
+        return [element for page in api.iter_pages(
+            api_endpoint, page_size=psdash.config['EXPORT_PAGE_SIZE'], refresh=True, **filters)
+                for element in page]
+    return get_index(api_endpoint).search(text, **filters)
+
+
+def get_bulk_form(plan_options=None, location_options=None):
+    '''Return the ProxyBulkForm with its choices
+    The plan and location options are requested if they are not given'''
+    form = ProxyBulkForm()
+    form.action.choices = list(BULK_ACTIONS)
+    if plan_options is None:
+        plan_options = get_api_options('provider_plan')
+    if location_options is None:
+        location_options = get_api_options('proxy_location')
+    form.provider_plan.choices = [(0, '')] + plan_options
+    form.proxy_location.choices = [(0, '')] + location_options
+    return form
+
+
+def fetch_elements(*keys):
+    '''Fetch the elements for the given (<endpoint>, <id>) keys from the API
+    The elements of the reference endpoints are taken from the cache, the rest are
+    requested once each, running the requests concurrently (bounded by the
+    API_CONCURRENCY config)
+    Return a dict {(<endpoint>, <id>): <data>, ...}'''
+    elements = {}
+    missing = []
+    for key in set(keys):
+        endpoint, elem_id = key
+        if endpoint in REFERENCE_ENDPOINTS:
+            element = get_reference_data(endpoint).get(elem_id)
+            if element is not None:
+                elements[key] = element
+                continue
+        missing.append(key)
+    api = API(psdash.config['api_url'], psdash.config['api_key'])
+    fetched = map_bounded(lambda key: api.get(key[0], elem_id=key[1])['data'], missing,
+                          concurrency=psdash.config['API_CONCURRENCY'])
+    elements.update(zip(missing, fetched))
+    return elements
+
+
+def export_response(api_endpoint, name):
+    '''Stream the export of all the elements of an endpoint
+    The format is given by the `format` query parameter (csv or jsonl)'''
+    export_format = request.args.get('format', 'csv')
+    if export_format not in FORMATS:
+        return abort(400)
+    api = API(psdash.config['api_url'], psdash.config['api_key'])
+    chunks = generate_export(api, api_endpoint, export_format,
+                             page_size=psdash.config['EXPORT_PAGE_SIZE'])
+    headers = {'Content-Disposition': 'attachment; filename={}.{}'.format(name, export_format)}
+    return Response(stream_with_context(chunks), mimetype=FORMATS[export_format],
+                    headers=headers)
+
+
+def add_names_to_results(results, *relations):
+    '''Add the name for ID relation fields to the results
     For example:
 
     results = [{'row_id': 1}, {'row_id': 2}]
 
-    add_name_to_results(results, 'row_id', 'rows', 'name', 'row_name')
+    add_names_to_results(results, ('row_id', 'rows', 'name', 'row_name'))
 
     results = [{'row_id': 1, 'row_name': 'Row 1'}, {'row_id': 2, 'row_name': 'Row 2'}]
 
+    The distinct IDs of all the relations are collected first and every related object
+    is requested only once, so the number of API calls depends on the number of
+    different related objects and not on the number of results
+
     @param results: the list of results
-    @id_field: the key of the object in the results that is the ID for the relation
-    @api_endpoint: the endpoint to call for asking the related object
-    @src_field: the field I want to add its value to the result object
-    @name_field: the name of the new field to be added to the result'''
-    api = API(psdash.config['api_url'], psdash.config['api_key'])
-    for result in results:
-        src_id = result[id_field]
-        if src_id is not None:
-            resp = api.get(api_endpoint, elem_id=src_id)
-            result[name_field] = resp['data'][src_field]
-        else:
-            result[name_field] = ''
+    @relations: a list of tuples (<id_field>, <api_endpoint>, <src_field>, <name_field>)
+    - id_field: the key of the object in the results that is the ID for the relation
+    - api_endpoint: the endpoint to call for asking the related object
+    - src_field: the field I want to add its value to the result object
+    - name_field: the name of the new field to be added to the result'''
+    keys = {(api_endpoint, result[id_field])
+            for id_field, api_endpoint, _, _ in relations
+            for result in results if result[id_field] is not None}
+    elements = fetch_elements(*keys)
+    for id_field, api_endpoint, src_field, name_field in relations:
+        for result in results:
+            element = elements.get((api_endpoint, result[id_field]))
+            result[name_field] = element[src_field] if element else ''
 
 
 @dashboard_blueprint.route('/dashboard', methods=['GET'])
 @login_required
 def dashboard():
     '''The main Dashboard'''
-    return render_template('dashboard/dashboard.html')
+    return render_conditional('dashboard/dashboard.html')
 
 
 @dashboard_blueprint.route('/targets', methods=['GET'])
 @login_required
 def targets():
     '''The Targets page'''
-    results, total, prev_page, next_page = return_paginated_list('target')
-    return render_template('dashboard/targets.html',
-                           results=results, total=total,
-                           prev_page=prev_page, next_page=next_page)
+    text, filters, list_args = get_list_filters(TARGET_FILTERS)
+    results, total, prev_page, next_page = return_filtered_list('target', text, **filters)
+    return render_conditional('dashboard/targets.html',
+                              results=results, total=total,
+                              prev_page=prev_page, next_page=next_page,
+                              list_args=list_args, providers=get_api_options('provider'))
 
 
+@dashboard_blueprint.route('/live/<api_endpoint>', methods=['GET'])
+@login_required
+def live_events(api_endpoint):
+    '''Stream the changes of the proxies or targets (Server-Sent Events)'''
+    if api_endpoint not in LIVE_FIELDS or not psdash.config['LIVE_UPDATES']:
+        return abort(404)
+    events = generate_events(api_endpoint, keepalive=psdash.config['LIVE_KEEPALIVE'])
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    return Response(stream_with_context(events), mimetype='text/event-stream',
+                    headers=headers)
+
+
+@dashboard_blueprint.route('/targets/export', methods=['GET'])
+@login_required
+def targets_export():
+    '''Export all the targets'''
+    return export_response('target', 'targets')
+
 
 @dashboard_blueprint.route('/target/edit', methods=['GET', 'POST'])
 @login_required
 def target_edit():
     '''Add/Edit/Remove a target'''
     form = TargetForm()
-    form.providers.choices = get_api_options('provider')
-    form.plans.choices = get_api_options('provider_plan')
+    elem_id = abs(request.args.get('id', 0, type=int))
+    # The options and the target data do not depend on each other
+    calls = [lambda: get_api_options('provider'), lambda: get_api_options('provider_plan')]
+    if elem_id and not form.is_submitted():
+        calls.append(lambda: populate_target_form(form, elem_id))
+    form.providers.choices, form.plans.choices = fan_out(
+        *calls, concurrency=psdash.config['API_CONCURRENCY'])[:2]
     if form.validate_on_submit():
         delete_flag = request.args.get('delete')
         if delete_flag:
             delete_element('target', form.id.data)
         else:
-            add_update_target_data(form)
+            try:
+                add_update_target_data(form)
+            except RelationSyncError as exc:
+                flash(str(exc), 'danger')
+                return redirect(url_for('dashboard.target_edit', id=exc.parent_id))
         return redirect(url_for('dashboard.targets'))
-    elem_id = abs(request.args.get('id', 0, type=int))
-    if elem_id:
+    if elem_id and form.is_submitted():
+        # Invalid submission: reload the stored data
         populate_target_form(form, elem_id)
-    return render_template('dashboard/target_edit.html', form=form)
+    return render_conditional('dashboard/target_edit.html', form=form)
 
 
 @dashboard_blueprint.route('/proxies', methods=['GET'])
 @login_required
 def proxies():
     '''The Proxies page'''
-    results, total, prev_page, next_page = return_paginated_list('proxy')
-    add_name_to_results(results, 'proxy_type_id', 'proxy_type', 'name', 'type')
-    add_name_to_results(results, 'proxy_location_id', 'proxy_location', 'name', 'location')
-    add_name_to_results(results, 'provider_id', 'provider', 'name', 'provider')
-    add_name_to_results(results, 'provider_plan_id', 'provider_plan', 'name', 'plan')
-    return render_template('dashboard/proxies.html',
-                           results=results, total=total,
-                           prev_page=prev_page, next_page=next_page)
+    text, filters, list_args = get_list_filters(PROXY_FILTERS)
+    results, total, prev_page, next_page = return_filtered_list('proxy', text, **filters)
+    add_names_to_results(results,
+                         ('proxy_type_id', 'proxy_type', 'name', 'type'),
+                         ('proxy_location_id', 'proxy_location', 'name', 'location'),
+                         ('provider_id', 'provider', 'name', 'provider'),
+                         ('provider_plan_id', 'provider_plan', 'name', 'plan'))
+    health = get_proxies_health([result['id'] for result in results])
+    filter_options = get_filter_options()
+    return render_conditional('dashboard/proxies.html',
+                              results=results, total=total,
+                              prev_page=prev_page, next_page=next_page,
+                              list_args=list_args, filter_options=filter_options,
+                              health=health, bulk_form=get_bulk_form(
+                                  filter_options['provider_plan_id'],
+                                  filter_options['proxy_location_id']))
+
+
+@dashboard_blueprint.route('/proxies/bulk', methods=['POST'])
+@login_required
+def proxies_bulk():
+    '''Apply an action to the selected proxies, or to all the proxies matching the
+    filters of the list (in the query string). The report is streamed while the
+    proxies are updated'''
+    form = get_bulk_form()
+    text, filters, list_args = get_list_filters(PROXY_FILTERS)
+    if not form.validate_on_submit():
+        for errors in form.errors.values():
+            for error in errors:
+                flash(error, 'danger')
+        return redirect(url_for('dashboard.proxies', **list_args))
+    if form.all_matching.data:
+        proxies_list = get_matching_elements('proxy', text, **filters)
+    else:
+        proxies_list = form.ids.data
+    value = {'plan': form.provider_plan.data,
+             'location': form.proxy_location.data}.get(form.action.data)
+    api = API(psdash.config['api_url'], psdash.config['api_key'])
+    bulk = BulkProxyAction(api, form.action.data, value,
+                           concurrency=psdash.config['BULK_CONCURRENCY'])
+    report = bulk.run(proxies_list)
+    return Response(stream_with_context(line + '\n' for line in report),
+                    mimetype='text/plain')
+
+
+@dashboard_blueprint.route('/proxies/export', methods=['GET'])
+@login_required
+def proxies_export():
+    '''Export all the proxies'''
+    return export_response('proxy', 'proxies')
 
 
 @dashboard_blueprint.route('/proxy/edit', methods=['GET', 'POST'])
@@ -285,10 +594,17 @@ def proxies():
 def proxy_edit():
     '''Add/Edit/Remove a proxy'''
     form = ProxyForm()
-    form.proxy_type.choices = get_api_options('proxy_type')
-    form.proxy_location.choices = get_api_options('proxy_location')
-    form.provider.choices = get_api_options('provider')
-    form.provider_plan.choices = get_api_options('provider_plan')
+    elem_id = abs(request.args.get('id', 0, type=int))
+    # The options and the proxy data do not depend on each other
+    calls = [lambda: get_api_options('proxy_type'),
+             lambda: get_api_options('proxy_location'),
+             lambda: get_api_options('provider'),
+             lambda: get_api_options('provider_plan')]
+    if elem_id and not form.is_submitted():
+        calls.append(lambda: populate_proxy_form(form, elem_id))
+    (form.proxy_type.choices, form.proxy_location.choices,
+     form.provider.choices, form.provider_plan.choices) = fan_out(
+         *calls, concurrency=psdash.config['API_CONCURRENCY'])[:4]
     if form.validate_on_submit():
         delete_flag = request.args.get('delete')
         if delete_flag:
@@ -296,10 +612,37 @@ def proxy_edit():
         else:
             add_update_proxy_data(form)
         return redirect(url_for('dashboard.proxies'))
-    elem_id = abs(request.args.get('id', 0, type=int))
-    if elem_id:
+    if elem_id and form.is_submitted():
+        # Invalid submission: reload the stored data
         populate_proxy_form(form, elem_id)
-    return render_template('dashboard/proxy_edit.html', form=form)
+    return render_conditional('dashboard/proxy_edit.html', form=form)
+
+
+@dashboard_blueprint.route('/proxies/import', methods=['GET', 'POST'])
+@login_required
+def proxies_import():
+    '''Bulk import of proxies from a CSV file or a list of URLs
+    The import report is streamed while the proxies are created'''
+    form = ProxyImportForm()
+    options = fan_out(lambda: get_api_options('proxy_type'),
+                      lambda: get_api_options('proxy_location'),
+                      lambda: get_api_options('provider'),
+                      lambda: get_api_options('provider_plan'),
+                      concurrency=psdash.config['API_CONCURRENCY'])
+    fields = (form.proxy_type, form.proxy_location, form.provider, form.provider_plan)
+    for field, choices in zip(fields, options):
+        field.choices = [(0, '')] + choices
+    if form.validate_on_submit():
+        defaults = {field.name: field.data or None for field in fields}
+        defaults['active'] = form.active.data
+        api = API(psdash.config['api_url'], psdash.config['api_key'])
+        importer = ProxyImporter(api, defaults,
+                                 batch_size=psdash.config['IMPORT_BATCH_SIZE'],
+                                 concurrency=psdash.config['API_CONCURRENCY'])
+        report = importer.run(iter_file_rows(spool_upload(form.file.data)))
+        return Response(stream_with_context(line + '\n' for line in report),
+                        mimetype='text/plain')
+    return render_template('dashboard/proxy_import.html', form=form)
 
 
 @dashboard_blueprint.route('/types', methods=['GET'])
@@ -307,9 +650,9 @@ def proxy_edit():
 def types():
     '''The Proxy Types page'''
     results, total, prev_page, next_page = return_paginated_list('proxy_type')
-    return render_template('dashboard/types.html',
-                           results=results, total=total,
-                           prev_page=prev_page, next_page=next_page)
+    return render_conditional('dashboard/types.html',
+                              results=results, total=total,
+                              prev_page=prev_page, next_page=next_page)
 
 
 @dashboard_blueprint.route('/type/edit', methods=['GET', 'POST'])
@@ -327,7 +670,7 @@ def type_edit():
     elem_id = abs(request.args.get('id', 0, type=int))
     if elem_id:
         populate_form('proxy_type', form, elem_id, *[('name', 'name'), ('code', 'code')])
-    return render_template('dashboard/type_edit.html', form=form)
+    return render_conditional('dashboard/type_edit.html', form=form)
 
 
 @dashboard_blueprint.route('/locations', methods=['GET'])
@@ -335,9 +678,9 @@ def type_edit():
 def locations():
     '''The Locations page'''
     results, total, prev_page, next_page = return_paginated_list('proxy_location')
-    return render_template('dashboard/locations.html',
-                           results=results, total=total,
-                           prev_page=prev_page, next_page=next_page)
+    return render_conditional('dashboard/locations.html',
+                              results=results, total=total,
+                              prev_page=prev_page, next_page=next_page)
 
 
 @dashboard_blueprint.route('/location/edit', methods=['GET', 'POST'])
@@ -355,7 +698,7 @@ def location_edit():
     elem_id = abs(request.args.get('id', 0, type=int))
     if elem_id:
         populate_form('proxy_location', form, elem_id, *[('name', 'name'), ('code', 'code')])
-    return render_template('dashboard/location_edit.html', form=form)
+    return render_conditional('dashboard/location_edit.html', form=form)
 
 
 @dashboard_blueprint.route('/providers', methods=['GET'])
@@ -363,9 +706,9 @@ def location_edit():
 def providers():
     '''The Providers page'''
     results, total, prev_page, next_page = return_paginated_list('provider')
-    return render_template('dashboard/providers.html',
-                           results=results, total=total,
-                           prev_page=prev_page, next_page=next_page)
+    return render_conditional('dashboard/providers.html',
+                              results=results, total=total,
+                              prev_page=prev_page, next_page=next_page)
 
 
 @dashboard_blueprint.route('/provider/edit', methods=['GET', 'POST'])
@@ -385,7 +728,7 @@ def provider_edit():
     if elem_id:
         populate_form('provider', form, elem_id,
                       *[('name', 'name'), ('url', 'url'), ('code', 'code')])
-    return render_template('dashboard/provider_edit.html', form=form)
+    return render_conditional('dashboard/provider_edit.html', form=form)
 
 
 @dashboard_blueprint.route('/plans', methods=['GET'])
@@ -393,10 +736,17 @@ def provider_edit():
 def plans():
     '''The Providers page'''
     results, total, prev_page, next_page = return_paginated_list('provider_plan')
-    add_name_to_results(results, 'provider_id', 'provider', 'name', 'provider')
-    return render_template('dashboard/plans.html',
-                           results=results, total=total,
-                           prev_page=prev_page, next_page=next_page)
+    add_names_to_results(results, ('provider_id', 'provider', 'name', 'provider'))
+    return render_conditional('dashboard/plans.html',
+                              results=results, total=total,
+                              prev_page=prev_page, next_page=next_page)
+
+
+@dashboard_blueprint.route('/plans/export', methods=['GET'])
+@login_required
+def plans_export():
+    '''Export all the provider plans'''
+    return export_response('provider_plan', 'plans')
 
 
 @dashboard_blueprint.route('/plan/edit', methods=['GET', 'POST'])
@@ -404,7 +754,14 @@ def plans():
 def plan_edit():
     '''Add/Edit/Remove a proxy provider plan'''
     form = ProviderPlanForm()
-    form.provider.choices = get_api_options('provider')
+    elem_id = abs(request.args.get('id', 0, type=int))
+    # The options and the plan data do not depend on each other
+    calls = [lambda: get_api_options('provider')]
+    if elem_id and not form.is_submitted():
+        calls.append(lambda: populate_form(
+            'provider_plan', form, elem_id,
+            *[('provider_id', 'provider'), ('name', 'name'), ('code', 'code')]))
+    form.provider.choices = fan_out(*calls, concurrency=psdash.config['API_CONCURRENCY'])[0]
     if form.validate_on_submit():
         delete_flag = request.args.get('delete')
         if delete_flag:
@@ -413,15 +770,57 @@ def plan_edit():
             add_update_data('provider_plan', form,
                             *[('provider_id', 'provider'), ('name', 'name'), ('code', 'code')])
         return redirect(url_for('dashboard.plans'))
-    elem_id = abs(request.args.get('id', 0, type=int))
-    if elem_id:
+    if elem_id and form.is_submitted():
+        # Invalid submission: reload the stored data
         populate_form('provider_plan', form, elem_id,
                       *[('provider_id', 'provider'), ('name', 'name'), ('code', 'code')])
-    return render_template('dashboard/plan_edit.html', form=form)
+    return render_conditional('dashboard/plan_edit.html', form=form)
 
 
 @dashboard_blueprint.route('/stats', methods=['GET'])
 @login_required
 def stats():
-    '''The Targets page'''
-    return render_template('dashboard/stats.html')
+    '''The Stats page'''
+    inventory = get_stats()
+    names = {endpoint: {elem_id: element['name'] for elem_id, element
+                        in get_reference_data(endpoint).items()}
+             for endpoint in REFERENCE_ENDPOINTS}
+    breakdowns = [
+        (title, [(names[endpoint].get(value, value), count)
+                 for value, count in inventory.counts(field)])
+        for title, field, endpoint in (
+            ('Provider', 'provider_id', 'provider'),
+            ('Plan', 'provider_plan_id', 'provider_plan'),
+            ('Type', 'proxy_type_id', 'proxy_type'),
+            ('Location', 'proxy_location_id', 'proxy_location'))]
+    active = dict(inventory.counts('active'))
+    dont_block = dict(inventory.counts('dont_block'))
+    target_providers = [(names['provider'].get(value, value), count)
+                        for value, count in inventory.target_providers.most_common()]
+    return render_conditional('dashboard/stats.html',
+                              total=inventory.total,
+                              loaded_at=time.strftime('%Y-%m-%d %H:%M:%S',
+                                                      time.localtime(inventory.loaded_at)),
+                              breakdowns=breakdowns,
+                              active=active.get(True, 0), inactive=active.get(False, 0),
+                              dont_block=dont_block.get(True, 0),
+                              target_providers=target_providers,
+                              health=get_health_summary())
+
+
+@dashboard_blueprint.app_errorhandler(requests.exceptions.ConnectionError)
+@dashboard_blueprint.app_errorhandler(requests.exceptions.Timeout)
+@dashboard_blueprint.app_errorhandler(httpx.TransportError)
+def api_unavailable(error):
+    '''The API failed or is too slow (or its circuit breaker is open): a page telling
+    it is unavailable instead of an error. httpx.TransportError are the ones of the
+    async views (see app.contrib.async_api)'''
+    breaker = get_circuit_breaker()
+    if isinstance(error, CircuitOpenError):
+        retry_after = math.ceil(error.retry_after)
+    else:
+        retry_after = breaker.reset_timeout if breaker is not None else 30
+    body = render_template('dashboard/degraded.html', retry_after=retry_after,
+                           circuit=breaker.state if breaker is not None else None,
+                           error=error.__class__.__name__)
+    return body, 503, {'Retry-After': str(max(1, retry_after))}
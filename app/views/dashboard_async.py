@@ -0,0 +1,288 @@
+"""
+Async dashboard views
+
+Async versions of the heaviest dashboard views, built on AsyncAPI:
+
+- Proxies
+- Targets
+- Proxy edit
+- Target edit
+
+They replace the sync views when `async_views` is enabled in the config
+The writes reuse the sync helpers, run in a thread to keep the event loop free
+"""
+
+import asyncio
+import functools
+import contextvars
+
+from flask import request
+from flask import url_for
+from flask import redirect
+from flask import flash
+
+from flask_login import login_required
+
+from app import psdash
+from app.contrib.async_api import AsyncAPI
+from app.contrib.async_api import client_scope
+from app.contrib.async_api import gather_bounded
+from app.utils.cache import REFERENCE_ENDPOINTS
+from app.utils.cache import reference_cache
+
+from app.models.dashboard import TargetForm
+from app.models.dashboard import ProxyForm
+
+from app.views.dashboard import get_current_page_offset_limit
+from app.views.dashboard import get_prev_next_page
+from app.views.dashboard import add_update_target_data
+from app.views.dashboard import add_update_proxy_data
+from app.views.dashboard import delete_element
+from app.views.dashboard import RelationSyncError
+from app.views.dashboard import PROXY_FILTERS
+from app.views.dashboard import TARGET_FILTERS
+from app.views.dashboard import get_list_filters
+from app.views.dashboard import get_bulk_form
+from app.utils.healthcheck import get_proxies_health
+from app.utils.conditional import render_conditional
+from app.views.dashboard import return_filtered_list as sync_return_filtered_list
+
+
+def get_async_api():
+    '''Return an AsyncAPI client for the configured API'''
+    return AsyncAPI(psdash.config['api_url'], psdash.config['api_key'])
+
+
+async def run_in_thread(func, *args, **kwargs):
+    '''Run a sync function in the default executor, in a copy of the current context
+    (the app context), like asyncio.to_thread (Python 3.9+) does'''
+    loop = asyncio.get_running_loop()
+    call = functools.partial(contextvars.copy_context().run, func, *args, **kwargs)
+    return await loop.run_in_executor(None, call)
+
+
+async def gather(*aws):
+    '''gather_bounded with the API_CONCURRENCY config'''
+    return await gather_bounded(*aws, concurrency=psdash.config['API_CONCURRENCY'])
+
+
+async def get_reference_data(api, endpoint):
+    '''Async version of app.utils.cache.get_reference_data (same cache)'''
+    elements = reference_cache.get(endpoint)
+    if elements is None:
+        resp = await api.get(endpoint)
+        elements = {element['id']: element for element in resp['data']}
+        reference_cache.set(endpoint, elements)
+    return elements
+
+
+async def get_api_options(api, endpoint, id_field='id', val_field='name'):
+    '''Async version of get_api_options'''
+    if endpoint in REFERENCE_ENDPOINTS:
+        data = (await get_reference_data(api, endpoint)).values()
+    else:
+        data = (await api.get(endpoint))['data']
+    return [(res[id_field], res[val_field]) for res in data]
+
+
+async def get_related_ids(api, endpoint, parent_field, child_field, parent_id):
+    '''Given an endpoint (relation) and a parent ID return the set of child IDs'''
+    params = {parent_field: parent_id}
+    resp = await api.get(endpoint, refresh=True, **params)
+    return {data[child_field] for data in resp['data']}
+
+
+async def fetch_elements(api, *keys):
+    '''Async version of fetch_elements'''
+    elements = {}
+    missing = []
+    for key in set(keys):
+        endpoint, elem_id = key
+        if endpoint in REFERENCE_ENDPOINTS:
+            element = (await get_reference_data(api, endpoint)).get(elem_id)
+            if element is not None:
+                elements[key] = element
+                continue
+        missing.append(key)
+    fetched = await gather(*(api.get(endpoint, elem_id=elem_id) for endpoint, elem_id in missing))
+    elements.update(zip(missing, (resp['data'] for resp in fetched)))
+    return elements
+
+
+async def add_names_to_results(api, results, *relations):
+    '''Async version of add_names_to_results'''
+    keys = {(api_endpoint, result[id_field])
+            for id_field, api_endpoint, _, _ in relations
+            for result in results if result[id_field] is not None}
+    elements = await fetch_elements(api, *keys)
+    for id_field, api_endpoint, src_field, name_field in relations:
+        for result in results:
+            element = elements.get((api_endpoint, result[id_field]))
+            result[name_field] = element[src_field] if element else ''
+
+
+async def return_paginated_list(api, api_endpoint):
+    '''Async version of return_paginated_list'''
+    page, offset, limit = get_current_page_offset_limit()
+    api_resp = await api.get(api_endpoint, offset=offset, limit=limit)
+    total = api_resp['total']
+    results = api_resp['data']
+    prev_page, next_page = get_prev_next_page(total, page)
+    return results, total, prev_page, next_page
+
+
+async def populate_target_form(api, form, target_id):
+    '''Async version of populate_target_form'''
+    target, provider_ids, plan_ids = await gather(
+        api.get('target', elem_id=target_id, refresh=True),
+        get_related_ids(api, 'target_provider', 'target_id', 'provider_id', target_id),
+        get_related_ids(api, 'target_provider_plan', 'target_id', 'provider_plan_id', target_id))
+    target = target['data']
+    if target:
+        form.id.data = target_id
+        form.domain.data = target['domain']
+        form.identifier.data = target['identifier']
+        form.sleep.data = target['blocked_standby']
+        form.providers.data = provider_ids
+        form.plans.data = plan_ids
+
+
+async def populate_proxy_form(api, form, proxy_id):
+    '''Async version of populate_proxy_form'''
+    proxy = (await api.get('proxy', elem_id=proxy_id, refresh=True))['data']
+    if proxy:
+        form.id.data = proxy_id
+        form.url.data = proxy['url']
+        form.active.data = proxy['active']
+        form.proxy_type.data = proxy['proxy_type_id']
+        form.proxy_location.data = proxy['proxy_location_id']
+        form.provider.data = proxy['provider_id']
+        form.provider_plan.data = proxy['provider_plan_id']
+        form.tor_control_port.data = proxy['tor_control_port']
+        form.tor_control_pswd.data = proxy['tor_control_pswd']
+        form.tor_renew_identity.data = proxy['tor_renew_identity']
+        form.dont_block.data = proxy['dont_block']
+
+
+async def return_filtered_list(api, api_endpoint, text, **filters):
+    '''Async version of return_filtered_list
+    The searches in the in-process index run in a thread'''
+    if not text and not filters:
+        return await return_paginated_list(api, api_endpoint)
+    return await run_in_thread(sync_return_filtered_list, api_endpoint, text, **filters)
+
+
+async def targets():
+    '''The Targets page'''
+    api = get_async_api()
+    text, filters, list_args = get_list_filters(TARGET_FILTERS)
+    (results, total, prev_page, next_page), providers = await gather(
+        return_filtered_list(api, 'target', text, **filters),
+        get_api_options(api, 'provider'))
+    return render_conditional('dashboard/targets.html',
+                              results=results, total=total,
+                              prev_page=prev_page, next_page=next_page,
+                              list_args=list_args, providers=providers)
+
+
+async def target_edit():
+    '''Add/Edit/Remove a target'''
+    api = get_async_api()
+    form = TargetForm()
+    elem_id = abs(request.args.get('id', 0, type=int))
+    calls = [get_api_options(api, 'provider'), get_api_options(api, 'provider_plan')]
+    if elem_id and not form.is_submitted():
+        calls.append(populate_target_form(api, form, elem_id))
+    form.providers.choices, form.plans.choices = (await gather(*calls))[:2]
+    if form.validate_on_submit():
+        delete_flag = request.args.get('delete')
+        if delete_flag:
+            await run_in_thread(delete_element, 'target', form.id.data)
+        else:
+            try:
+                await run_in_thread(add_update_target_data, form)
+            except RelationSyncError as exc:
+                flash(str(exc), 'danger')
+                return redirect(url_for('dashboard.target_edit', id=exc.parent_id))
+        return redirect(url_for('dashboard.targets'))
+    if elem_id and form.is_submitted():
+        # Invalid submission: reload the stored data
+        await populate_target_form(api, form, elem_id)
+    return render_conditional('dashboard/target_edit.html', form=form)
+
+
+async def proxies():
+    '''The Proxies page'''
+    api = get_async_api()
+    text, filters, list_args = get_list_filters(PROXY_FILTERS)
+    results, total, prev_page, next_page = await return_filtered_list(
+        api, 'proxy', text, **filters)
+    await add_names_to_results(api, results,
+                               ('proxy_type_id', 'proxy_type', 'name', 'type'),
+                               ('proxy_location_id', 'proxy_location', 'name', 'location'),
+                               ('provider_id', 'provider', 'name', 'provider'),
+                               ('provider_plan_id', 'provider_plan', 'name', 'plan'))
+    options = await gather(*(get_api_options(api, endpoint) for endpoint in
+                             ('provider', 'provider_plan', 'proxy_type', 'proxy_location')))
+    filter_options = dict(zip(('provider_id', 'provider_plan_id', 'proxy_type_id',
+                               'proxy_location_id'), options))
+    health = get_proxies_health([result['id'] for result in results])
+    return render_conditional('dashboard/proxies.html',
+                              results=results, total=total,
+                              prev_page=prev_page, next_page=next_page,
+                              list_args=list_args, filter_options=filter_options,
+                              health=health, bulk_form=get_bulk_form(
+                                  filter_options['provider_plan_id'],
+                                  filter_options['proxy_location_id']))
+
+
+async def proxy_edit():
+    '''Add/Edit/Remove a proxy'''
+    api = get_async_api()
+    form = ProxyForm()
+    elem_id = abs(request.args.get('id', 0, type=int))
+    calls = [get_api_options(api, 'proxy_type'),
+             get_api_options(api, 'proxy_location'),
+             get_api_options(api, 'provider'),
+             get_api_options(api, 'provider_plan')]
+    if elem_id and not form.is_submitted():
+        calls.append(populate_proxy_form(api, form, elem_id))
+    (form.proxy_type.choices, form.proxy_location.choices,
+     form.provider.choices, form.provider_plan.choices) = (await gather(*calls))[:4]
+    if form.validate_on_submit():
+        delete_flag = request.args.get('delete')
+        if delete_flag:
+            await run_in_thread(delete_element, 'proxy', form.id.data)
+        else:
+            await run_in_thread(add_update_proxy_data, form)
+        return redirect(url_for('dashboard.proxies'))
+    if elem_id and form.is_submitted():
+        # Invalid submission: reload the stored data
+        await populate_proxy_form(api, form, elem_id)
+    return render_conditional('dashboard/proxy_edit.html', form=form)
+
+
+ASYNC_VIEWS = {
+    'dashboard.targets': targets,
+    'dashboard.target_edit': target_edit,
+    'dashboard.proxies': proxies,
+    'dashboard.proxy_edit': proxy_edit,
+}
+
+
+def with_client_scope(view):
+    '''Run an async view in a client_scope: its API client is closed when it returns'''
+
+    @functools.wraps(view)
+    async def scoped_view(*args, **kwargs):
+        async with client_scope():
+            return await view(*args, **kwargs)
+
+    return scoped_view
+
+
+def register_async_views(app):
+    '''Replace the sync dashboard views with the async ones
+    The dashboard blueprint must be registered first'''
+    for endpoint, view in ASYNC_VIEWS.items():
+        app.view_functions[endpoint] = login_required(with_client_scope(view))
@@ -17,6 +17,7 @@ from flask_login import logout_user
 from flask_login import login_required
 
 from app.utils.url import is_safe_url
+from app.utils.passwords import PasswordHashingBusy
 from app.models.users import User
 from app.models.users import LoginForm
 
@@ -29,7 +30,11 @@ def login():
     '''Log a User in'''
     form = LoginForm()
     if form.validate_on_submit():
-        user = User.login(form)
+        try:
+            user = User.login(form)
+        except PasswordHashingBusy:
+            return render_template('login/login.html', form=form, busy=True), 503, {
+                'Retry-After': '5'}
         if user is not None:
             login_user(user)
             next_url = request.args.get('next', url_for('dashboard.dashboard'))
@@ -0,0 +1,61 @@
+"""
+Metrics views
+
+- Metrics (Prometheus format), for the logged in users, a bearer token or the
+  allowed addresses (METRICS_TOKEN and METRICS_ALLOW config)
+"""
+
+import os
+import hmac
+import ipaddress
+
+from flask import Blueprint
+from flask import Response
+from flask import abort
+from flask import request
+from flask_login import current_user
+
+from prometheus_client import CONTENT_TYPE_LATEST
+from prometheus_client import REGISTRY
+from prometheus_client import CollectorRegistry
+from prometheus_client import generate_latest
+from prometheus_client import multiprocess
+
+from app import psdash
+
+
+metrics_blueprint = Blueprint('metrics', __name__)
+
+
+def is_allowed_address(address, allowed):
+    '''Return whether an IP address is one of the allowed addresses/networks'''
+    try:
+        address = ipaddress.ip_address(address or '')
+    except ValueError:
+        return False
+    return any(address in ipaddress.ip_network(network, strict=False) for network in allowed)
+
+
+@metrics_blueprint.before_request
+def check_access():
+    '''Only the logged in users, the token and the allowed addresses read the metrics'''
+    token = psdash.config['METRICS_TOKEN']
+    if token and hmac.compare_digest(request.headers.get('Authorization', '').encode('utf-8'),
+                                     'Bearer {}'.format(token).encode('utf-8')):
+        return None
+    if is_allowed_address(request.remote_addr, psdash.config['METRICS_ALLOW']):
+        return None
+    if current_user.is_authenticated:
+        return None
+    return abort(401 if token else 403)
+
+
+@metrics_blueprint.route('/metrics', methods=['GET'])
+def metrics():
+    '''The metrics of all the workers in the Prometheus text format'''
+    if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), headers={'Content-Type': CONTENT_TYPE_LATEST})
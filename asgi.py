@@ -0,0 +1,9 @@
+"""
+To use with an ASGI server (for example Gunicorn with uvicorn workers)
+"""
+
+from asgiref.wsgi import WsgiToAsgi
+
+from wsgi import application as wsgi_application
+
+application = WsgiToAsgi(wsgi_application)
@@ -1,7 +1,12 @@
 """gunicorn WSGI server configuration."""
 
+import gc
+import os
+import shutil
+import tempfile
 from multiprocessing import cpu_count
 from os import environ
+from os import makedirs
 
 
 def max_workers():
@@ -12,7 +17,71 @@ def max_workers():
 bind = 'unix:/tmp/psdash.sock'
 umask = 7
 max_requests = 1000
-worker_class = 'gevent'
+# Do not recycle all the workers at the same time
+max_requests_jitter = 100
+# Use WORKER_CLASS=uvicorn.workers.UvicornWorker with asgi:application to run
+# the async views without gevent monkey-patching
+worker_class = environ.get('WORKER_CLASS', 'gevent')
 workers = max_workers()
 accesslog = 'gunicorn_access.log'
 errorlog = 'gunicorn_error.log'
+
+# Load the app (imports, templates, reference data) once in the master, the
+# workers are forked with it, so starting or recycling a worker is cheap
+preload_app = environ.get('PRELOAD_APP', '1') == '1'
+
+if preload_app and worker_class == 'gevent':
+    # The app is imported before forking: patch before it imports ssl/socket
+    from gevent import monkey
+    monkey.patch_all()
+
+
+def private_dir(path):
+    '''Create a directory only this user can read (and its parent), raise
+    PermissionError if it belongs to another user'''
+    makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    makedirs(path, mode=0o700, exist_ok=True)
+    if os.path.islink(path) or os.stat(path).st_uid != os.getuid():
+        raise PermissionError('Unsafe metrics directory: {}'.format(path))
+    os.chmod(path, 0o700)
+
+
+def clear_dir(path):
+    '''Remove the contents of a directory (not the directory itself)'''
+    for entry in os.scandir(path):
+        if entry.is_dir(follow_symlinks=False):
+            shutil.rmtree(entry.path)
+        else:
+            os.unlink(entry.path)
+
+
+# The Prometheus metrics of every worker are written to this private directory
+# and aggregated by the /metrics view. It must be set before the app is imported
+# and it starts with no metrics from previous runs
+environ.setdefault('PROMETHEUS_MULTIPROC_DIR', os.path.join(
+    tempfile.gettempdir(), 'psdash-{}'.format(os.getuid()), 'metrics'))
+private_dir(environ['PROMETHEUS_MULTIPROC_DIR'])
+clear_dir(environ['PROMETHEUS_MULTIPROC_DIR'])
+
+
+def when_ready(server):
+    '''The app is loaded: move its objects out of the GC generations so they are
+    not touched (copied) by the garbage collector of every worker'''
+    if preload_app:
+        gc.freeze()
+
+
+def post_fork(server, worker):
+    '''Do not share the DB connections opened by the master with the workers
+    (the API sessions are recreated per process, see app.contrib.api)'''
+    if preload_app:
+        from app import db
+        from app import psdash
+        with psdash.app_context():
+            db.engine.dispose(close=False)
+
+
+def child_exit(server, worker):
+    '''Drop the live gauges of a dead worker (its counters are kept)'''
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -9,22 +9,35 @@ import argparse
 parser = argparse.ArgumentParser(description='PSDash - CLI server debug')
 parser.add_argument('--dbcreate', type=bool, dest='dbc', default=False, help='Create the DB schema')
 parser.add_argument('--run', dest='run', action='store_true', help='Run the debug server')
+parser.add_argument('--healthcheck', dest='healthcheck', action='store_true',
+                    help='Check the active proxies')
+parser.add_argument('--build-assets', dest='build_assets', action='store_true',
+                    help='Build the fingerprinted and precompressed static files')
 
 
 if __name__ == '__main__':
     args = parser.parse_args()
 
-    if not(args.dbc or args.run):
+    if not(args.dbc or args.run or args.healthcheck or args.build_assets):
         print('Nothing to do')
         sys.exit(0)
 
     from app import db
     from app import psdash
-    from app.views import register_blueprints
+    from app import create_app
 
     if args.dbc:
+        import app.models.health  # pylint: disable=unused-import
         db.create_all()
 
+    if args.build_assets:
+        from app.utils.assets import build_assets
+        print('{} static files built'.format(len(build_assets(psdash.static_folder))))
+
+    if args.healthcheck:
+        from app.utils.healthcheck import run_health_checks
+        with psdash.app_context():
+            print(run_health_checks())
+
     if args.run:
-        register_blueprints(psdash)
-        psdash.run(debug=True)
+        create_app().run(debug=True)
@@ -0,0 +1,233 @@
+"""
+Page latency benchmark
+
+Drives the dashboard pages (lists, edit pages and saves) through the Flask test
+client against the stand-in API (tests.fake_api) and reports, for every scenario,
+the p50/p99 latency and the upstream calls per request:
+
+    python -m tests.bench --proxies 10000 --latency 5 --requests 50
+
+With --max-calls/--max-p99 it exits with an error when a scenario goes over
+them, so it can run before a deploy. The app is configured once per process
+(see create_bench_app), run a new process for every configuration
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+import toml
+
+from tests.fake_api import FakeAPI
+
+
+def percentile(values, percent):
+    '''Nearest-rank percentile of a list of values'''
+    values = sorted(values)
+    if not values:
+        return None
+    rank = max(1, -(-len(values) * percent // 100))
+    return values[int(rank) - 1]
+
+
+def write_bench_config(api_url, page_size=50):
+    '''Write the config of the app to a temporary directory: a temporary SQLite
+    database, no background refresh. It is used if the app is not imported yet
+    (the app reads its config once per process)'''
+    if 'app' in sys.modules:
+        return
+    work_dir = tempfile.mkdtemp(prefix='psdash-bench-')
+    config_path = os.path.join(work_dir, 'config.toml')
+    with open(config_path, 'w') as c_f:
+        toml.dump({
+            'database': {'uri': 'sqlite:///{}'.format(os.path.join(work_dir, 'psdash.db'))},
+            'app': {'domains': ['localhost'], 'secret_key': 'bench', 'page_size': page_size},
+            'api': {'url': api_url, 'api_key': 'bench'},
+            'cache': {'shared_path': os.path.join(work_dir, 'api-cache.sqlite')},
+            # The benchmarks count the API requests of the pages only
+            'refresh': {'enabled': False},
+        }, c_f)
+    os.environ['PSDASH_CONFIG'] = config_path
+
+
+def create_bench_app(api_url, page_size=50):
+    '''Return the dashboard app configured to use the given API, with a temporary
+    SQLite database and no login required (see write_bench_config)'''
+    write_bench_config(api_url, page_size=page_size)
+
+    from app import db
+    from app import psdash
+    from app import create_app
+    import app.models.health  # pylint: disable=unused-import
+
+    # Before create_app: it may warm up the caches from the API
+    psdash.config['api_url'] = api_url
+    create_app()
+    psdash.config['LOGIN_DISABLED'] = True
+    psdash.config['WTF_CSRF_ENABLED'] = False
+    with psdash.app_context():
+        db.create_all()
+    return psdash
+
+
+def pick(api, endpoint, rnd):
+    '''A random element of an endpoint of the fake API'''
+    return rnd.choice(list(api.data[endpoint].values()))
+
+
+def proxy_form_data(api, rnd):
+    '''The form data to save a random proxy'''
+    proxy = pick(api, 'proxy', rnd)
+    return proxy['id'], {
+        'id': proxy['id'],
+        'url': proxy['url'],
+        'active': 'y' if proxy['active'] else '',
+        'proxy_type': proxy['proxy_type_id'],
+        'proxy_location': proxy['proxy_location_id'],
+        'provider': proxy['provider_id'],
+        'provider_plan': proxy['provider_plan_id'],
+        'dont_block': 'y' if proxy['dont_block'] else '',
+    }
+
+
+def target_form_data(api, rnd):
+    '''The form data to save a random target'''
+    target = pick(api, 'target', rnd)
+    return target['id'], {
+        'id': target['id'],
+        'domain': target['domain'],
+        'identifier': target['identifier'],
+        'sleep': target['blocked_standby'],
+        'providers': [rel['provider_id'] for rel in api.data['target_provider'].values()
+                      if rel['target_id'] == target['id']],
+        'plans': [rel['provider_plan_id'] for rel in api.data['target_provider_plan'].values()
+                  if rel['target_id'] == target['id']],
+    }
+
+
+def save_proxy(api, rnd):
+    '''POST the proxy edit form'''
+    proxy_id, data = proxy_form_data(api, rnd)
+    return 'POST', '/proxy/edit?id={}'.format(proxy_id), data
+
+
+def save_target(api, rnd):
+    '''POST the target edit form'''
+    target_id, data = target_form_data(api, rnd)
+    return 'POST', '/target/edit?id={}'.format(target_id), data
+
+
+def list_pages(api, endpoint, page_size=50):
+    '''Number of list pages of an endpoint'''
+    return max(1, -(-len(api.data[endpoint]) // page_size))
+
+
+# (<name>, <function(api, random) returning (<method>, <path>, <form data>)>)
+SCENARIOS = (
+    ('proxies', lambda api, rnd: ('GET', '/proxies', None)),
+    ('proxies page', lambda api, rnd: (
+        'GET', '/proxies?page={}'.format(rnd.randint(1, list_pages(api, 'proxy'))), None)),
+    ('proxies search', lambda api, rnd: (
+        'GET', '/proxies?q=10.0.{}&active=1'.format(rnd.randint(0, 9)), None)),
+    ('proxies filter', lambda api, rnd: (
+        'GET', '/proxies?provider_id={}'.format(pick(api, 'provider', rnd)['id']), None)),
+    ('targets', lambda api, rnd: ('GET', '/targets', None)),
+    ('proxy edit', lambda api, rnd: (
+        'GET', '/proxy/edit?id={}'.format(pick(api, 'proxy', rnd)['id']), None)),
+    ('target edit', lambda api, rnd: (
+        'GET', '/target/edit?id={}'.format(pick(api, 'target', rnd)['id']), None)),
+    ('proxy save', save_proxy),
+    ('target save', save_target),
+    ('stats', lambda api, rnd: ('GET', '/stats', None)),
+)
+
+
+def run_scenario(client, api, make_request, requests, rnd):
+    '''Send the requests of a scenario
+    Return a dict with the latencies (ms) percentiles and the upstream calls'''
+    latencies = []
+    calls = []
+    errors = 0
+    for _ in range(requests):
+        method, path, data = make_request(api, rnd)
+        calls_before = len(api.calls)
+        start = time.perf_counter()
+        if method == 'POST':
+            resp = client.post(path, data=data)
+        else:
+            resp = client.get(path)
+        resp.get_data()
+        latencies.append((time.perf_counter() - start) * 1000)
+        calls.append(len(api.calls) - calls_before)
+        if resp.status_code >= 400:
+            errors += 1
+    return {
+        'requests': requests,
+        'errors': errors,
+        'p50': percentile(latencies, 50),
+        'p99': percentile(latencies, 99),
+        'calls_first': calls[0],
+        'calls_mean': sum(calls) / len(calls),
+        'calls_max': max(calls),
+    }
+
+
+def run_benchmark(proxies=1000, targets=100, providers=10, latency=0.0, jitter=0.0,
+                  requests=20, scenarios=None, seed=0):
+    '''Run the benchmark, return a list of (<scenario name>, <results dict>)
+    @param latency, jitter: seconds added to every upstream request
+    @param scenarios: names of the scenarios to run (all by default)'''
+    api = FakeAPI(latency=latency, jitter=jitter)
+    api.seed(proxies=proxies, targets=targets, providers=providers, seed=seed)
+    server = api.serve()
+    try:
+        client = create_bench_app(api.url(server)).test_client()
+        rnd = random.Random(seed)
+        return [(name, run_scenario(client, api, make_request, requests, rnd))
+                for name, make_request in SCENARIOS
+                if scenarios is None or name in scenarios]
+    finally:
+        server.shutdown()
+
+
+def main():
+    '''Run the benchmark and print the results'''
+    parser = argparse.ArgumentParser(description='PSDash - Page latency benchmark')
+    parser.add_argument('--proxies', type=int, default=1000, help='Number of proxies')
+    parser.add_argument('--targets', type=int, default=100, help='Number of targets')
+    parser.add_argument('--providers', type=int, default=10, help='Number of providers')
+    parser.add_argument('--latency', type=float, default=0, help='Upstream latency (ms)')
+    parser.add_argument('--jitter', type=float, default=0, help='Max random upstream latency (ms)')
+    parser.add_argument('--requests', type=int, default=20, help='Requests per scenario')
+    parser.add_argument('--scenario', action='append', dest='scenarios',
+                        choices=[name for name, _ in SCENARIOS], help='Run only this scenario')
+    parser.add_argument('--max-p99', type=float, help='Fail if a p99 is above (ms)')
+    parser.add_argument('--max-calls', type=float,
+                        help='Fail if the mean upstream calls of a scenario are above')
+    args = parser.parse_args()
+
+    results = run_benchmark(proxies=args.proxies, targets=args.targets,
+                            providers=args.providers, latency=args.latency / 1000,
+                            jitter=args.jitter / 1000, requests=args.requests,
+                            scenarios=args.scenarios)
+    row = '{:<16} {:>8} {:>6} {:>10} {:>10} {:>11} {:>10} {:>9}'
+    print(row.format('scenario', 'requests', 'errors', 'p50 (ms)', 'p99 (ms)',
+                     'calls first', 'calls mean', 'calls max'))
+    failed = False
+    for name, result in results:
+        print(row.format(name, result['requests'], result['errors'],
+                         '{:.1f}'.format(result['p50']), '{:.1f}'.format(result['p99']),
+                         result['calls_first'], '{:.1f}'.format(result['calls_mean']),
+                         result['calls_max']))
+        if (result['errors']
+                or (args.max_p99 is not None and result['p99'] > args.max_p99)
+                or (args.max_calls is not None and result['calls_mean'] > args.max_calls)):
+            failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
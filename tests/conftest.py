@@ -0,0 +1,10 @@
+"""
+The app reads its config once per process, when it is imported: every test gets
+the benchmark config (see tests.bench), whichever module imports the app first.
+The tests point the app at their stand-in API (see create_bench_app)
+"""
+
+from tests.bench import write_bench_config
+
+
+write_bench_config('http://127.0.0.1:9/api/v1.0/')
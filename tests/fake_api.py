@@ -0,0 +1,204 @@
+"""
+Stand-in Proxy Service API
+
+An in-memory version of the API endpoints used by the dashboard, seeded with a
+synthetic inventory and with an optional latency added to every request.
+Every request is recorded, so the upstream calls made by a page can be counted.
+
+Run it standalone (then set [api] url = "http://127.0.0.1:8099/api/v1.0/"):
+
+    python -m tests.fake_api --proxies 10000 --latency 20
+"""
+
+import time
+import random
+import argparse
+import threading
+import itertools
+
+from flask import Flask
+from flask import request
+from flask import jsonify
+from werkzeug.serving import make_server
+from werkzeug.serving import WSGIRequestHandler
+
+
+ENDPOINTS = ('proxy_type', 'proxy_location', 'provider', 'provider_plan', 'proxy',
+             'target', 'target_provider', 'target_provider_plan')
+
+# Query string parameters that are not filters
+RESERVED_PARAMS = ('api_key', 'offset', 'limit')
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    '''Do not log every request'''
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def parse_value(value):
+    '''Parse a query string value the way the API compares it'''
+    if value.lower() in ('true', 'false'):
+        return value.lower() == 'true'
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+
+class FakeAPI:
+    '''In-memory Proxy Service API
+    @param latency: seconds added to every request
+    @param jitter: max random seconds added on top of the latency
+    @param keyset_param: the parameter used for keyset pagination (last ID seen)'''
+
+    def __init__(self, latency=0.0, jitter=0.0, keyset_param='after_id'):
+        self.latency = latency
+        self.jitter = jitter
+        self.keyset_param = keyset_param
+        self.data = {endpoint: {} for endpoint in ENDPOINTS}
+        self.calls = []
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self.app = self.create_app()
+
+    def add(self, endpoint, **element):
+        '''Add an element, return it with its new ID'''
+        with self._lock:
+            element['id'] = next(self._ids)
+            self.data[endpoint][element['id']] = element
+        return element
+
+    def seed(self, proxies=100, targets=20, providers=5, plans=2, types=3, locations=5,
+             target_providers=2, seed=0):
+        '''Add a synthetic inventory
+        @param plans: plans per provider
+        @param target_providers: providers related to every target'''
+        rnd = random.Random(seed)
+        type_ids = [self.add('proxy_type', name='Type {}'.format(num), code='T{}'.format(num))['id']
+                    for num in range(types)]
+        location_ids = [self.add('proxy_location', name='Location {}'.format(num),
+                                 code='L{}'.format(num))['id']
+                        for num in range(locations)]
+        provider_ids = [self.add('provider', name='Provider {}'.format(num), code='P{}'.format(num),
+                                 url='http://provider{}.example.com'.format(num))['id']
+                        for num in range(providers)]
+        plan_ids = {provider_id: [self.add('provider_plan', provider_id=provider_id,
+                                           name='Plan {}-{}'.format(provider_id, num),
+                                           code='PP{}{}'.format(provider_id, num))['id']
+                                  for num in range(plans)]
+                    for provider_id in provider_ids}
+        for num in range(proxies):
+            provider_id = rnd.choice(provider_ids)
+            self.add('proxy',
+                     url='http://10.{}.{}.{}:{}'.format(num >> 16 & 255, num >> 8 & 255, num & 255,
+                                                        rnd.choice((3128, 8080, 8888))),
+                     active=rnd.random() < 0.9,
+                     proxy_type_id=rnd.choice(type_ids),
+                     proxy_location_id=rnd.choice(location_ids),
+                     provider_id=provider_id,
+                     provider_plan_id=rnd.choice(plan_ids[provider_id]),
+                     tor_control_port=None, tor_control_pswd=None, tor_renew_identity=False,
+                     dont_block=rnd.random() < 0.05)
+        for num in range(targets):
+            target = self.add('target', domain='site{}.example.com'.format(num),
+                              identifier='site{}'.format(num), blocked_standby=30)
+            for provider_id in rnd.sample(provider_ids, min(target_providers, providers)):
+                self.add('target_provider', target_id=target['id'], provider_id=provider_id)
+                self.add('target_provider_plan', target_id=target['id'],
+                         provider_plan_id=rnd.choice(plan_ids[provider_id]))
+        return self
+
+    def wait(self):
+        '''Sleep the configured latency'''
+        delay = self.latency + (random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay:
+            time.sleep(delay)
+
+    def list_elements(self, endpoint, args):
+        '''Return the (<page>, <total>) of a list request'''
+        with self._lock:
+            rows = list(self.data[endpoint].values())
+        for param, value in args.items():
+            if param in RESERVED_PARAMS or param == self.keyset_param:
+                continue
+            value = parse_value(value)
+            rows = [row for row in rows if row.get(param) == value]
+        total = len(rows)
+        if self.keyset_param in args:
+            last_id = int(args[self.keyset_param])
+            rows = [row for row in rows if row['id'] > last_id]
+        else:
+            rows = rows[int(args.get('offset', 0)):]
+        if 'limit' in args:
+            rows = rows[:int(args['limit'])]
+        return rows, total
+
+    def create_app(self):
+        '''The Flask app of the API'''
+        app = Flask(__name__)
+
+        @app.route('/api/v1.0/<endpoint>', methods=['GET', 'POST'])
+        def collection(endpoint):
+            if endpoint not in self.data:
+                return jsonify(status='error', message='Unknown endpoint'), 404
+            self.calls.append((request.method, endpoint, None))
+            self.wait()
+            if request.method == 'POST':
+                return jsonify(status='ok', data=self.add(endpoint, **request.get_json()))
+            rows, total = self.list_elements(endpoint, request.args)
+            return jsonify(status='ok', data=rows, total=total)
+
+        @app.route('/api/v1.0/<endpoint>/<int:elem_id>', methods=['GET', 'PUT', 'DELETE'])
+        def element(endpoint, elem_id):
+            if endpoint not in self.data:
+                return jsonify(status='error', message='Unknown endpoint'), 404
+            self.calls.append((request.method, endpoint, elem_id))
+            self.wait()
+            with self._lock:
+                elements = self.data[endpoint]
+                if request.method == 'GET':
+                    return jsonify(status='ok', data=elements.get(elem_id))
+                if elem_id not in elements:
+                    return jsonify(status='error', message='Not found'), 404
+                if request.method == 'PUT':
+                    elements[elem_id].update(request.get_json())
+                    return jsonify(status='ok', data=elements[elem_id])
+                del elements[elem_id]
+                return jsonify(status='ok', data=None)
+
+        return app
+
+    def serve(self, host='127.0.0.1', port=0):
+        '''Serve the API in a background thread
+        Return the server (see server.port and server.shutdown)'''
+        server = make_server(host, port, self.app, threaded=True,
+                             request_handler=QuietRequestHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def url(self, server):
+        '''The API URL to set in the dashboard config'''
+        return 'http://{}:{}/api/v1.0/'.format(server.host, server.port)
+
+
+def main():
+    '''Run the fake API'''
+    parser = argparse.ArgumentParser(description='PSDash - Stand-in Proxy Service API')
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--proxies', type=int, default=1000, help='Number of proxies')
+    parser.add_argument('--targets', type=int, default=100, help='Number of targets')
+    parser.add_argument('--providers', type=int, default=10, help='Number of providers')
+    parser.add_argument('--latency', type=float, default=0, help='Latency added (ms)')
+    parser.add_argument('--jitter', type=float, default=0, help='Max random latency added (ms)')
+    args = parser.parse_args()
+    api = FakeAPI(latency=args.latency / 1000, jitter=args.jitter / 1000)
+    api.seed(proxies=args.proxies, targets=args.targets, providers=args.providers)
+    server = make_server('127.0.0.1', args.port, api.app, threaded=True)
+    print('Serving on {}'.format(api.url(server)))
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
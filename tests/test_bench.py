@@ -0,0 +1,41 @@
+"""
+Upstream call budgets of the dashboard pages
+
+A short run of the benchmark (tests.bench) against the stand-in API. The latency
+depends on the machine, so only the upstream calls per request are checked
+"""
+
+import pytest
+
+from tests.bench import run_benchmark
+
+
+# <scenario>: max mean upstream calls per request
+CALL_BUDGETS = {
+    'proxies': 2,
+    'proxies page': 2,
+    'proxies search': 3,
+    'proxies filter': 2,
+    'targets': 2,
+    'proxy edit': 1,
+    'target edit': 3,
+    'proxy save': 1,
+    'target save': 3,
+    'stats': 3,
+}
+
+
+@pytest.fixture(scope='module')
+def results():
+    '''Run every scenario once'''
+    return dict(run_benchmark(proxies=2000, targets=50, requests=20))
+
+
+@pytest.mark.parametrize('scenario', sorted(CALL_BUDGETS))
+def test_no_errors(results, scenario):
+    assert results[scenario]['errors'] == 0
+
+
+@pytest.mark.parametrize('scenario', sorted(CALL_BUDGETS))
+def test_upstream_calls(results, scenario):
+    assert results[scenario]['calls_mean'] <= CALL_BUDGETS[scenario]
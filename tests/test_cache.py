@@ -0,0 +1,49 @@
+"""
+In-process caches
+"""
+
+
+class FakeTimer:
+    '''A clock moved by hand'''
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_get_expired():
+    from app.contrib.cache import TTLCache
+    timer = FakeTimer()
+    cache = TTLCache(ttl=10, timer=timer)
+    cache.set('key', 'value')
+    timer.now = 9
+    assert cache.get('key') == 'value'
+    timer.now = 10
+    assert cache.get('key') is None
+
+
+def test_pop_expired():
+    from app.contrib.cache import TTLCache
+    timer = FakeTimer()
+    cache = TTLCache(ttl=10, timer=timer)
+    cache.set('fresh', 1)
+    cache.set('old', 2, ttl=5)
+    timer.now = 6
+    assert cache.pop('old', 'missing') == 'missing'
+    assert len(cache) == 1
+    assert cache.pop('fresh') == 1
+    assert cache.pop('fresh') is None
+
+
+def test_len_expired():
+    from app.contrib.cache import TTLCache
+    timer = FakeTimer()
+    cache = TTLCache(ttl=10, timer=timer)
+    cache.set('a', 1)
+    cache.set('b', 2, ttl=20)
+    assert len(cache) == 2
+    timer.now = 15
+    assert len(cache) == 1
+    assert cache.get('b') == 2
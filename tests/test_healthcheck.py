@@ -0,0 +1,211 @@
+"""
+Proxy health checks
+
+The checker runs against the stand-in API (tests.fake_api), with local proxies
+relaying the checks to a local target server
+"""
+
+import sys
+import time
+import socket
+import threading
+import urllib.request
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+from tests.bench import create_bench_app
+from tests.fake_api import FakeAPI
+
+
+class StandInProxy(ThreadingHTTPServer):
+    '''A local HTTP proxy: it relays the GET requests to their URL, or answers them
+    with `status` without relaying them when set
+    It counts the requests and the max of them handled at once (for all the proxies
+    sharing the same `gauge`)'''
+
+    daemon_threads = True
+
+    def __init__(self, status=None, delay=0.0, gauge=None):
+        super().__init__(('127.0.0.1', 0), ProxyHandler)
+        self.status = status
+        self.delay = delay
+        self.gauge = gauge if gauge is not None else Gauge()
+        self.requests = 0
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        '''The proxy URL stored in the API'''
+        return 'http://127.0.0.1:{}'.format(self.server_port)
+
+
+class Gauge:
+    '''Current and max number of requests in progress'''
+
+    def __init__(self):
+        self.current = 0
+        self.max = 0
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        with self._lock:
+            self.current += 1
+            self.max = max(self.max, self.current)
+
+    def __exit__(self, *exc_info):
+        with self._lock:
+            self.current -= 1
+
+
+class ProxyHandler(BaseHTTPRequestHandler):
+    '''Relay a request to the target (self.path is its absolute URL)'''
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        server = self.server
+        server.requests += 1
+        with server.gauge:
+            time.sleep(server.delay)
+            if server.status is not None:
+                status = server.status
+            else:
+                # Directly, not through the proxies of the environment
+                opener = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+                with opener.open(self.path, timeout=5) as resp:
+                    status = resp.status
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class TargetHandler(BaseHTTPRequestHandler):
+    '''The check URL: 200 on /check, 404 elsewhere'''
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        self.server.requests += 1
+        self.send_response(200 if self.path == '/check' else 404)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def closed_port():
+    '''A local port nothing listens on'''
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture()
+def api():
+    '''The stand-in API, served'''
+    fake_api = FakeAPI()
+    server = fake_api.serve()
+    fake_api.server = server
+    yield fake_api
+    server.shutdown()
+
+
+@pytest.fixture()
+def target():
+    '''The target server, its check URL is target.check_url'''
+    server = ThreadingHTTPServer(('127.0.0.1', 0), TargetHandler)
+    server.daemon_threads = True
+    server.requests = 0
+    server.check_url = 'http://127.0.0.1:{}/check'.format(server.server_port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+
+
+@pytest.fixture()
+def psdash(api):
+    '''The app (for its database) pointed at the stand-in API, without any stored
+    health. The API URL of the app is restored afterwards (the app is configured once
+    per process, by the first module creating it)'''
+    app = sys.modules.get('app')
+    api_url = app.psdash.config['api_url'] if app is not None else None
+    psdash = create_bench_app(api.url(api.server))
+    from app import db
+    from app.models.health import ProxyHealth
+    try:
+        with psdash.app_context():
+            ProxyHealth.query.delete()
+            db.session.commit()
+            yield psdash
+    finally:
+        psdash.config['api_url'] = api_url
+
+
+def make_checker(api, target, **kwargs):
+    '''A HealthChecker of the proxies of the stand-in API'''
+    from app.contrib.api import API
+    from app.utils.healthcheck import HealthChecker
+    return HealthChecker(API(api.url(api.server), 'test'), target.check_url, timeout=2,
+                         **kwargs)
+
+
+def add_proxy(api, url, provider_id=1, active=True):
+    '''Add a proxy to the stand-in API, return it'''
+    return api.add('proxy', url=url, active=active, provider_id=provider_id,
+                   provider_plan_id=1, proxy_type_id=1, proxy_location_id=1,
+                   dont_block=False)
+
+
+def test_check_results(psdash, api, target):
+    from app.utils.healthcheck import get_proxies_health
+    good, failing = StandInProxy(), StandInProxy(status=502)
+    ok_id = add_proxy(api, good.url)['id']
+    failed_id = add_proxy(api, failing.url)['id']
+    dead_id = add_proxy(api, 'http://127.0.0.1:{}'.format(closed_port()))['id']
+    inactive = StandInProxy()
+    add_proxy(api, inactive.url, active=False)
+
+    checker = make_checker(api, target)
+    summary = checker.run()
+
+    assert summary == {'checked': 3, 'ok': 1, 'failed': 2, 'deactivated': 0}
+    # No pool manager kept per proxy
+    assert not any(adapter.proxy_manager for adapter in checker.session.adapters.values())
+    assert target.requests == 1 and inactive.requests == 0
+    health = get_proxies_health([ok_id, failed_id, dead_id])
+    assert health[ok_id].consecutive_failures == 0
+    assert health[ok_id].histogram.percentile(50) is not None
+    assert health[failed_id].last_error == 'HTTP 502'
+    assert health[dead_id].last_error == 'ProxyError'
+    assert [row.checks for row in health.values()] == [1, 1, 1]
+
+
+def test_deactivate_after(psdash, api, target):
+    good, failing = StandInProxy(), StandInProxy(status=503)
+    ok_id = add_proxy(api, good.url)['id']
+    failed_id = add_proxy(api, failing.url)['id']
+    checker = make_checker(api, target, deactivate_after=2)
+
+    assert checker.run()['deactivated'] == 0
+    assert checker.run()['deactivated'] == 1
+
+    assert api.data['proxy'][ok_id]['active'] is True
+    assert api.data['proxy'][failed_id]['active'] is False
+    # Sent back whole
+    assert api.data['proxy'][failed_id]['url'] == failing.url
+    # Not checked anymore
+    assert checker.run() == {'checked': 1, 'ok': 1, 'failed': 0, 'deactivated': 0}
+
+
+def test_provider_concurrency(psdash, api, target):
+    gauges = {provider_id: Gauge() for provider_id in (1, 2)}
+    for provider_id, gauge in gauges.items():
+        for _ in range(6):
+            add_proxy(api, StandInProxy(delay=0.1, gauge=gauge).url, provider_id=provider_id)
+
+    summary = make_checker(api, target, concurrency=10, provider_concurrency=2).run()
+
+    assert summary['ok'] == 12
+    assert [gauge.max for gauge in gauges.values()] == [2, 2]
@@ -2,7 +2,6 @@
 To use with Gunicorn
 """
 
-from app import psdash as application
-from app.views import register_blueprints
+from app import create_app
 
-register_blueprints(application)
+application = create_app()